@@ -18,15 +18,23 @@ import json
 import numpy as np
 import matplotlib.pyplot as plt
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from datetime import date
 from pathlib import Path
 from PIL import Image
 from PIL import ImageColor
+from PIL import ImageDraw
 from os.path import exists
 
 from matplotlib.colors import LinearSegmentedColormap
 
+import kernels
+import nearcolor
+import reference
+import stagecache
+import stagetrace
+
 # Constants
 # maximum color brightness
 MAX_COLOR = 255
@@ -38,6 +46,10 @@ BACKGROUND = (0, 0, 0, 255)
 #BBLACK = (0, 0, 255)
 BLACK = (0, 0, 0)
 WHITE = (MAX_COLOR, MAX_COLOR, MAX_COLOR)
+# largest side of each image in a threshold sweep contact sheet, larger images are shrunk
+SHEET_CELL = 256
+# width of the threshold label column in a contact sheet
+SHEET_LABEL = 64
 # max_cDist is the greatest distance between colors
 # (distance between black and white, so sqrt((255 * 255) * 3) + 1))
 MAX_CDIST = 443
@@ -113,6 +125,44 @@ def palette(cm):
     return(ncColors)
 
 
+def loadPalette(pn):
+    # Read a palette from a JSON palette file, or create one from a
+    # MatPlotLib colormap, returns the palette and the name to save it under
+    colors = []
+
+    # Test for custom palette in file
+    cpPath = Path(pn)
+    if cpPath.exists():
+        # It's a file, read in the JSONized palette
+        cpFP = open(pn)
+        pData = json.load(cpFP)
+
+        # convert JSON lists to tuples for the palette
+        for d in pData:
+            colors.append(tuple(d))
+
+        # strip .json extension from palette name
+        pn = pn.split('.')[0]
+    else:
+        cpPath = Path(pn + ".json")
+        if cpPath.exists():
+            # It's a file, user just forgot to add ".json" extension.
+            cpFP = open(pn + ".json")
+            pData = json.load(cpFP)
+
+            # convert JSON lists to tuples for the palette
+            for d in pData:
+                colors.append(tuple(d))
+        else:
+            # Use MatPlotLib colormap to query colormap for colors, save in look up tables
+            cm = plt.colormaps.get_cmap(pn)
+
+            # poster lookup table
+            colors = palette(cm)
+
+    return(colors, pn)
+
+
 def invert(pixel):
     # invert (compliment) the provided pixel
 
@@ -123,38 +173,62 @@ def invert(pixel):
     return((r, g, b))
 
 
+def saturatePalette(colors):
+    # scale up color saturation by pushing max component to 255,
+    # and scaling up the other two components the same amount
+    satColors = list()
+    for color in colors:
+        maxComponent = max(max(color), 1)
+#        maxR = int((color[0] / maxComponent) * 255)
+#        maxG = int((color[1] / maxComponent) * 255)
+#        maxB = int((color[2] / maxComponent) * 255)
+#        saturator = 255.0 * maxComponent
+        saturator = 255.0 / maxComponent
+        maxR = int(color[0] * saturator)
+        maxG = int(color[1] * saturator)
+        maxB = int(color[2] * saturator)
+        satColors.append((maxR, maxG, maxB))
+
+    return(satColors)
+
+
 def get_lum(pixel):
     # Calculate luminosity of an (r, g, b) pixel
     # gray level = 0.3r + 0.59g + 0.11b
+    # NOTE: integer math, same result as the float version of the formula
 
-    lum = int((0.3 * pixel[0]) + (0.59 * pixel[1]) + (0.11 * pixel[2]))
-
-    return(lum)
+    return(kernels.pixelLum(pixel))
 
 
-def get_luminosities(im, lums, border=0):
+def get_luminosities(im, lums, border=0, mode="int"):
     # Calculate the luminosity of every pixel in im inside the border area
-
-    for x in range(border, im.size[0] - border):
-        for y in range(border, im.size[1] - border):
-            lums[x, y] = get_lum(im.getpixel((x, y)))
-
-
-# Read or generate luminosity data
-def lumData(im, name, bord=0):
-    lumPath = Path(name)
-    lums = None
-    if lumPath.exists():
-        lpFP = open(name, "rb")
-        lums = np.load(lpFP)
-        print(str(datetime.now()), "Using saved file:", name)
-    else:
+    # NOTE: whole array at once, same results as get_lum() on each pixel
+    #       mode is "int" (lookup tables) or "float" (float weights)
+    if reference.active():
+        # original per pixel loop (mode makes no difference to it)
+        reference.luminosities(im, lums, border)
+        return
+
+    rgb = kernels.imageArray(im)
+    inner = (slice(border, im.size[0] - border), slice(border, im.size[1] - border))
+
+    lums[inner] = kernels.luminosities(rgb[inner], mode)
+
+
+# Read cached luminosity data, or generate it
+def lumData(im, name, bord=0, mode="int"):
+    # NOTE: cached by the image contents and settings, name is written
+    #       as well, for use by other programs, unless it's already up to date
+    key = stagecache.stageKey("lums", stagecache.dataHash(im), {"border": bord, "mode": mode},
+                              (get_luminosities,))
+    lums = stagecache.loadArray("lums", key, kernels.LUM_DTYPE)
+    if lums is None:
         # Calculate input image pixel luminosities
-        lums = np.zeros(im.size).astype(int)
-        get_luminosities(im, lums, bord)
-        lpFP = open(name, "wb")
-        np.save(lpFP, lums)
-    lpFP.close()
+        lums = np.zeros(im.size, dtype=kernels.LUM_DTYPE)
+        get_luminosities(im, lums, bord, mode)
+        stagecache.saveArray("lums", key, lums)
+
+    stagecache.exportArray(key, lums, name)
 
     return(lums)
 
@@ -177,39 +251,39 @@ def get_av(im, x, y):
     return((int(r / 9), int(g / 9), int(b / 9)))
 
 
-def processImage(npa, name, palette, save=False, border=0):
-    # Create, and possibly display, and possibly save, an image
-    # using provided lookup values and palette
+def processImages(npa, names, palettes, saves, border=0):
+    # Create, and possibly save, one image per palette using the same
+    # lookup values, rendering all of them in a single pass over npa
 
-    # Create canvas for new image
-    newIm = Image.new('RGB', npa.shape, BACKGROUND)
-    pixels = newIm.load()
+    # Look up the palette colors, then blank the border back to the background
+    # NOTE: every palette's pixels share the one [x, y, palette, (r, g, b)] array
+    rgb = kernels.renderPalettes(npa, palettes, "npa")
+    rgb[:border] = rgb[npa.shape[0] - border:] = BLACK
+    rgb[:, :border] = rgb[:, npa.shape[1] - border:] = BLACK
 
-    for x in range(border, npa.shape[0] - border):
-        for y in range(border, npa.shape[1] - border):
-            try:
-                pixels[x, y] = palette[npa[x, y]]
-            except:
-                print("ERROR: npa[", str(x) + ",", str(y) + "] = ", str(npa[x, y]))
+    newIms = list()
+    for p in range(len(palettes)):
+        newIm = kernels.arrayImage(rgb[:, :, p])
 
-    if save:
-        newIm.save(name, format="PNG", quality=95)
+        if saves[p]:
+            newIm.save(names[p], format="PNG", quality=95)
 
-    # NOTE: crops border from around generated image
-    return(newIm.crop((border, border, npa.shape[0] - border, npa.shape[1] - border)))
+        # NOTE: crops border from around generated image
+        newIms.append(newIm.crop((border, border, npa.shape[0] - border, npa.shape[1] - border)))
 
+    return(newIms)
 
-# Read saved image, or create if it doesn't exist
+
+def processImage(npa, name, palette, save=False, border=0):
+    # Create, and possibly display, and possibly save, an image
+    # using provided lookup values and palette
+    return(processImages(npa, [name], [palette], [save], border)[0])
+
+
+# Create, and possibly display, and possibly save, an image
+# NOTE: always rendered, a single palette lookup is cheaper than reading a saved file
 def getImage(npa, name, palette, display=False, save=False, bord=0):
-    imPath = Path(name)
-    im = None
-    if imPath.exists():
-        # read image
-        im = Image.open(name)
-        print(str(datetime.now()), "Using saved file:", name)
-    else:
-        # create image
-        im = processImage(npa, name, palette, save, bord)
+    im = processImage(npa, name, palette, save, bord)
 
     if display:
         im.show()
@@ -217,17 +291,41 @@ def getImage(npa, name, palette, display=False, save=False, bord=0):
     return(im)
 
 
+# Create, and possibly display, and possibly save, a batch of images in one pass
+# requests maps a key to a (name, palette, display, save) tuple,
+# returns a dictionary of images with the same keys
+def getImages(npa, requests, bord=0):
+    keys = list(requests.keys())
+    newIms = processImages(npa,
+                           [requests[key][0] for key in keys],
+                           [requests[key][1] for key in keys],
+                           [requests[key][3] for key in keys],
+                           bord
+                           )
+    images = dict(zip(keys, newIms))
+
+    for key, (name, palette, display, save) in requests.items():
+        if display:
+            images[key].show()
+
+    return(images)
+
+
 def smoothImage(im, name, save=False, border=0):
     # Create, and possibly display, and possibly save, a smoothed image
     # created by averaging the 3x3 box centerd on each input imagee
 
-    # Create canvas for new image
-    newIm = Image.new('RGB', im.size, BACKGROUND)
-    pixels = newIm.load()
+    if reference.active():
+        # original per pixel loop
+        newIm = reference.smoothImage(im, border)
+    else:
+        # Average every 3x3 box at once, then blank the border back to the background
+        # NOTE: same integer-truncated averages as get_av()
+        rgb = kernels.boxAverage(kernels.imageArray(im), 3)
+        rgb[:border] = rgb[im.size[0] - border:] = BLACK
+        rgb[:, :border] = rgb[:, im.size[1] - border:] = BLACK
 
-    for x in range(border, im.size[0] - border):
-        for y in range(border, im.size[1] - border):
-            pixels[x, y] = get_av(im, x, y)
+        newIm = kernels.arrayImage(rgb)
 
     if save:
         newIm.save(name, format="PNG", quality=95)
@@ -235,17 +333,20 @@ def smoothImage(im, name, save=False, border=0):
     return(newIm.crop((border, border, im.size[0] - border, im.size[1] - border)))
 
 
-# Either open or generate the smoothed imagee
+# Either read the cached smoothed image, or generate it
 def getSmoothImage(im, name, display=False, save=False, border=0):
-    sImPath = Path(name)
-    sIm = None
-    if sImPath.exists():
-        # read image
-        sIm = Image.open(name)
-        print(str(datetime.now()), "Using saved file:", name)
-    else:
+    # NOTE: cached by the image contents and border
+    key = stagecache.stageKey("smooth", stagecache.dataHash(im), {"border": border}, (smoothImage,))
+    sIm = stagecache.loadImage("smooth", key)
+    if sIm is None:
         # create image
         sIm = smoothImage(im, name, save, border)
+        stagecache.saveImage("smooth", key, sIm)
+    elif save:
+        # saved file is the full size image, with a blank border
+        saveIm = Image.new("RGB", im.size, BACKGROUND)
+        saveIm.paste(sIm, (border, border))
+        saveIm.save(name, format="PNG", quality=95)
 
     if display:
         sIm.show()
@@ -299,42 +400,41 @@ def sobel(im, x, y):
 
 # Fill an edges array with the calculated sobel edge gradient
 def createSobelEdges(im, edges, border=0):
+    if reference.active():
+        # original per pixel loop
+        reference.sobelEdges(im, edges, border)
+        return
+
+    # NOTE: whole array at once from the red plane, same values as sobel()
+    grads = kernels.sobelGradients(kernels.imageArray(im)[..., 0])
+    inner = (slice(border, im.size[0] - (2 * border)), slice(border, im.size[1] - (2 * border)))
 
-    for x in range(border, im.size[0] - (2 * border)):
-        for y in range(border, im.size[1] - (2 * border)):
-            edges[x, y] = sobel(im, x, y)
+    edges[inner] = grads[inner]
 
 
-# Read gradients file if exists, else calculate gradients.
+# Read the cached gradients for the image, else calculate the gradients
+# (once) and cache them. name is written as well (if not up to date), for cli_thinning.py
+# Returns the gradients, and True if they came from the cache
 def getEdges(im, name, bord=0):
-    ePath = Path(name)
-    edges = None
-    if ePath.exists():
-        epFP = open(name, "rb")
-        edges = np.load(epFP)
-        print(str(datetime.now()), "Using saved file:", name)
-    else:
-        # Calculate input image pixel luminosities
-        edges = np.zeros(im.size).astype(int)
+    key = stagecache.stageKey("sobel", stagecache.dataHash(im), {"border": bord}, (createSobelEdges,))
+    edges = stagecache.loadArray("sobel", key, kernels.SOBEL_DTYPE)
+    cached = edges is not None
+    if not cached:
+        # Calculate smoothed image sobel gradients
+        edges = np.zeros(im.size, dtype=kernels.SOBEL_DTYPE)
         createSobelEdges(im, edges, bord)
-        epFP = open(name, "wb")
-        np.save(epFP, edges)
-    epFP.close()
+        stagecache.saveArray("sobel", key, edges)
 
-    return(edges)
-
-
-# Normalize the edges array to 0<->MAX_COLOR
-def normalizeEdges(edges):
-    maxR = np.max(edges)
+    stagecache.exportArray(key, edges, name)
 
-    norm = np.zeros(im.size).astype(int)
+    return((edges, cached))
 
-    for x in range(edges.shape[0]):
-        for y in range(edges.shape[1]):
-            norm[x, y] = int((edges[x, y] / maxR) * MAX_COLOR)
 
-    return(norm)
+# Normalize the edges array to 0<->MAX_COLOR
+def normalizeEdges(edges, mode="max", percentile=kernels.NORM_PERCENTILE, scale=kernels.MAX_SOBEL):
+    # Scale the edge gradients into the range 0 - MAX_COLOR, for palette lookups
+    # mode is one of kernels.NORM_MODES, see kernels.normalizeGradients()
+    return(kernels.normalizeGradients(edges, mode, percentile, scale, MAX_COLOR))
 
 
 # Create a palettized version of the edge gradients
@@ -342,15 +442,8 @@ def edgesImage(edges, name, palette, display=False, save=False):
     # Create, and possibly display, and possibly save, an image
     # by applying the provided sobel edges values to the provide image
 
-    # Create canvas for new image
-    newIm = Image.new('RGB', edges.shape, BACKGROUND)
-    newPixels = newIm.load()
-
-    max = np.max(edges)
-
-    for x in range(edges.shape[0]):
-        for y in range(edges.shape[1]):
-            newPixels[x, y] = palette[edges[x, y]]
+    # Look up the palette color for every edge value
+    newIm = kernels.arrayImage(kernels.renderPalette(edges, palette, "edges"))
 
     if display:
         newIm.show()
@@ -361,32 +454,191 @@ def edgesImage(edges, name, palette, display=False, save=False):
     return(newIm)
 
 
-def applyEdges(im, edges, name, th, display=False, save=False):
-    # Create, and possibly display, and possibly save, an image
-    # by applying the provided sobel edges values to the provide image
+def edgeMask(edges, th):
+    # Mark the pixels whose edge value is at or above the threshold,
+    # these are blacked out in every image the edges are applied to
+    return(np.asarray(edges) >= th)
 
-    # Create canvas for new image
-    newIm = Image.new('RGB', im.size, BACKGROUND)
-    newPixels = newIm.load()
 
-    # get the input image
-    pixels = im.load()
-    
-    for x in range(im.size[0]):
-        for y in range(im.size[1]):
-            if edges[x, y] < th:
-                newPixels[x, y] = pixels[x, y]
-            else:
-                newPixels[x, y] = BLACK
-#                newPixels[x, y] = BBLACK
+def applyEdgeMask(ims, mask, names, display=False, saves=None):
+    # Create, and possibly display, and possibly save, one image per input
+    # image by applying the same precomputed edge mask to each of them
+    if saves is None:
+        saves = [False] * len(ims)
 
-    if display:
-        newIm.show()
+    newIms = list()
+    for i in range(len(ims)):
+        rgb = kernels.imageArray(ims[i]).copy()
+        # NOTE: pixels past the edge of the mask are kept, as if their edge value was 0
+        w = min(rgb.shape[0], mask.shape[0])
+        h = min(rgb.shape[1], mask.shape[1])
+        rgb[:w, :h][mask[:w, :h]] = BLACK
+        newIm = kernels.arrayImage(rgb)
 
-    if save:
-        newIm.save(name, format="PNG", quality=95)
+        if display:
+            newIm.show()
 
-    return(newIm)
+        if saves[i]:
+            newIm.save(names[i], format="PNG", quality=95)
+
+        newIms.append(newIm)
+
+    return(newIms)
+
+
+def applyEdges(im, edges, name, th, display=False, save=False):
+    # Create, and possibly display, and possibly save, an image
+    # by applying the provided sobel edges values to the provide image
+    return(applyEdgeMask([im], edgeMask(edges, th), [name], display, [save])[0])
+
+
+def thresholdRange(text):
+    # Parse a start:stop:step threshold sweep, eg: 4:64:4, stop included
+    try:
+        start, stop, step = (int(value) for value in text.split(":"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("threshold sweep '" + text + "' is not start:stop:step")
+
+    if step < 1 or start > stop:
+        raise argparse.ArgumentTypeError("threshold sweep '" + text + "' is empty")
+
+    return(list(range(start, stop + 1, step)))
+
+
+def contactSheet(rows, labels):
+    # Lay out rows of images side by side, with a label to the left of each row
+    # NOTE: every cell is the size of the largest image
+    cellW = max(im.size[0] for row in rows for im in row)
+    cellH = max(im.size[1] for row in rows for im in row)
+    sheet = Image.new("RGB",
+                      (SHEET_LABEL + (cellW * max(len(row) for row in rows)), cellH * len(rows)),
+                      BACKGROUND)
+    draw = ImageDraw.Draw(sheet)
+    for r in range(len(rows)):
+        draw.text((4, (r * cellH) + 4), labels[r], fill=WHITE)
+        for c in range(len(rows[r])):
+            sheet.paste(rows[r][c], (SHEET_LABEL + (c * cellW), r * cellH))
+
+    return(sheet)
+
+
+def thresholdSweep(edges, thresholds, lineart, requests, sheetName):
+    # Create and save the edge dependent images for every threshold from
+    # one set of normalized edges, then a contact sheet of all of them
+    # lineart is the (color, base name, suffix) of the line art image,
+    # requests is a list of (image, base name, suffix) to apply edges to,
+    # each saved as base name + threshold + "_" + suffix
+    # NOTE: images are encoded and saved by a pool of threads, while the
+    #       next threshold's images are being created
+    rows = list()
+    with ThreadPoolExecutor() as pool:
+        saves = list()
+        for th in thresholds:
+            mask = edgeMask(edges, th)
+
+            # line art is the line art color wherever the edges are at or above th
+            rgb = np.zeros(mask.shape + (3,), dtype=np.uint8)
+            rgb[mask] = lineart[0]
+            ims = [kernels.arrayImage(rgb)]
+            names = [lineart[1] + str(th) + "_" + lineart[2]]
+
+            ims += applyEdgeMask([request[0] for request in requests], mask, None)
+            names += [request[1] + str(th) + "_" + request[2] for request in requests]
+
+            for i in range(len(ims)):
+                saves.append(pool.submit(ims[i].save, names[i], format="PNG", quality=95))
+
+            thumbs = list()
+            for sweepIm in ims:
+                thumb = sweepIm.copy()
+                thumb.thumbnail((SHEET_CELL, SHEET_CELL))
+                thumbs.append(thumb)
+            rows.append(thumbs)
+            print(str(datetime.now()), "Threshold", th, "sweep images done.")
+
+        # wait for, and report any errors from, the saves
+        for save in saves:
+            save.result()
+
+    contactSheet(rows, ["th " + str(th) for th in thresholds]).save(sheetName, format="PNG", quality=95)
+    print(str(datetime.now()), "Threshold sweep contact sheet saved:", sheetName)
+
+
+def mainComponent(color):
+    # return masked version of largest component of color
+    # NOTE: on =, g>r, b>r, b>g, ie: yellow->green, magenta->blue, white,cyan->blue
+    r, g, b = color
+    if r > g:
+        if r > b:
+            return(((r & 0xF0), 0, 0))
+        else:
+            return((0, 0, (b * 0xF0)))
+    else:
+        if g > b:
+            return((0, (g & 0xF0), 0))
+        else:
+            return((0, 0, (b & 0xF0)))
+
+
+def crossStitch(oIm, colors):
+    # Create a pseudo-cross stitch image, one 5x5 stitch per 5x5 block of
+    # oIm, colored by looking up the luminosity of the block's 3x3 center
+    # Ensure output image is an integer multiple of 5 in each dimension
+    xs_x = int(((oIm.size[0] + 4) // 5) * 5)
+    xs_y = int(((oIm.size[1] + 4) // 5) * 5)
+    xs_size = (xs_x, xs_y)
+
+    # create blank canvas for cross stitch image
+    xsIm = Image.new("RGB", xs_size, BACKGROUND)
+    xsPixels = xsIm.load()
+    # create properly sized version of original image to allow skipping boundary checking
+    im = Image.new("RGB", xs_size, BACKGROUND)
+    im.paste(oIm, (0, 0))
+    imPixels = im.load()
+    # scan through sized original image, average 3x3 block in center of each 5x5 block,
+    # look up cross stich color, apply cross stitch and complementary background
+    x = 0
+    while x < xsIm.size[0]:
+        y = 0
+        while y < xsIm.size[1]:
+            # get stitch color from average brightness of current 3x3 pixel center block
+            # get total red value of block
+            rTotal = (imPixels[x+1,y+1][0] + imPixels[x+2,y+1][0] + imPixels[x+3,y+1][0] +
+                      imPixels[x+1,y+2][0] + imPixels[x+2,y+2][0] + imPixels[x+3,y+2][0] +
+                      imPixels[x+1,y+3][0] + imPixels[x+2,y+3][0] + imPixels[x+3,y+3][0])
+            # get total green value of block
+            gTotal = (imPixels[x+1,y+1][1] + imPixels[x+2,y+1][1] + imPixels[x+3,y+1][1] +
+                      imPixels[x+1,y+2][1] + imPixels[x+2,y+2][1] + imPixels[x+3,y+2][1] +
+                      imPixels[x+1,y+3][1] + imPixels[x+2,y+3][1] + imPixels[x+3,y+3][1])
+            # get total blue value of block
+            bTotal = (imPixels[x+1,y+1][2] + imPixels[x+2,y+1][2] + imPixels[x+3,y+1][2] +
+                      imPixels[x+1,y+2][2] + imPixels[x+2,y+2][1] + imPixels[x+3,y+2][2] +
+                      imPixels[x+1,y+3][2] + imPixels[x+2,y+3][1] + imPixels[x+3,y+3][2])
+            # calculate average red, green, blue values
+            newR = rTotal // 9
+            newG = gTotal // 9
+            newB = bTotal // 9
+            # calculate brighteness of averaged pixel, look up stitch color in the standard palette
+            lum = get_lum((newR, newG, newB))
+            color = colors[lum]
+            # xs_color = largest component of (r, g, b) set to 255, rest set to 0
+            xs_color = mainComponent(color)
+            # draw in the X of the sticth on the background
+            xsPixels[x,y] = xsPixels[x+4,y] = xsPixels[x,y+4] = xsPixels[x+4,y+4] = color
+            # Draw in center stitch with saturated color
+            xsPixels[x+1,y+1] = xsPixels[x+3,y+1] = xs_color
+            xsPixels[x+2,y+2] = xs_color
+            xsPixels[x+1,y+3] = xsPixels[x+3,y+3] = xs_color
+            # Fill in rest of block with posterized color
+            xsPixels[x+1,y] = xsPixels[x+2,y] = xsPixels[x+3, y] = color
+            xsPixels[x,y+1] = xsPixels[x+2,y+1] = xsPixels[x+4,y+1] = color
+            xsPixels[x,y+2] = xsPixels[x+1,y+2] = xsPixels[x+3,y+2] = xsPixels[x+4,y+2] = color
+            xsPixels[x,y+3] = xsPixels[x+2,y+3] = xsPixels[x+4,y+3] = color
+            xsPixels[x+1,y+4] = xsPixels[x+2,y+4] = xsPixels[x+3,y+4] = color
+            y += 5
+        x += 5
+
+    return(xsIm)
 
 
 
@@ -413,6 +665,18 @@ if __name__ == '__main__':
                         default="jet"
                         )
 
+    # Optional argument for more palettes to render, names or JSON files
+    # NOTE: reuses the luminosities, smoothing, and edges calculated for --pn,
+    #       and creates the posterized, line art, and edged posterized images
+    #       for each palette (not the optional versions, eg: --nc, --pc)
+    parser.add_argument('--pns',
+                        action="store",
+                        dest="pns",
+                        help="more posterization palette names",
+                        nargs="+",
+                        default=[]
+                        )
+
     # Optional argument for edge threshhold (defaults to 16)
     parser.add_argument('--th',
                         type=int,
@@ -429,6 +693,114 @@ if __name__ == '__main__':
                         default="white"
                         )
 
+    # Optional argument for a threshold sweep, start:stop:step (stop included)
+    # NOTE: creates the edge dependent images for every threshold in the sweep,
+    #       along with a contact sheet, reusing the one set of edges
+    parser.add_argument('--th-sweep',
+                        action="store",
+                        dest="ths",
+                        help="threshold sweep, start:stop:step, eg: 4:64:4",
+                        type=thresholdRange,
+                        default=None
+                        )
+
+    # Optional argument for luminosity math (defaults to int)
+    # NOTE: int and float give identical results, int is lighter on memory
+    parser.add_argument('--lm',
+                        action="store",
+                        dest="lm",
+                        help="luminosity math (int or float)",
+                        choices=kernels.LUM_MODES,
+                        default="int"
+                        )
+
+    # Optional arguments for the intermediate results cache
+    # NOTE: least recently used results are removed to keep under the size limit
+    parser.add_argument('--cache-dir',
+                        action="store",
+                        dest="cd",
+                        help="intermediate results cache directory",
+                        default=stagecache.CACHE_DIR
+                        )
+
+    parser.add_argument('--cache-mb',
+                        type=float,
+                        dest="cmb",
+                        help="intermediate results cache size limit, in megabytes",
+                        default=stagecache.CACHE_MB
+                        )
+
+    # Optional argument to read cached arrays in full, instead of memory mapping them
+    parser.add_argument('--eager', action='store_true', help="read cached arrays in full (for benchmarking)")
+
+    # Optional argument for the image operations backend (defaults to fast)
+    # NOTE: reference runs the original per pixel loops, very slowly, for
+    #       checking the fast versions against, see cli_golden.py
+    parser.add_argument('--backend',
+                        action="store",
+                        dest="backend",
+                        help="image operations backend (fast or reference)",
+                        choices=reference.BACKENDS,
+                        default="fast"
+                        )
+
+    # Optional arguments for the stage timing trace
+    # NOTE: a summary table is always printed at the end of the run,
+    #       the trace file is CSV if its name ends in .csv, JSON otherwise
+    parser.add_argument('--trace',
+                        action="store",
+                        dest="trace",
+                        help="stage timing trace filename (.json or .csv)",
+                        default=None
+                        )
+
+    parser.add_argument('--trace-mem',
+                        action="store",
+                        dest="tm",
+                        help="stage peak memory measure (rss, or tracemalloc which is slower)",
+                        choices=stagetrace.MEMORY_MODES,
+                        default="rss"
+                        )
+
+    # Optional arguments to profile each stage, one cProfile file per stage in
+    # the directory (for pstats or snakeviz), plus sampled collapsed stacks
+    # (for flame graphs) if asked
+    parser.add_argument('--profile',
+                        action="store",
+                        dest="prof",
+                        help="stage profile directory",
+                        default=None
+                        )
+
+    parser.add_argument('--profile-collapsed',
+                        action='store_true',
+                        dest="profc",
+                        help="also save sampled collapsed stacks for each stage (needs --profile)"
+                        )
+
+    # Optional arguments for edge normalization (defaults to max)
+    # NOTE: percentile or fixed keep a few very strong edges from squeezing
+    #       all the others into the bottom of the range
+    parser.add_argument('--nm',
+                        action="store",
+                        dest="nm",
+                        help="edge normalization (max, percentile, or fixed)",
+                        choices=kernels.NORM_MODES,
+                        default="max"
+                        )
+
+    parser.add_argument('--np',
+                        type=float,
+                        help="edge normalization percentile",
+                        default=kernels.NORM_PERCENTILE
+                        )
+
+    parser.add_argument('--ns',
+                        type=float,
+                        help="edge normalization fixed scale",
+                        default=kernels.MAX_SOBEL
+                        )
+
     # Optional argument to display all images
     parser.add_argument('--da', action='store_true', help="display all images")
 
@@ -491,6 +863,9 @@ if __name__ == '__main__':
     # Optional argument to create image using nearest palette colors to original
     parser.add_argument('--nc', action='store_true', help="create version using nearest color")
 
+    # Optional argument to allow quantized (approximate) nearest colors, faster first run
+    parser.add_argument('--ncq', action='store_true', help="allow approximate nearest colors")
+
     # Optional argument to create image using dominant color per pixel
     parser.add_argument('--pc', action='store_true', help="create version using primary color")
 
@@ -510,7 +885,21 @@ if __name__ == '__main__':
     args = parser.parse_args()
     print("fn\t", args.fn)
     print("pn\t", args.pn)
+    print("pns\t", args.pns)
     print("th\t", args.th)
+    print("ths\t", args.ths)
+    print("lm\t", args.lm)
+    print("nm\t", args.nm)
+    print("np\t", args.np)
+    print("ns\t", args.ns)
+    print("cd\t", args.cd)
+    print("cmb\t", args.cmb)
+    print("eager\t", args.eager)
+    print("backend\t", args.backend)
+    print("trace\t", args.trace)
+    print("tm\t", args.tm)
+    print("prof\t", args.prof)
+    print("profc\t", args.profc)
     print("lac\t", args.lac)
     print("da\t", args.da)
     print("do\t", args.do)
@@ -529,45 +918,25 @@ if __name__ == '__main__':
     print("wmfn\t", args.wmfn)
     print("ms\t", args.ms)
     print("nc\t", args.nc)
+    print("ncq\t", args.ncq)
     print("pc\t", args.pc)
     print("dc\t", args.dc)
     print("t\t", args.t)
     print("pt\t", args.pt)
     print("xs\t", args.xs)
 
+    # NOTE: the reference backend caches its results separately, so they
+    #       never stand in for the fast backend's, or the other way round
+    reference.configure(args.backend)
+    if reference.active():
+        args.cd = str(Path(args.cd) / "reference")
+    stagecache.configure(args.cd, args.cmb, not args.eager)
+    stagetrace.configure(args.trace, args.tm, "ImageMaker.py", vars(args))
+    stagetrace.configureProfile(args.prof, args.profc)
+
     # Create the working palette
-    colors = []
     anticolors = []
-
-    # Test for custom palette in file
-    cpPath = Path(args.pn)
-    if cpPath.exists():
-        # It's a file, read in the JSONized palette
-        cpFP = open(args.pn)
-        pData = json.load(cpFP)
-
-        # convert JSON lists to tuples for the palette
-        for d in pData:
-            colors.append(tuple(d))
-
-        # strip .json extension from palette name
-        args.pn = args.pn.split('.')[0]
-    else:
-        cpPath = Path(args.pn + ".json")
-        if cpPath.exists():
-            # It's a file, user just forgot to add ".json" extension.
-            cpFP = open(args.pn + ".json")
-            pData = json.load(cpFP)
-
-            # convert JSON lists to tuples for the palette
-            for d in pData:
-                colors.append(tuple(d))
-        else:
-            # Use MatPlotLib colormap to query colormap for colors, save in look up tables
-            cm = plt.colormaps.get_cmap(args.pn)
-
-            # poster lookup table
-            colors = palette(cm)
+    colors, args.pn = loadPalette(args.pn)
 
     if args.ci:
         # create the inverse of the color palette
@@ -589,6 +958,11 @@ if __name__ == '__main__':
     # Create generic grayscale palette
     grays = [(x, x, x) for x in range(len(colors))]
 
+    # Create saturated palettes
+    satColors = saturatePalette(colors)
+    if args.ci:
+        satAnticolors = saturatePalette(anticolors)
+
     # Build image save filename strings
     # All files saved into a directory named from today's date (YYYYMMDD)
     today = date.today()
@@ -638,155 +1012,139 @@ if __name__ == '__main__':
     # Create an image from the nearest palette colors to the original colors
     if args.nc:
         print(str(datetime.now()), "Nearest colors version started.")
-        oImPixels = oIm.load()
-        ncIm = Image.new('RGB', oIm.size, BACKGROUND)
-        ncImPixels = ncIm.load()
-
-        matchCounter = 0
-        mcDict = dict()
-        for x in range(ncIm.size[0]):
-            for y in range(ncIm.size[1]):
-                pixel = oImPixels[x, y]
-                if pixel in mcDict:
-                    # know closest color to this pixel, use look up to cut down on computation
-                    ncImPixels[x, y] = mcDict[pixel]
-                    matchCounter += 1
-                else:
-                    # haven't found closest color to this pixel yet, calculate it
-                    color = nearest(pixel, colors)
-                    ncImPixels[x, y] = color
-                    # and save what we just calculated in a lookup table
-                    mcDict[pixel] = color
-
-        print(str(datetime.now()), "entries in mcDict:", len(mcDict))
-        print(str(datetime.now()), "color already in mcDict:", matchCounter)
+        stagetrace.begin("nc")
+        # Look up every pixel in a precomputed cube of nearest palette colors
+        # NOTE: the full cube is exact, --ncq uses a smaller quantized cube
+        # NOTE: extra last palette entry is nearest()'s white fallback for
+        #       colors with nothing in the palette closer than MAX_CDIST
+        if reference.active():
+            # original per pixel search, see reference.py
+            ncIm = reference.nearestImage(oIm, colors, "l1")
+        else:
+            ncLevels = nearcolor.QUANTIZED_LEVELS if args.ncq else nearcolor.EXACT_LEVELS
+            ncCube = nearcolor.getColorCube(colors, ncLevels, MAX_CDIST)
+            ncIndices = nearcolor.cubeIndices(kernels.imageArray(oIm), ncCube)
+            ncIm = kernels.arrayImage(kernels.renderPalette(ncIndices, colors + [WHITE], "ncIndices"))
+
         if args.da:
             ncIm.show()
         ncIm.save(savePalBase + "nc.png", "JPEG", quality=95)
-        print(str(datetime.now()), "Nearest colors version done.")
-
-    lums = lumData(im, saveBase + "luminosity.npy", bord=BORDER) 
-    print(str(datetime.now()), "Original luminosity array done.")
-
-    # Grayscale image
-    gsIm = getImage(lums,
-                    saveBase + "gs.png",
-                    grays,
-                    (args.da or args.dgs),
-                    True,
-                    BORDER
-                    )
-    print(str(datetime.now()), "Grayscale image done.")
-
-    # Generate posterized and poster-invereted images
-    pIm = getImage(lums,
-                   savePalBase + "p.png",
-                   colors,
-                   (args.da or args.dp),
-                   (args.sa or args.sp),
-                   BORDER
-                   )
-    print(str(datetime.now()), "Posterized image done.")
-
-    if args.ci:
-        piIm = getImage(lums,
-                        savePalBase + "pi.png",
-                        anticolors,
+        stagetrace.end("nc", "Nearest colors version done.")
+
+    stagetrace.begin("lums")
+    lums = lumData(im, saveBase + "luminosity.npy", bord=BORDER, mode=args.lm)
+    stagetrace.end("lums", "Original luminosity array done.")
+
+    # Grayscale, posterized, reverse posterized, and saturated palette images
+    # NOTE: all rendered together in one pass over lums
+    stagetrace.begin("lumImages")
+    lumRequests = dict()
+    lumRequests["gs"] = (saveBase + "gs.png", grays, (args.da or args.dgs), True)
+    lumRequests["p"] = (savePalBase + "p.png",
+                        colors,
                         (args.da or args.dp),
-                        (args.sa or args.sp),
-                        BORDER
+                        (args.sa or args.sp)
                         )
-        print(str(datetime.now()), "Posterized invert image done.")
-
-    # Generate reverse posterized and poster-invereted images
-    rpIm = getImage(lums,
-                    savePalBase + "pr.png",
-                    r_colors,
-                    (args.da or args.dr),
-                    (args.sa or args.sr),
-                    BORDER
-                    )
-    print(str(datetime.now()), "Reverse posterized image done.")
+    lumRequests["pr"] = (savePalBase + "pr.png",
+                         r_colors,
+                         (args.da or args.dr),
+                         (args.sa or args.sr)
+                         )
+    lumRequests["spp"] = (savePalBase + "spp.png",
+                          satColors,
+                          (args.da or args.dp),
+                          (args.sa or args.sp)
+                          )
+    if args.ci:
+        lumRequests["pi"] = (savePalBase + "pi.png",
+                             anticolors,
+                             (args.da or args.dp),
+                             (args.sa or args.sp)
+                             )
+        lumRequests["pri"] = (savePalBase + "pri.png",
+                              r_anticolors,
+                              (args.da or args.dp),
+                              (args.sa or args.sp)
+                              )
+        lumRequests["sppi"] = (savePalBase + "sppi.png",
+                               satAnticolors,
+                               (args.da or args.dp),
+                               (args.sa or args.sp)
+                               )
 
+    lumIms = getImages(lums, lumRequests, BORDER)
+    gsIm = lumIms["gs"]
+    pIm = lumIms["p"]
+    rpIm = lumIms["pr"]
+    satPIm = lumIms["spp"]
     if args.ci:
-        rpiIm = getImage(lums,
-                         savePalBase + "pri.png",
-                         r_anticolors,
-                         (args.da or args.dp),
-                         (args.sa or args.sp),
-                         BORDER
-                         )
-        print(str(datetime.now()), "Reverse posterized invert image done.")
+        piIm = lumIms["pi"]
+        rpiIm = lumIms["pri"]
+        satPiIm = lumIms["sppi"]
+    stagetrace.end("lumImages", "Grayscale and posterized images done.")
 
     # Generate a smoothed (averaged) version of the input image.
+    stagetrace.begin("smooth")
     sIm = getSmoothImage(im,
                          saveBase + "a.png",
                          args.da,
                          True,
                          border=BORDER
                          )
-    print(str(datetime.now()), "Smoothed image done.")
+    stagetrace.end("smooth", "Smoothed image done.")
 
     # Calculate smoothed image pixel luminosities
-    sLums = lumData(sIm, saveBase + "smoothLum.npy", BORDER)
-    print(str(datetime.now()), "Smoothed luminosity array done.")
-
-    # Generatee smoothed grayscale image
-    sgsIm = getImage(sLums,
-                     saveBase + "gsa.png",
-                     grays,
-                     (args.da or args.dgs),
-                     True,
-                     BORDER
-                     )
-    print(str(datetime.now()), "Smoothed grayscale image done.")
-
-    # Generate posterized and poster-invereted images
-    spIm = getImage(sLums,
-                    savePalBase + "sp.png",
-                    colors,
-                    (args.da or args.dp),
-                    (args.sa or args.sp),
-                    BORDER
-                    )
-    print(str(datetime.now()), "Smoothed posterized image done.")
-
+    stagetrace.begin("smoothLums")
+    sLums = lumData(sIm, saveBase + "smoothLum.npy", BORDER, args.lm)
+    stagetrace.end("smoothLums", "Smoothed luminosity array done.")
+
+    # Smoothed grayscale, posterized, and reverse posterized images
+    # NOTE: all rendered together in one pass over sLums
+    stagetrace.begin("smoothLumImages")
+    sLumRequests = dict()
+    sLumRequests["gsa"] = (saveBase + "gsa.png", grays, (args.da or args.dgs), True)
+    sLumRequests["sp"] = (savePalBase + "sp.png",
+                          colors,
+                          (args.da or args.dp),
+                          (args.sa or args.sp)
+                          )
+    sLumRequests["spr"] = (savePalBase + "spr.png",
+                           r_colors,
+                           (args.da or args.dr),
+                           (args.sa or args.sr)
+                           )
     if args.ci:
-        spiIm = getImage(sLums,
-                         savePalBase + "spi.png",
-                         anticolors,
-                         (args.da or args.dp),
-                         (args.sa or args.sp),
-                         BORDER
-                         )
-        print(str(datetime.now()), "Smoothed posterized invert image done.")
-
-    # Generate smoothed reverse posterized and poster-invereted images
-    sprIm = getImage(sLums,
-                    savePalBase + "spr.png",
-                    r_colors,
-                    (args.da or args.dr),
-                    (args.sa or args.sr),
-                    BORDER
-                    )
-    print(str(datetime.now()), "Smoothed reverse posterized image done.")
+        sLumRequests["spi"] = (savePalBase + "spi.png",
+                               anticolors,
+                               (args.da or args.dp),
+                               (args.sa or args.sp)
+                               )
+        sLumRequests["spri"] = (savePalBase + "spri.png",
+                                r_anticolors,
+                                (args.da or args.dp),
+                                (args.sa or args.sp)
+                                )
 
+    sLumIms = getImages(sLums, sLumRequests, BORDER)
+    sgsIm = sLumIms["gsa"]
+    spIm = sLumIms["sp"]
+    sprIm = sLumIms["spr"]
     if args.ci:
-        spriIm = getImage(sLums,
-                         savePalBase + "spri.png",
-                         r_anticolors,
-                         (args.da or args.dp),
-                         (args.sa or args.sp),
-                         BORDER
-                         )
-        print(str(datetime.now()), "Smoothed reverse posterized invert image done.")
-
-    edges = getEdges(sIm, saveBase + "sobel.npy", BORDER)
-    eIm = createSobelEdges(sIm, edges, BORDER)
-    print(str(datetime.now()), "Edge gradients calculated.")
+        spiIm = sLumIms["spi"]
+        spriIm = sLumIms["spri"]
+    stagetrace.end("smoothLumImages", "Smoothed grayscale and posterized images done.")
+
+    # NOTE: getEdges only calculates the gradients when there is no usable saved file
+    stagetrace.begin("edges")
+    edges, edgesCached = getEdges(sIm, saveBase + "sobel.npy", BORDER)
+    if edgesCached:
+        stagetrace.end("edges", "Edge gradients loaded (cache hit).")
+    else:
+        stagetrace.end("edges", "Edge gradients calculated (cache miss).")
 
-    normEdges = normalizeEdges(edges)
-    print(str(datetime.now()), "Edge gradients normalized.")
+    stagetrace.begin("normalize")
+    normEdges = normalizeEdges(edges, args.nm, args.np, args.ns)
+    stagetrace.end("normalize", "Edge gradients normalized.")
 
     edgePal = list()
     lacName = args.lac.lower()
@@ -803,6 +1161,7 @@ if __name__ == '__main__':
             edgePal.append(lineartColor)
 
     # NOTE: Add args.th for filname because edgePal created using args.th
+    stagetrace.begin("lineart")
     edgesIm = edgesImage(normEdges,
                          saveThBase + "l_" + lacName + ".png",
                          edgePal,
@@ -810,8 +1169,9 @@ if __name__ == '__main__':
                          (args.sa or args.spe)
                          )
 
-    print(str(datetime.now()), "Line art image done.")
+    stagetrace.end("lineart", "Line art image done.")
 
+    stagetrace.begin("lineartP")
     colEdges = edgesImage(normEdges,
                           savePalBase + "lp.png",
                           colors,
@@ -819,8 +1179,9 @@ if __name__ == '__main__':
                           (args.sa or args.spe)
                           )
 
-    print(str(datetime.now()), "Posterized line art image done.")
+    stagetrace.end("lineartP", "Posterized line art image done.")
 
+    stagetrace.begin("lineartPi")
     if args.ci:
         antiEdges = edgesImage(normEdges,
                                savePalBase + "lpi.png",
@@ -829,8 +1190,9 @@ if __name__ == '__main__':
                                (args.sa or args.spe)
                                )
 
-    print(str(datetime.now()), "Posterized invert line art image done.")
+    stagetrace.end("lineartPi", "Posterized invert line art image done.")
 
+    stagetrace.begin("lineartPr")
     rcolEdges = edgesImage(normEdges,
                            savePalBase + "lpr.png",
                            r_colors,
@@ -838,8 +1200,9 @@ if __name__ == '__main__':
                            (args.sa or args.sr)
                            )
 
-    print(str(datetime.now()), "Reverse posterized line art image done.")
+    stagetrace.end("lineartPr", "Reverse posterized line art image done.")
 
+    stagetrace.begin("lineartPri")
     if args.ci:
         rantiEdges = edgesImage(normEdges,
                                 savePalBase + "lpri.png",
@@ -848,90 +1211,116 @@ if __name__ == '__main__':
                                 (args.sa or args.sr)
                                 )
 
-    print(str(datetime.now()), "Reverse posterized invert line art image done.")
-
-    if args.nc:
-        # Apply edges to the nearest color image
-        encIM = applyEdges(ncIm,
-                           normEdges,
-                           savePalThBase + "nc_es.png",
-                           args.th,
-                           args.da,
-                           True
-                           )
-
-    # Apply edges to the various posterized images available
-    espIm = applyEdges(spIm,
-                       normEdges,
-                       savePalThBase + "esp.png",
-                       args.th,
-                       args.da,
-                       (args.sa or args.spe)
-                       )
+    stagetrace.end("lineartPri", "Reverse posterized invert line art image done.")
 
-    print(str(datetime.now()), "Edged smoothed posterized image done.")
+    # Find the pixels to black out once, every edged image shares the mask
+    stagetrace.begin("edged")
+    thMask = edgeMask(normEdges, args.th)
 
+    # Apply edges to the nearest color image and the various posterized
+    # images available, in one batch
+    # NOTE: key maps to (image, base name, suffix, save, message)
+    edgeRequests = dict()
+    if args.nc:
+        edgeRequests["nc"] = (ncIm, savePalBase, "nc_es.png", True, None)
+    edgeRequests["sp"] = (spIm, savePalBase, "esp.png", (args.sa or args.spe),
+                          "Edged smoothed posterized image done.")
     if args.ci:
-        espiIm = applyEdges(spiIm,
-                            normEdges,
-                            savePalThBase + "espri.png",
-                            args.th,
-                            args.da,
-                            (args.sa or args.spe)
-                            )
-
-        print(str(datetime.now()), "Edged smoothed reversed posterized invert image done.")
-
-    esprIm = applyEdges(sprIm,
-                       normEdges,
-                       savePalThBase + "espr.png",
-                       args.th,
-                       args.da,
-                       (args.sa or args.spe)
-                       )
-
-    print(str(datetime.now()), "Edged smoothed reversed posterized image done.")
-
+        edgeRequests["spi"] = (spiIm, savePalBase, "espri.png", (args.sa or args.spe),
+                               "Edged smoothed reversed posterized invert image done.")
+    edgeRequests["spr"] = (sprIm, savePalBase, "espr.png", (args.sa or args.spe),
+                           "Edged smoothed reversed posterized image done.")
     if args.ci:
-        espriIm = applyEdges(spriIm,
-                            normEdges,
-                            savePalThBase + "espi.png",
-                            args.th,
-                            args.da,
-                            (args.sa or args.spe)
-                            )
-
-        print(str(datetime.now()), "Edged smoothed reversed posterized invert image done.")
-
-    esIm = applyEdges(sIm,
-                      normEdges,
-                      saveThBase + "es.png",
-                      args.th,
-                      args.da,
-                      True
-                      )
-
-    print(str(datetime.now()), "Edged smoothed image done.")
+        edgeRequests["spri"] = (spriIm, savePalBase, "espi.png", (args.sa or args.spe),
+                                "Edged smoothed reversed posterized invert image done.")
+    edgeRequests["s"] = (sIm, saveBase, "es.png", True,
+                         "Edged smoothed image done.")
+
+    esIms = applyEdgeMask([request[0] for request in edgeRequests.values()],
+                          thMask,
+                          [request[1] + str(args.th) + "_" + request[2] for request in edgeRequests.values()],
+                          args.da,
+                          [request[3] for request in edgeRequests.values()]
+                          )
+    stagetrace.end("edged")
+
+    for request in edgeRequests.values():
+        if request[4]:
+            print(str(datetime.now()), request[4])
+
+    for pn in args.pns:
+        # Create the palette dependent images for each extra palette, from the
+        # luminosities, smoothed luminosities, and edges already calculated
+        stagetrace.begin("palette " + pn)
+        pnColors, pnName = loadPalette(pn)
+        pnSavePalBase = saveBase + pnName + "_"
+        pnSavePalThBase = pnSavePalBase + str(args.th) + "_"
+
+        pnPalettes = dict()
+        pnPalettes["p"] = pnColors
+        pnPalettes["pr"] = [pnColors[i] for i in range(255, -1, -1)]
+        if args.ci:
+            pnPalettes["pi"] = [invert(color) for color in pnColors]
+            pnPalettes["pri"] = [pnPalettes["pi"][i] for i in range(255, -1, -1)]
+
+        # NOTE: same display and save flags as the --pn images
+        pFlags = ((args.da or args.dp), (args.sa or args.sp))
+        rFlags = ((args.da or args.dr), (args.sa or args.sr))
+
+        # posterized and saturated palette images, one pass over lums
+        pnRequests = dict()
+        pnRequests["p"] = (pnSavePalBase + "p.png", pnPalettes["p"]) + pFlags
+        pnRequests["pr"] = (pnSavePalBase + "pr.png", pnPalettes["pr"]) + rFlags
+        pnRequests["spp"] = (pnSavePalBase + "spp.png", saturatePalette(pnPalettes["p"])) + pFlags
+        if args.ci:
+            pnRequests["pi"] = (pnSavePalBase + "pi.png", pnPalettes["pi"]) + pFlags
+            pnRequests["pri"] = (pnSavePalBase + "pri.png", pnPalettes["pri"]) + pFlags
+            pnRequests["sppi"] = (pnSavePalBase + "sppi.png", saturatePalette(pnPalettes["pi"])) + pFlags
+        pnLumIms = getImages(lums, pnRequests, BORDER)
+
+        # smoothed posterized images, one pass over sLums
+        pnRequests = dict()
+        pnRequests["sp"] = (pnSavePalBase + "sp.png", pnPalettes["p"]) + pFlags
+        pnRequests["spr"] = (pnSavePalBase + "spr.png", pnPalettes["pr"]) + rFlags
+        if args.ci:
+            pnRequests["spi"] = (pnSavePalBase + "spi.png", pnPalettes["pi"]) + pFlags
+            pnRequests["spri"] = (pnSavePalBase + "spri.png", pnPalettes["pri"]) + pFlags
+        pnSLumIms = getImages(sLums, pnRequests, BORDER)
+
+        # line art images, one pass over normEdges
+        pnKeys = list(pnPalettes.keys())
+        pnEdgeIms = processImages(normEdges,
+                                  [pnSavePalBase + "l" + key + ".png" for key in pnKeys],
+                                  [pnPalettes[key] for key in pnKeys],
+                                  [(args.sa or (args.spe if key in ("p", "pi") else args.sr)) for key in pnKeys]
+                                  )
+        # NOTE: same display flags as the --pn line art, --dr shows the reversed ones
+        for key, pnEdgeIm in zip(pnKeys, pnEdgeIms):
+            if args.da or (args.dr and key in ("pr", "pri")):
+                pnEdgeIm.show()
+
+        # edged smoothed posterized and saturated palette images, sharing the threshold mask
+        # NOTE: same (swapped) names for the invert versions as for --pn
+        pnEsIms = [pnSLumIms[key] for key in pnSLumIms]
+        pnEsNames = {"sp": "esp.png", "spr": "espr.png", "spi": "espri.png", "spri": "espi.png"}
+        pnEsNames = [pnSavePalThBase + pnEsNames[key] for key in pnSLumIms]
+        pnEsSaves = [(args.sa or args.spe)] * len(pnSLumIms)
+        pnEsIms.append(pnLumIms["spp"])
+        pnEsNames.append(pnSavePalThBase + "espp.png")
+        pnEsSaves.append(True)
+        if args.ci:
+            pnEsIms.append(pnLumIms["sppi"])
+            pnEsNames.append(pnSavePalThBase + "esppi.png")
+            pnEsSaves.append(True)
+        applyEdgeMask(pnEsIms, thMask, pnEsNames, args.da, pnEsSaves)
+
+        stagetrace.end("palette " + pn, "Palette " + pnName + " images done.")
 
     if args.ms:
+        stagetrace.begin("ms")
         # Create max saturation image
-        from colorsys import hsv_to_rgb, rgb_to_hsv
-        
-        msIm = Image.new("RGB", im.size, BACKGROUND)
-        msPixels = msIm.load()
-        msOrigImPixels = im.load()
-        for x in range(msIm.size[0]):
-            for y in range(msIm.size[1]):
-                # get original (r,g,b) information -- NOTE: range 0-255
-                r, g, b = msOrigImPixels[x, y]
-                # convert to (h,s,v) -- NOTE: convert range to 0.0-1.0
-#                h, s, v = rgb_to_hsv(r, g, b)
-                h, s, v = rgb_to_hsv((r / 255), (g / 255), (b / 255))
-                # keep original hue and value, bump saturation to max, get new (r,g,b)
-                nr, ng, nb = hsv_to_rgb(h, 1.0, v)
-                # write new pixel to new image -- NOTE: convert to range 0-255
-#                msPixels[x, y] = (int(nr), int(ng), int(nb))
-                msPixels[x, y] = (int(nr * 255), int(ng * 255), int(nb * 255))
+        # keep original hue and value, bump saturation to max, for all pixels at once
+        msIm = kernels.arrayImage(kernels.maxSaturation(kernels.imageArray(im)))
 
         if args.da:
             msIm.show()
@@ -940,17 +1329,17 @@ if __name__ == '__main__':
             msIm.save(saveBase + "ms.png", format="PNG", quality=95)
             print(str(datetime.now()), "Max saturation image done.")
 
-        msEsIm = applyEdges(msIm,
-                            normEdges,
-                            saveThBase + "ms_es.png",
-                            args.th,
-                            args.da,
-                            True
-                            )
+        msEsIm = applyEdgeMask([msIm],
+                               thMask,
+                               [saveThBase + "ms_es.png"],
+                               args.da,
+                               [True]
+                               )[0]
 
-        print(str(datetime.now()), "Edged max saturation image done.")
+        stagetrace.end("ms", "Edged max saturation image done.")
 
     if args.pc:
+        stagetrace.begin("pc")
         # Create primary colors image (use largest of r/g/b as index)
         
         pcIm = Image.new("RGB", im.size, BACKGROUND)
@@ -968,17 +1357,17 @@ if __name__ == '__main__':
             pcIm.save(savePalBase + "pc.png", format="PNG", quality=95)
             print(str(datetime.now()), "Primary colors image done.")
 
-        pcEsIm = applyEdges(pcIm,
-                            normEdges,
-                            savePalThBase + "pc_es.png",
-                            args.th,
-                            args.da,
-                            True
-                            )
+        pcEsIm = applyEdgeMask([pcIm],
+                               thMask,
+                               [savePalThBase + "pc_es.png"],
+                               args.da,
+                               [True]
+                               )[0]
 
-        print(str(datetime.now()), "Edged primary colors image done.")
+        stagetrace.end("pc", "Edged primary colors image done.")
 
     if args.dc:
+        stagetrace.begin("dc")
         # Set output pixel based on average of palette values indexed separately
         # by red, green, and blue values of original pixel
 
@@ -1007,17 +1396,21 @@ if __name__ == '__main__':
             dcIm.save(savePalBase + "dc.png", format="PNG", quality=95)
             print(str(datetime.now()), "Difference colors image done.")
 
-        dcEsIm = applyEdges(dcIm,
-                            normEdges,
-                            savePalThBase + "dc_es.png",
-                            args.th,
-                            args.da,
-                            True
-                            )
+        dcEsIm = applyEdgeMask([dcIm],
+                               thMask,
+                               [savePalThBase + "dc_es.png"],
+                               args.da,
+                               [True]
+                               )[0]
+
+        stagetrace.end("dc", "Edged difference colors image done.")
 
-        print(str(datetime.now()), "Edged difference colors image done.")
+    # The tiered versions cover the whole padded canvas, with no edges past the gradients
+    tierEdges = np.zeros(im.size, dtype=int)
+    tierEdges[:normEdges.shape[0], :normEdges.shape[1]] = normEdges
 
     if args.t:
+        stagetrace.begin("t")
         # Create tiered image from normalized edges
         
         tIm = Image.new("RGB", im.size, BACKGROUND)
@@ -1025,7 +1418,7 @@ if __name__ == '__main__':
         edgeCounts = {"gray":0,"red":0,"yellow":0,"green":0,"cyan":0,"blue":0,"magenta":0,"white":0}
         for x in range(tIm.size[0]):
             for y in range(tIm.size[1]):
-                edge = normEdges[x, y]
+                edge = tierEdges[x, y]
                 if edge < args.th:
                     # edge value less than threshhold, mark with gray
                     tPixels[x, y] = (64, 64, 64)
@@ -1070,8 +1463,10 @@ if __name__ == '__main__':
         if args.sa:
             tIm.save(saveThBase + "t.png", format="PNG", quality=95)
             print(str(datetime.now()), "Tiered image done.")
+        stagetrace.end("t")
 
     if args.pt:
+        stagetrace.begin("pt")
         # Create palletized ad tiered image from normalized edges
         
         ptIm = Image.new("RGB", im.size, BACKGROUND)
@@ -1080,7 +1475,7 @@ if __name__ == '__main__':
         base = len(colors) - (len(colors) // palDiv)
         for x in range(ptIm.size[0]):
             for y in range(ptIm.size[1]):
-                edge = normEdges[x, y]
+                edge = tierEdges[x, y]
                 if edge < args.th:
                     # edge value less than threshhold, mark with gray
                     ptPixels[x, y] = (64, 64, 64)
@@ -1095,49 +1490,12 @@ if __name__ == '__main__':
         if args.sa:
             ptIm.save(savePalThBase + "pt.png", format="PNG", quality=95)
             print(str(datetime.now()), "Palletized Tiered image done.")
-
-    # Generate saturated palette posterized and poster-invereted images
-    def saturatePalette(colors):
-        # scale up color saturation by pushing max component to 255,
-        # and scaling up the other two components the same amount
-        satColors = list()
-        for color in colors:
-            maxComponent = max(max(color), 1)
-#            maxR = int((color[0] / maxComponent) * 255)
-#            maxG = int((color[1] / maxComponent) * 255)
-#            maxB = int((color[2] / maxComponent) * 255)
-#            saturator = 255.0 * maxComponent
-            saturator = 255.0 / maxComponent
-            maxR = int(color[0] * saturator)
-            maxG = int(color[1] * saturator)
-            maxB = int(color[2] * saturator)
-            satColors.append((maxR, maxG, maxB))
-
-        return(satColors)
+        stagetrace.end("pt")
 
     def superSatColor(color):
         # force saturation to maximum while maintaining hue and value
-        r, g, b = color
-        # convert to (h,s,v) -- NOTE: convert range to 0.0-1.0
-        h, s, v = rgb_to_hsv((r / 255), (g / 255), (b / 255))
-        # keep original hue and value, bump saturation to max, get new (r,g,b)
-        nr, ng, nb = hsv_to_rgb(h, 1.0, v)
-        return(int(nr * 255), int(ng * 255), int(nb * 255))
-
-    def mainComponent(color):
-        # return masked version of largest component of color
-        # NOTE: on =, g>r, b>r, b>g, ie: yellow->green, magenta->blue, white,cyan->blue
-        r, g, b = color
-        if r > g:
-            if r > b:
-                return(((r & 0xF0), 0, 0))
-            else:
-                return((0, 0, (b * 0xF0)))
-        else:
-            if g > b:
-                return((0, (g & 0xF0), 0))
-            else:
-                return((0, 0, (b & 0xF0)))
+        # NOTE: use kernels.maxSaturation() directly for whole palettes
+        return(tuple(kernels.maxSaturation([color[:3]])[0].tolist()))
 
     MULTIPLE = 16
     ROUND = MULTIPLE - 1 
@@ -1150,67 +1508,24 @@ if __name__ == '__main__':
         return((nr, ng, nb))
                 
     if args.xs:
+        stagetrace.begin("xs")
         # Create pseudo-cross stitch image
 
-        # Get saturated version of current palette, for use with stitch
-        xsSatColors = saturatePalette(colors)
-
         # Ensure output image is an integer multiple of 5 in each dimension
         xs_x = int(((oIm.size[0] + 4) // 5) * 5)
         xs_y = int(((oIm.size[1] + 4) // 5) * 5)
         xs_size = (xs_x, xs_y)
 
-        # create blank canvas for cross stitch image
         print(str(datetime.now()), "Creating xsIm")
-        xsIm = Image.new("RGB", xs_size, BACKGROUND)
-        xsPixels = xsIm.load()
-        # create properly sized version of original image to allow skipping boundary checking
+        if reference.active():
+            xsIm = reference.crossStitch(oIm, colors)
+        else:
+            xsIm = crossStitch(oIm, colors)
+        # create properly sized version of original image, for the stitches over the original
         print("\tCreating im")
         im = Image.new("RGB", xs_size, BACKGROUND)
         im.paste(oIm, (0, 0))
         imPixels = im.load()
-        # scan through sized original image, average 3x3 block in center of each 5x5 block,
-        # look up cross stich color, apply cross stitch and complementary background
-        x = 0
-        while x < xsIm.size[0]:
-            y = 0
-            while y < xsIm.size[1]:
-                # get stitch color from average brightness of current 3x3 pixel center block
-                # get total red value of block
-                rTotal = (imPixels[x+1,y+1][0] + imPixels[x+2,y+1][0] + imPixels[x+3,y+1][0] +
-                          imPixels[x+1,y+2][0] + imPixels[x+2,y+2][0] + imPixels[x+3,y+2][0] +
-                          imPixels[x+1,y+3][0] + imPixels[x+2,y+3][0] + imPixels[x+3,y+3][0])
-                # get total green value of block
-                gTotal = (imPixels[x+1,y+1][1] + imPixels[x+2,y+1][1] + imPixels[x+3,y+1][1] +
-                          imPixels[x+1,y+2][1] + imPixels[x+2,y+2][1] + imPixels[x+3,y+2][1] +
-                          imPixels[x+1,y+3][1] + imPixels[x+2,y+3][1] + imPixels[x+3,y+3][1])
-                # get total blue value of block
-                bTotal = (imPixels[x+1,y+1][2] + imPixels[x+2,y+1][2] + imPixels[x+3,y+1][2] +
-                          imPixels[x+1,y+2][2] + imPixels[x+2,y+2][1] + imPixels[x+3,y+2][2] +
-                          imPixels[x+1,y+3][2] + imPixels[x+2,y+3][1] + imPixels[x+3,y+3][2])
-                # calculate average red, green, blue values
-                newR = rTotal // 9
-                newG = gTotal // 9
-                newB = bTotal // 9
-                # calculate brighteness of averaged pixel, look up stitch color in the standard palette
-                lum = get_lum((newR, newG, newB))
-                color = colors[lum]
-                # xs_color = largest component of (r, g, b) set to 255, rest set to 0
-                xs_color = mainComponent(color)
-                # draw in the X of the sticth on the background
-                xsPixels[x,y] = xsPixels[x+4,y] = xsPixels[x,y+4] = xsPixels[x+4,y+4] = color
-                # Draw in center stitch with saturated color
-                xsPixels[x+1,y+1] = xsPixels[x+3,y+1] = xs_color
-                xsPixels[x+2,y+2] = xs_color
-                xsPixels[x+1,y+3] = xsPixels[x+3,y+3] = xs_color
-                # Fill in rest of block with posterized color
-                xsPixels[x+1,y] = xsPixels[x+2,y] = xsPixels[x+3, y] = color
-                xsPixels[x,y+1] = xsPixels[x+2,y+1] = xsPixels[x+4,y+1] = color
-                xsPixels[x,y+2] = xsPixels[x+1,y+2] = xsPixels[x+3,y+2] = xsPixels[x+4,y+2] = color
-                xsPixels[x,y+3] = xsPixels[x+2,y+3] = xsPixels[x+4,y+3] = color
-                xsPixels[x+1,y+4] = xsPixels[x+2,y+4] = xsPixels[x+3,y+4] = color
-                y += 5
-            x += 5
 
         if args.da:
             xsIm.show()
@@ -1336,49 +1651,52 @@ if __name__ == '__main__':
         if args.sa:
             im.save(saveBase + "xsms.png", format="PNG", quality=95)
             print(str(datetime.now()), "Max Saturation Cross Stich image saved.")
+        stagetrace.end("xs")
 
+    stagetrace.begin("espp")
+    satEIm = applyEdgeMask([satPIm],
+                           thMask,
+                           [savePalThBase + "espp.png"],
+                           args.da,
+                           [True]
+                           )[0]
 
-    satColors = saturatePalette(colors)
-    satPIm = getImage(lums,
-                   savePalBase + "spp.png",
-                   satColors,
-                   (args.da or args.dp),
-                   (args.sa or args.sp),
-                   BORDER
-                   )
-    print(str(datetime.now()), "Saturated Palette Posterized image done.")
-
-    satEIm = applyEdges(satPIm,
-                            normEdges,
-                            savePalThBase + "espp.png",
-                            args.th,
-                            args.da,
-                            True
-                            )
-
-    print(str(datetime.now()), "Edged Saturated Palette Posterized image done.")
+    stagetrace.end("espp", "Edged Saturated Palette Posterized image done.")
 
     if args.ci:
-        satAnticolors = saturatePalette(anticolors)
-        satPiIm = getImage(lums,
-                        savePalBase + "sppi.png",
-                        satAnticolors,
-                        (args.da or args.dp),
-                        (args.sa or args.sp),
-                        BORDER
-                        )
-
-        print(str(datetime.now()), "Saturated Palette Posterized invert image done.")
-
-        satEPiIm = applyEdges(satPiIm,
-                            normEdges,
-                            savePalThBase + "esppi.png",
-                            args.th,
-                            args.da,
-                            True
-                            )
-
-        print(str(datetime.now()), "Edged Saturated Palette Posterized invert image done.")
+        stagetrace.begin("esppi")
+        satEPiIm = applyEdgeMask([satPiIm],
+                                 thMask,
+                                 [savePalThBase + "esppi.png"],
+                                 args.da,
+                                 [True]
+                                 )[0]
+
+        stagetrace.end("esppi", "Edged Saturated Palette Posterized invert image done.")
+
+    if args.ths:
+        # Create the line art and every edged image for every threshold in the sweep
+        # NOTE: last, once the max saturation, primary colors, difference colors,
+        #       and saturated palette images to apply edges to all exist
+        stagetrace.begin("thresholdSweep")
+        sweepRequests = [request[:3] for request in edgeRequests.values()]
+        sweepRequests.append((satPIm, savePalBase, "espp.png"))
+        if args.ci:
+            sweepRequests.append((satPiIm, savePalBase, "esppi.png"))
+        if args.ms:
+            sweepRequests.append((msIm, saveBase, "ms_es.png"))
+        if args.pc:
+            sweepRequests.append((pcIm, savePalBase, "pc_es.png"))
+        if args.dc:
+            sweepRequests.append((dcIm, savePalBase, "dc_es.png"))
+        thresholdSweep(normEdges,
+                       args.ths,
+                       (lineartColor, saveBase, "l_" + lacName + ".png"),
+                       sweepRequests,
+                       saveBase + args.pn + "_sweep_" + str(args.ths[0]) + "_" + str(args.ths[-1]) + ".png"
+                       )
+        stagetrace.end("thresholdSweep")
 
     print(str(datetime.now()), "Run complete.")
+    stagetrace.finish()
     
@@ -0,0 +1,492 @@
+#! /Library/Frameworks/Python.framework/Versions/3.9/bin/python3
+#
+# cli_bench.py
+#
+# A program to benchmark the image pipeline stages on synthetic images.
+#
+# Creates deterministic synthetic images (gradients, noise, and photographic
+# like textures) at each requested size, times each stage function on them
+# in isolation, and optionally times whole ImageMaker.py runs, with their
+# per stage times from the --trace file. Writes the results, along with a
+# description of the host, to a JSON file for later comparison.
+#
+# Stages still running per pixel Python loops are only timed on images up to
+# --loop-max pixels, as larger ones take hours.
+#
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import PIL
+
+from datetime import datetime
+from datetime import date
+from pathlib import Path
+from PIL import Image
+
+import cli_thinning
+import ImageMaker
+import kernels
+import nearcolor
+import stagecache
+
+# Default image sizes, each image is size x size pixels (256^2 to 8K^2)
+SIZES = (256, 512, 1024, 2048, 4096, 8192)
+# Synthetic image kinds
+KINDS = ("gradient", "noise", "texture")
+# Stages timed in isolation
+STAGES = ("lumData", "getSmoothImage", "getEdges", "normalizeEdges", "posterize",
+          "edgeMask", "nc", "nearest", "ms", "thinning")
+# Stages that still loop over pixels in Python, limited by --loop-max
+# NOTE: none left in isolation since thinning went whole array, --xs in the
+#       end to end runs still does
+LOOP_STAGES = ()
+# Default largest image (in pixels) for the LOOP_STAGES
+LOOP_MAX = 256 * 256
+# Default flags for the end to end ImageMaker.py runs, --xs is added for
+# images up to --loop-max pixels
+E2E_FLAGS = "--sa --ci --nc --ms"
+# Directories the end to end runs save reusable results in (the stage cache
+# and --nc color cubes), removed before each run so every run is a cold one
+E2E_COLD_DIRS = ("cache", nearcolor.CUBE_DIR)
+# Border around the working canvas, as in ImageMaker.py
+BORDER = 1
+# Edge and thinning thresholds, ImageMaker.py and cli_thinning.py defaults
+EDGE_TH = 16
+THIN_TH = 8
+# Palette used by the stages
+PALETTE = "jet"
+
+
+def rampImage(size):
+    # Smooth red, green, and blue ramps across, down, and diagonally
+    ramp = np.linspace(0, 255, size)
+    rgb = np.empty((size, size, 3), dtype=np.uint8)
+    rgb[..., 0] = ramp[:, None]
+    rgb[..., 1] = ramp[None, :]
+    rgb[..., 2] = (ramp[:, None] + ramp[None, :]) / 2
+
+    return(rgb)
+
+
+def noiseImage(size, rng):
+    # Uniform random noise, every pixel independent
+    return(rng.integers(0, 256, (size, size, 3), dtype=np.uint8))
+
+
+def textureImage(size, rng):
+    # Photographic like texture, smooth shapes at several scales, a few
+    # hard edged regions, and some fine grain
+    # NOTE: float32 and updated in place, a float64 field and its temporaries
+    #       take gigabytes on the largest images
+    field = np.zeros((size, size, 3), dtype=np.float32)
+    weight = 1.0
+    for cells in (4, 16, 64):
+        # smooth random field, coarse noise scaled up with bicubic filtering
+        for channel in range(3):
+            coarse = rng.random((cells, cells)).astype(np.float32)
+            smooth = Image.fromarray(coarse).resize((size, size), Image.BICUBIC)
+            field[..., channel] += weight * np.asarray(smooth).T
+        weight /= 2
+    low = field.min()
+    field -= low
+    field *= 255 / max(field.max(), 1e-9)
+
+    # hard edged rectangles, like objects in front of a background
+    for r in range(8):
+        x0, y0 = rng.integers(0, size, 2)
+        x1, y1 = x0 + rng.integers(size // 16, size // 4, 2)
+        field[x0:x1, y0:y1] = field[x0:x1, y0:y1] * 0.5 + rng.integers(0, 256, 3) * 0.5
+
+    # fine grain
+    for channel in range(3):
+        field[..., channel] += 4 * rng.standard_normal((size, size), dtype=np.float32)
+    np.clip(field, 0, 255, out=field)
+
+    return(field.astype(np.uint8))
+
+
+def syntheticImage(kind, size, seed=0):
+    # Create a deterministic synthetic image, the same kind, size, and seed
+    # always give the same pixels
+    rng = np.random.default_rng([seed, size, KINDS.index(kind)])
+    if kind == "gradient":
+        rgb = rampImage(size)
+    elif kind == "noise":
+        rgb = noiseImage(size, rng)
+    elif kind == "texture":
+        rgb = textureImage(size, rng)
+    else:
+        raise ValueError("Unknown image kind '" + str(kind) + "', use one of " + str(KINDS))
+
+    return(kernels.arrayImage(rgb))
+
+
+def hostInfo():
+    # Description of the host and software versions, stored with the results
+    host = dict()
+    host["node"] = platform.node()
+    host["platform"] = platform.platform()
+    host["machine"] = platform.machine()
+    host["processor"] = platform.processor()
+    try:
+        # NOTE: platform.processor() is often blank on Linux
+        with open("/proc/cpuinfo") as fp:
+            for line in fp:
+                if line.startswith("model name"):
+                    host["processor"] = line.split(":", 1)[1].strip()
+                    break
+    except OSError:
+        pass
+    host["cpus"] = os.cpu_count()
+    try:
+        host["memoryBytes"] = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        host["memoryBytes"] = None
+    host["python"] = platform.python_version()
+    host["numpy"] = np.__version__
+    host["pillow"] = PIL.__version__
+    try:
+        host["commit"] = subprocess.run(["git", "rev-parse", "HEAD"],
+                                        cwd=Path(__file__).parent,
+                                        capture_output=True,
+                                        text=True
+                                        ).stdout.strip() or None
+    except OSError:
+        host["commit"] = None
+
+    return(host)
+
+
+def stageInputs(oIm, workDir):
+    # Inputs for the stage benchmarks, calculated once per image the same
+    # way ImageMaker.py does
+    inputs = dict()
+    colors, pn = ImageMaker.loadPalette(PALETTE)
+    inputs["colors"] = colors
+    inputs["r_colors"] = colors[::-1]
+    inputs["oIm"] = oIm
+
+    im = Image.new("RGB", (oIm.size[0] + (2 * BORDER), oIm.size[1] + (2 * BORDER)), ImageMaker.BACKGROUND)
+    im.paste(oIm, (BORDER, BORDER))
+    inputs["im"] = im
+
+    lums = np.zeros(im.size, dtype=kernels.LUM_DTYPE)
+    ImageMaker.get_luminosities(im, lums, BORDER)
+    inputs["lums"] = lums
+
+    sIm = ImageMaker.smoothImage(im, None, False, BORDER)
+    inputs["sIm"] = sIm
+
+    edges = np.zeros(sIm.size, dtype=kernels.SOBEL_DTYPE)
+    ImageMaker.createSobelEdges(sIm, edges, BORDER)
+    inputs["edges"] = edges
+    inputs["normEdges"] = ImageMaker.normalizeEdges(edges)
+
+    # NOTE: built (or read) before timing, like a second --nc run
+    inputs["ncCube"] = nearcolor.getColorCube(colors, nearcolor.EXACT_LEVELS, ImageMaker.MAX_CDIST,
+                                              cubeDir=str(workDir / "colorcubes"))
+
+    return(inputs)
+
+
+def thinStage(normEdges):
+    # Guo-Hall thinning of the normalized gradients, as cli_thinning.py
+    # does, without its displays and saves
+    gradientBools = cli_thinning.thresholdGradients(normEdges, THIN_TH)
+    gradientBools, limit = cli_thinning.guoHallThin(gradientBools)
+
+    return(cli_thinning.maskGradients(normEdges, gradientBools))
+
+
+def stageCall(stage, inputs, workDir):
+    # The call to time for a stage, and the setup to run before each call
+    # NOTE: the cached stages start from an empty cache every time, so the
+    #       time includes calculating and caching the result
+    cacheDir = workDir / "cache"
+
+    def clearCache():
+        shutil.rmtree(cacheDir, ignore_errors=True)
+
+    def noSetup():
+        pass
+
+    im = inputs["im"]
+    if stage == "lumData":
+        return((lambda: ImageMaker.lumData(im, str(workDir / "luminosity.npy"), BORDER), clearCache))
+    elif stage == "getSmoothImage":
+        return((lambda: ImageMaker.getSmoothImage(im, str(workDir / "a.png"), False, True, BORDER), clearCache))
+    elif stage == "getEdges":
+        return((lambda: ImageMaker.getEdges(inputs["sIm"], str(workDir / "sobel.npy"), BORDER), clearCache))
+    elif stage == "normalizeEdges":
+        return((lambda: ImageMaker.normalizeEdges(inputs["edges"]), noSetup))
+    elif stage == "posterize":
+        return((lambda: ImageMaker.processImages(inputs["lums"],
+                                                 [None, None],
+                                                 [inputs["colors"], inputs["r_colors"]],
+                                                 [False, False],
+                                                 BORDER
+                                                 ), noSetup))
+    elif stage == "edgeMask":
+        return((lambda: ImageMaker.applyEdgeMask([inputs["sIm"]],
+                                                 ImageMaker.edgeMask(inputs["normEdges"], EDGE_TH),
+                                                 [None]
+                                                 ), noSetup))
+    elif stage == "nc":
+        return((lambda: kernels.arrayImage(kernels.renderPalette(
+                    nearcolor.cubeIndices(kernels.imageArray(inputs["oIm"]), inputs["ncCube"]),
+                    inputs["colors"] + [ImageMaker.WHITE], "ncIndices")), noSetup))
+    elif stage == "nearest":
+        return((lambda: nearcolor.nearestColors(kernels.imageArray(inputs["oIm"]),
+                                                inputs["colors"],
+                                                "l1",
+                                                ImageMaker.MAX_CDIST
+                                                ), noSetup))
+    elif stage == "ms":
+        return((lambda: kernels.maxSaturation(kernels.imageArray(im)), noSetup))
+    elif stage == "thinning":
+        return((lambda: thinStage(inputs["normEdges"]), noSetup))
+    else:
+        raise ValueError("Unknown stage '" + str(stage) + "', use one of " + str(STAGES))
+
+
+def timeCall(call, setup, repeat):
+    # Wall times of repeat calls, with setup run (untimed) before each
+    times = list()
+    for r in range(repeat):
+        setup()
+        start = time.perf_counter()
+        call()
+        times.append(time.perf_counter() - start)
+
+    return(times)
+
+
+def peakMemory(call, setup):
+    # Peak memory allocated by one more call, above what was already in use
+    # NOTE: a separate untimed call, as tracing slows the call down
+    setup()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    call()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return(peak - base)
+
+
+def result(stage, kind, size, mode, times, peakBytes):
+    # One benchmark result
+    return({"stage": stage,
+            "kind": kind,
+            "size": size,
+            "pixels": size * size,
+            "mode": mode,
+            "times": times,
+            "best": min(times),
+            "median": statistics.median(times),
+            "peakBytes": peakBytes
+            })
+
+
+def endToEnd(imPath, kind, size, flags, repeat, workDir):
+    # Time whole ImageMaker.py runs on an image, from an empty cache and no
+    # saved color cubes each time, returning a result for the run and for
+    # each of its stages
+    runTimes = list()
+    stageTimes = dict()
+    stagePeaks = dict()
+    tracePath = workDir / "trace.json"
+    for r in range(repeat):
+        for coldDir in E2E_COLD_DIRS:
+            shutil.rmtree(workDir / coldDir, ignore_errors=True)
+        command = [sys.executable, str(Path(ImageMaker.__file__).resolve()),
+                   "--fn", imPath.name,
+                   "--cache-dir", "cache",
+                   "--trace", tracePath.name
+                   ] + flags.split()
+        start = time.perf_counter()
+        subprocess.run(command, cwd=workDir, stdout=subprocess.DEVNULL, check=True)
+        runTimes.append(time.perf_counter() - start)
+
+        with open(tracePath) as fp:
+            trace = json.load(fp)
+        for stage in trace["stages"]:
+            stageTimes.setdefault(stage["stage"], list()).append(stage["wall"])
+            stagePeaks[stage["stage"]] = max(stagePeaks.get(stage["stage"], 0), stage["peakBytes"] or 0)
+
+    # NOTE: end to end peaks are the process's peak rss at the end of each stage
+    results = [result("ImageMaker", kind, size, "e2e", runTimes, max(stagePeaks.values(), default=None))]
+    for stage in stageTimes:
+        results.append(result(stage, kind, size, "e2e", stageTimes[stage], stagePeaks[stage]))
+
+    return(results)
+
+
+def summary(results):
+    # Table of the benchmark results
+    lines = list()
+    lines.append("{:<16} {:<9} {:>6} {:<4} {:>10} {:>10} {:>10}".format(
+        "stage", "kind", "size", "mode", "best s", "median s", "peak MB"))
+    for r in results:
+        lines.append("{:<16} {:<9} {:>6} {:<4} {:>10.4f} {:>10.4f} {:>10}".format(
+            r["stage"][:16],
+            r["kind"],
+            r["size"],
+            r["mode"],
+            r["best"],
+            r["median"],
+            "" if r["peakBytes"] is None else "{:.1f}".format(r["peakBytes"] / (1024 * 1024))
+            ))
+
+    return("\n".join(lines))
+
+
+if __name__ == '__main__':
+    print("Start now:",  str(datetime.now()))
+
+    # Instantiate the command line parser
+    parser = argparse.ArgumentParser(description="cli_bench: image pipeline benchmarks")
+
+    # Optional argument for image sizes
+    parser.add_argument('--sizes',
+                        type=int,
+                        nargs="+",
+                        help="image sizes (each image is size x size)",
+                        default=list(SIZES)
+                        )
+
+    # Optional argument for synthetic image kinds
+    parser.add_argument('--kinds',
+                        nargs="+",
+                        help="synthetic image kinds",
+                        choices=KINDS,
+                        default=list(KINDS)
+                        )
+
+    # Optional argument for the stages to time in isolation
+    parser.add_argument('--stages',
+                        nargs="+",
+                        help="stages to time in isolation",
+                        choices=STAGES,
+                        default=list(STAGES)
+                        )
+
+    # Optional argument for number of timed calls of each stage
+    parser.add_argument('--repeat',
+                        type=int,
+                        help="timed calls per stage",
+                        default=3
+                        )
+
+    # Optional argument for the synthetic image seed
+    parser.add_argument('--seed',
+                        type=int,
+                        help="synthetic image seed",
+                        default=0
+                        )
+
+    # Optional argument for the largest image for the per pixel loop stages
+    parser.add_argument('--loop-max',
+                        type=int,
+                        dest="lmax",
+                        help="largest image (pixels) for per pixel loop stages",
+                        default=LOOP_MAX
+                        )
+
+    # Optional arguments for end to end ImageMaker.py runs
+    parser.add_argument('--e2e', action='store_true', help="also time whole ImageMaker.py runs")
+
+    parser.add_argument('--e2e-flags',
+                        action="store",
+                        dest="e2ef",
+                        help="ImageMaker.py flags for the end to end runs",
+                        default=E2E_FLAGS
+                        )
+
+    # Optional argument for the results filename
+    parser.add_argument('--out',
+                        action="store",
+                        dest="out",
+                        help="results filename (defaults to YYYYMMDD/YYYYMMDD_bench.json)",
+                        default=None
+                        )
+
+    # Optional argument for the scratch directory
+    parser.add_argument('--wd',
+                        action="store",
+                        dest="wd",
+                        help="scratch directory for images, caches, and outputs",
+                        default="benchwork"
+                        )
+
+    # Get the actual values of the command line arguments.
+    args = parser.parse_args()
+    print("sizes\t", args.sizes)
+    print("kinds\t", args.kinds)
+    print("stages\t", args.stages)
+    print("repeat\t", args.repeat)
+    print("seed\t", args.seed)
+    print("lmax\t", args.lmax)
+    print("e2e\t", args.e2e)
+    print("e2ef\t", args.e2ef)
+    print("out\t", args.out)
+    print("wd\t", args.wd)
+
+    # Results saved into a directory named from today's date (YYYYMMDD)
+    today = date.today()
+    saveDirStr = "./" + today.__format__("%Y%m%d")
+    outPath = Path(args.out) if args.out else Path(saveDirStr) / (today.__format__("%Y%m%d") + "_bench.json")
+    outPath.parent.mkdir(parents=True, exist_ok=True)
+
+    workDir = Path(args.wd).resolve()
+    workDir.mkdir(parents=True, exist_ok=True)
+    stagecache.configure(str(workDir / "cache"), stagecache.CACHE_MB)
+
+    bench = dict()
+    bench["host"] = hostInfo()
+    bench["started"] = datetime.now().isoformat()
+    bench["settings"] = vars(args)
+    bench["results"] = list()
+
+    for size in args.sizes:
+        for kind in args.kinds:
+            oIm = syntheticImage(kind, size, args.seed)
+            print(str(datetime.now()), "Benchmarking", kind, str(size) + "x" + str(size))
+            inputs = stageInputs(oIm, workDir)
+
+            for stage in args.stages:
+                if stage in LOOP_STAGES and size * size > args.lmax:
+                    print(str(datetime.now()), "Skipping", stage, "(per pixel loops, over --loop-max)")
+                    continue
+
+                call, setup = stageCall(stage, inputs, workDir)
+                times = timeCall(call, setup, args.repeat)
+                peakBytes = peakMemory(call, setup)
+                bench["results"].append(result(stage, kind, size, "iso", times, peakBytes))
+                print(str(datetime.now()), stage, "best {:.4f} s".format(min(times)))
+
+            if args.e2e:
+                imPath = workDir / ("bench_" + kind + "_" + str(size) + ".png")
+                oIm.save(imPath, format="PNG")
+                flags = args.e2ef
+                if size * size <= args.lmax:
+                    flags += " --xs"
+                bench["results"] += endToEnd(imPath, kind, size, flags, args.repeat, workDir)
+                print(str(datetime.now()), "ImageMaker.py run done.")
+
+            # NOTE: save as we go, so a long run that is stopped still has results
+            with open(outPath, "w") as fp:
+                json.dump(bench, fp, indent=2)
+
+    print(summary(bench["results"]))
+    print(str(datetime.now()), "Benchmark results saved:", str(outPath))
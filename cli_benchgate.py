@@ -0,0 +1,282 @@
+#! /Library/Frameworks/Python.framework/Versions/3.9/bin/python3
+#
+# cli_benchgate.py
+#
+# A program to keep the pipeline stages from getting slower, by comparing
+# cli_bench.py results against stored baseline timings and peak memory.
+#
+# --update stores (or refreshes) the baseline from a results file, each
+# result along with the host it was measured on, without it the results are
+# compared against the baseline, and the program exits with status 1 if any
+# gated stage got slower, or used more memory, by more than the tolerance.
+# Everything is read from local files, so it runs offline.
+#
+# Times are compared by the best of the timed calls, the least noisy of the
+# measures. Stages quicker than --min-time in the baseline are only reported,
+# as small differences there are mostly noise.
+#
+# Memory is only gated for the isolated stage results, which are the memory
+# allocated by the stage itself (tracemalloc). End to end results hold the
+# process's peak rss so far, which mostly reflects the stages before, so their
+# memory changes are shown but never fail the gate.
+#
+
+import argparse
+import json
+import sys
+
+from datetime import datetime
+from pathlib import Path
+
+# Stages gated by default, isolated stages from cli_bench.py and the
+# ImageMaker.py stages of its end to end runs (--nc, --ms, --xs)
+GATE_STAGES = ("lumData", "getSmoothImage", "getEdges", "nc", "ms", "xs", "thinning")
+# Default baseline filename
+BASELINE = "bench_baseline.json"
+# Default tolerances, as fractions of the baseline (0.25 is 25% more)
+TIME_TOL = 0.25
+MEM_TOL = 0.25
+# Default shortest baseline time (in seconds) that is gated
+MIN_TIME = 0.005
+# Result modes whose peak memory is gated, see above
+MEM_MODES = ("iso",)
+# Host description fields that should match for timings to be comparable
+HOST_FIELDS = ("node", "processor", "cpus", "python", "numpy", "pillow")
+
+
+def resultKey(result):
+    # Key identifying a benchmark result across runs
+    return((result["stage"], result["mode"], result["kind"], result["size"]))
+
+
+def keyName(key):
+    # Readable name of a result key
+    return(key[0] + " " + key[1] + " " + key[2] + " " + str(key[3]))
+
+
+def loadJson(path):
+    # Read a results or baseline file
+    with open(path) as fp:
+        return(json.load(fp))
+
+
+def updateBaseline(baseline, bench, stages):
+    # Store the gated stages of a benchmark run as the baseline, keeping
+    # baseline entries the run didn't measure
+    entries = dict()
+    if baseline is not None:
+        for entry in baseline["stages"]:
+            entries[resultKey(entry)] = dict(entry, host=hostSummary(entryHost(baseline, entry)))
+
+    for result in bench["results"]:
+        if result["stage"] in stages:
+            entries[resultKey(result)] = {"stage": result["stage"],
+                                          "mode": result["mode"],
+                                          "kind": result["kind"],
+                                          "size": result["size"],
+                                          "best": result["best"],
+                                          "median": result["median"],
+                                          "peakBytes": result["peakBytes"],
+                                          "commit": bench["host"].get("commit"),
+                                          "host": hostSummary(bench["host"])
+                                          }
+
+    return({"host": bench["host"],
+            "saved": datetime.now().isoformat(),
+            "stages": sorted(entries.values(), key=lambda e: (e["stage"], e["mode"], e["kind"], e["size"]))
+            })
+
+
+def hostSummary(host):
+    # The host description fields compared by hostWarnings()
+    return({field: host.get(field) for field in HOST_FIELDS})
+
+
+def entryHost(baseline, entry):
+    # Host a baseline entry was measured on
+    # NOTE: older baselines only have the host of their last update
+    return(entry.get("host", baseline["host"]))
+
+
+def hostWarnings(baseHost, host):
+    # Differences between the baseline host and the results host
+    warnings = list()
+    for field in HOST_FIELDS:
+        if baseHost.get(field) != host.get(field):
+            warnings.append(field + ": baseline " + str(baseHost.get(field)) + ", results " + str(host.get(field)))
+
+    return(warnings)
+
+
+def change(base, current):
+    # Fractional change from base to current, or None if either is unknown
+    if (base is None) or (current is None) or (base <= 0):
+        return(None)
+
+    return((current - base) / base)
+
+
+def percent(fraction):
+    # Fractional change as a signed percentage, blank if unknown
+    if fraction is None:
+        return("")
+
+    return("{:+.1f}%".format(fraction * 100))
+
+
+def compare(baseline, bench, stages, timeTol, memTol, minTime):
+    # Compare a benchmark run to the baseline, one row per gated result
+    # Returns the rows, and the names of the results that regressed
+    entries = {resultKey(entry): entry for entry in baseline["stages"]}
+    rows = list()
+    regressions = list()
+    seen = set()
+    for result in bench["results"]:
+        key = resultKey(result)
+        if result["stage"] not in stages:
+            continue
+        seen.add(key)
+
+        base = entries.get(key)
+        if base is None:
+            rows.append((keyName(key), "", "{:.4f}".format(result["best"]), "", "", "new"))
+            continue
+
+        timeChange = change(base["best"], result["best"])
+        memChange = change(base["peakBytes"], result["peakBytes"])
+        status = list()
+        if (timeChange is not None) and (timeChange > timeTol):
+            if base["best"] >= minTime:
+                status.append("SLOWER")
+            else:
+                status.append("slower (under --min-time)")
+        if (memChange is not None) and (memChange > memTol):
+            if result["mode"] in MEM_MODES:
+                status.append("MORE MEMORY")
+            else:
+                status.append("more memory (not gated)")
+        if ("SLOWER" in status) or ("MORE MEMORY" in status):
+            regressions.append(keyName(key))
+
+        rows.append((keyName(key),
+                     "{:.4f}".format(base["best"]),
+                     "{:.4f}".format(result["best"]),
+                     percent(timeChange),
+                     percent(memChange),
+                     ", ".join(status) if status else "ok"
+                     ))
+
+    for key in entries:
+        if (key[0] in stages) and (key not in seen):
+            rows.append((keyName(key), "{:.4f}".format(entries[key]["best"]), "", "", "", "not run"))
+
+    return((rows, regressions))
+
+
+def report(rows):
+    # Table of the comparison rows
+    lines = list()
+    lines.append("{:<36} {:>10} {:>10} {:>9} {:>9}  {}".format(
+        "stage mode kind size", "base s", "now s", "time", "memory", "status"))
+    for row in rows:
+        lines.append("{:<36} {:>10} {:>10} {:>9} {:>9}  {}".format(row[0], row[1], row[2], row[3], row[4], row[5]))
+
+    return("\n".join(lines))
+
+
+if __name__ == '__main__':
+    print("Start now:",  str(datetime.now()))
+
+    # Instantiate the command line parser
+    parser = argparse.ArgumentParser(description="cli_benchgate: benchmark regression gate")
+
+    # Required argument for the benchmark results
+    parser.add_argument('results',
+                        help="cli_bench.py results file"
+                        )
+
+    # Optional argument for the baseline filename
+    parser.add_argument('--baseline',
+                        action="store",
+                        dest="baseline",
+                        help="baseline filename",
+                        default=BASELINE
+                        )
+
+    # Optional argument to store the results as the baseline, instead of checking them
+    parser.add_argument('--update', action='store_true', help="store the results as the baseline")
+
+    # Optional argument for the gated stages
+    parser.add_argument('--stages',
+                        nargs="+",
+                        help="stages to gate",
+                        default=list(GATE_STAGES)
+                        )
+
+    # Optional arguments for the tolerances
+    parser.add_argument('--tol',
+                        type=float,
+                        help="allowed slowdown, as a fraction of the baseline time",
+                        default=TIME_TOL
+                        )
+
+    parser.add_argument('--mem-tol',
+                        type=float,
+                        dest="mtol",
+                        help="allowed peak memory growth of isolated stages, as a fraction of the baseline",
+                        default=MEM_TOL
+                        )
+
+    parser.add_argument('--min-time',
+                        type=float,
+                        dest="mint",
+                        help="shortest baseline time (seconds) that is gated",
+                        default=MIN_TIME
+                        )
+
+    # Get the actual values of the command line arguments.
+    args = parser.parse_args()
+    print("results\t", args.results)
+    print("baseline\t", args.baseline)
+    print("update\t", args.update)
+    print("stages\t", args.stages)
+    print("tol\t", args.tol)
+    print("mtol\t", args.mtol)
+    print("mint\t", args.mint)
+
+    bench = loadJson(args.results)
+    baselinePath = Path(args.baseline)
+    baseline = loadJson(baselinePath) if baselinePath.exists() else None
+
+    if args.update:
+        baseline = updateBaseline(baseline, bench, args.stages)
+        with open(baselinePath, "w") as fp:
+            json.dump(baseline, fp, indent=2)
+        print(str(datetime.now()), "Baseline saved:", str(baselinePath), len(baseline["stages"]), "results")
+        sys.exit(0)
+
+    if baseline is None:
+        print(str(datetime.now()), "No baseline file", str(baselinePath) + ", create one with --update.")
+        sys.exit(2)
+
+    # NOTE: a partial --update leaves entries from other hosts in the baseline
+    warnings = list()
+    for entry in baseline["stages"]:
+        if entry["stage"] in args.stages:
+            for warning in hostWarnings(entryHost(baseline, entry), bench["host"]):
+                if warning not in warnings:
+                    warnings.append(warning)
+    for warning in warnings:
+        print(str(datetime.now()), "WARNING: different host,", warning)
+
+    rows, regressions = compare(baseline, bench, args.stages, args.tol, args.mtol, args.mint)
+    print(report(rows))
+
+    if regressions:
+        print(str(datetime.now()), "FAILED:", len(regressions), "regressed beyond",
+              percent(args.tol), "time or", percent(args.mtol), "memory:")
+        for name in regressions:
+            print("\t" + name)
+        sys.exit(1)
+
+    print(str(datetime.now()), "PASSED:", len(rows), "results within tolerance.")
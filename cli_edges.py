@@ -3,6 +3,7 @@
 import argparse
 import json
 
+import numpy as np
 import matplotlib.pyplot as plt
 
 from matplotlib.colors import LinearSegmentedColormap
@@ -10,42 +11,11 @@ from datetime import datetime
 from datetime import date
 from pathlib import Path
 from PIL import Image
-from os.path import exists
 from random import randint
 
-# Scratch table to keep track of closest color matches
-lookup = dict()
-
-
-def get_distance(pixel, color):
-    # calculate three dimensional distance between colors
-    r = pixel[0] - color[0]
-    g = pixel[1] - color[1]
-    b = pixel[2] - color[2]
-    dist = (r**2 + g**2 + b**2)**0.5
-
-    return(dist)
-
-
-def get_closest(pixel, palette):    
-
-    if pixel in lookup:
-    # Have already mapped this pixel.
-        closest = lookup[pixel]
-    else:
-        # pick the closest color in the palette to the existing color
-        distance = 442      # 442 is maxiumum possible distance between colors 
-        closest = (0, 0, 0)
-
-        for color in palette:
-            dist = get_distance(pixel, color)
-            if dist < distance:
-                    distance = dist
-                    closest = color
-                    
-        lookup[pixel] = closest
-
-    return(closest)
+import kernels
+import stagecache
+import stagetrace
 
 
 def createCDict(colors):
@@ -102,10 +72,9 @@ def palette(cm):
 
 def get_brightness(pixel):
     # Calculate luminosity of an (r, g, b) pixel
+    # NOTE: integer math, same result as int(0.3r + 0.59g + 0.11b)
 
-    gs = int((0.3 * pixel[0]) + (0.59 * pixel[1]) + (0.11 * pixel[2]))
-
-    return(gs)
+    return(kernels.pixelLum(pixel))
 
 
 def invert(pixel):
@@ -315,6 +284,56 @@ parser.add_argument('--q', action='store_true', help="quiet mode (no displays)")
 # Optional argument to create watermarked files, as well
 parser.add_argument('--wm', action='store_true', help="create watermarked files")
 
+# Optional arguments for the intermediate results cache
+# NOTE: least recently used results are removed to keep under the size limit
+parser.add_argument('--cache-dir',
+                    action="store",
+                    dest="cd",
+                    help="intermediate results cache directory",
+                    default=stagecache.CACHE_DIR
+                    )
+
+parser.add_argument('--cache-mb',
+                    type=float,
+                    dest="cmb",
+                    help="intermediate results cache size limit, in megabytes",
+                    default=stagecache.CACHE_MB
+                    )
+
+# Optional arguments for the stage timing trace
+# NOTE: a summary table is always printed at the end of the run,
+#       the trace file is CSV if its name ends in .csv, JSON otherwise
+parser.add_argument('--trace',
+                    action="store",
+                    dest="trace",
+                    help="stage timing trace filename (.json or .csv)",
+                    default=None
+                    )
+
+parser.add_argument('--trace-mem',
+                    action="store",
+                    dest="tm",
+                    help="stage peak memory measure (rss, or tracemalloc which is slower)",
+                    choices=stagetrace.MEMORY_MODES,
+                    default="rss"
+                    )
+
+# Optional arguments to profile each stage, one cProfile file per stage in
+# the directory (for pstats or snakeviz), plus sampled collapsed stacks
+# (for flame graphs) if asked
+parser.add_argument('--profile',
+                    action="store",
+                    dest="prof",
+                    help="stage profile directory",
+                    default=None
+                    )
+
+parser.add_argument('--profile-collapsed',
+                    action='store_true',
+                    dest="profc",
+                    help="also save sampled collapsed stacks for each stage (needs --profile)"
+                    )
+
 args = parser.parse_args()
 print("fn\t", args.fn)
 print("pn\t", args.pn)
@@ -333,6 +352,16 @@ print("sv\t", args.sv)
 print("se\t", args.se)
 print("hi\t", args.hi)
 print("q\t", args.q)
+print("cd\t", args.cd)
+print("cmb\t", args.cmb)
+print("trace\t", args.trace)
+print("tm\t", args.tm)
+print("prof\t", args.prof)
+print("profc\t", args.profc)
+
+stagecache.configure(args.cd, args.cmb)
+stagetrace.configure(args.trace, args.tm, "cli_edges.py", vars(args))
+stagetrace.configureProfile(args.prof, args.profc)
 
 # Allows enabled displays if not in quiet mode
 loud = not args.q
@@ -405,6 +434,12 @@ savePalBase = saveBase + args.pn + "_"
 im = Image.open(args.fn)
 pixels = im.load()
 
+# Intermediate images are cached by the contents of the original image
+# NOTE: cached losslessly, the .jpg files are only saved as outputs
+imHash = stagecache.dataHash(im)
+# NOTE: the stages aren't functions, so the whole of this file is their code
+edgesCode = (__file__,)
+
 if (args.do or args.da) and loud:
     im.show()
     print("Original version, for comparisons.",  str(datetime.now()))
@@ -415,6 +450,7 @@ if args.wm:
     wmIm = Image.open("watermark.png")
     loc = ((im.size[0] - wmIm.size[0]), (im.size[1] - wmIm.size[1]))
 
+stagetrace.begin("posterize")
 # posterized images
 # create a canvas to posterize into
 pIm = Image.new('RGB', im.size, background)
@@ -438,17 +474,14 @@ if args.sv:
     pIm.save(savePalBase + "p.jpg", format="JPEG", quality=95)
     iIm.save(savePalBase + "pi.jpg", format="JPEG", quality=95)
 
-print("Posterized versions done.",  str(datetime.now()))
+stagetrace.end("posterize", "Posterized versions done.")
 
+stagetrace.begin("gs")
 # plain grayscale image
-gIm = None
-genGS = True
-if exists(saveBase + "gs.jpg"):
-    # already generated a grayscale image and saved it, use it
-    gIm = Image.open(saveBase + "gs.jpg")
-    genGS = False
-    print("Opened saved file:", saveBase + "gs.jpg")
-else:
+gsKey = stagecache.stageKey("edges_gs", imHash, {}, edgesCode)
+gIm = stagecache.loadImage("edges_gs", gsKey)
+genGS = gIm is None
+if genGS:
     # creat a canvas for grayscale version
     gIm = Image.new('RGB', im.size, background)
 
@@ -459,67 +492,51 @@ if genGS:
         for y in range(0, im.size[1]):
             bright = get_brightness(im.getpixel((x, y)))
             gPixels[x, y] = grays[bright]
+    stagecache.saveImage("edges_gs", gsKey, gIm)
 
 if (args.dgs or args.da) and loud:
     gIm.show()
 
-if args.sv and genGS:
+if args.sv:
     gIm.save(saveBase + "gs.jpg", format="JPEG", quality=95)
 
-print("Grayscale version done.")
-
-# average values
-avgIm = None
-genAvg = True
-if exists(saveBase + "a.jpg"):
-    # exists, use it
-    avgIm = Image.open(saveBase + "a.jpg")
-    genAvg = False
-    print("Opened saved file:", saveBase + "a.jpg")
-else:
-    # create a canvas for the smoothed [averaged] version
-    avgIm = Image.new('RGB', im.size, background)
-
-aPixels = avgIm.load()
-
-gAvgIm = None
-genGAvg = True
-if exists(saveBase + "ags.jpg"):
-    gAvgIm = Image.open(saveBase + "ags.jpg")
-    genGAvg = False
-    print("Opened saved file:", saveBase + "ags.jpg")
-
-else:
-    # create a canvas for the averaged grayscale version
-    gAvgIm = Image.new('RGB', im.size, background)
-
-gaPixels = gAvgIm.load()
+stagetrace.end("gs", "Grayscale version done.")
 
 # NOTE: margin/other_margin are used to allow average generation w/o bounds checking
 #       which speeds the whole process up considerably
 margin = int(args.bs / 2)
 other_margin = args.bs - margin
 
+stagetrace.begin("a")
+# average values
+aKey = stagecache.stageKey("edges_a", imHash, {"bs": args.bs}, edgesCode)
+avgIm = stagecache.loadImage("edges_a", aKey)
+genAvg = avgIm is None
 if genAvg:
-    for x in range(margin, im.size[0] - other_margin):
-        for y in range(margin, im.size[1] - other_margin):
-            aPixels[x, y] = getAverage(im, x, y, args.bs)
+    # create the smoothed [averaged] version, summed-area table keeps
+    # the cost per pixel the same for any box size
+    avgRgb = kernels.boxAverage(kernels.imageArray(im), args.bs)
+    # NOTE: keep the last row and column inside the margins black, as before
+    avgRgb[im.size[0] - other_margin:] = (0, 0, 0)
+    avgRgb[:, im.size[1] - other_margin:] = (0, 0, 0)
+    avgIm = kernels.arrayImage(avgRgb)
+    stagecache.saveImage("edges_a", aKey, avgIm)
+
+aPixels = avgIm.load()
 
 if (args.ds or args.da) and loud:
     avgIm.show()
 
-if args.sv and genAvg:
+if args.sv:
     avgIm.save(saveBase + "a.jpg", format="JPEG", quality=95)
 
-print("Averaged version done.",  str(datetime.now()))
+stagetrace.end("a", "Averaged version done.")
 
-gAvgIm = None
-genGAvg = True
-if exists(saveBase + "ags.jpg"):
-    gAvgIm = Image.open(saveBase + "ags.jpg")
-    genGAvg = False
-    print("Opened saved file:", saveBase + "ags.jpg")
-else:
+stagetrace.begin("ags")
+agsKey = stagecache.stageKey("edges_ags", imHash, {"bs": args.bs}, edgesCode)
+gAvgIm = stagecache.loadImage("edges_ags", agsKey)
+genGAvg = gAvgIm is None
+if genGAvg:
     # create a canvas for the averaged grayscale version
     gAvgIm = Image.new('RGB', im.size, background)
 
@@ -529,23 +546,22 @@ if genGAvg:
     for x in range(margin, im.size[0] - other_margin):
         for y in range(margin, im.size[1] - other_margin):
             gaPixels[x, y] = grays[get_brightness(aPixels[x, y])]
-        
+    stagecache.saveImage("edges_ags", agsKey, gAvgIm)
+
 if (args.dsgs or args.da) and loud:
     gAvgIm.show()
 
-if args.sv and genGAvg:
+if args.sv:
     gAvgIm.save(saveBase + "ags.jpg", format="JPEG", quality=95)
 
-print("Grayscale averaged version done.")
+stagetrace.end("ags", "Grayscale averaged version done.")
 
+stagetrace.begin("av")
 # differences images/scratch canvases
-vDiffIm = None
-genVDiff = True
-if exists(saveBase + "av.jpg"):
-    vDiffIm = Image.open(saveBase + "av.jpg")
-    genVDiff = False
-    print("Opened saved file:", saveBase + "av.jpg")
-else:
+avKey = stagecache.stageKey("edges_av", imHash, {"bs": args.bs}, edgesCode)
+vDiffIm = stagecache.loadImage("edges_av", avKey)
+genVDiff = vDiffIm is None
+if genVDiff:
     vDiffIm = Image.new('RGB', im.size, background)
 
 vPixels = vDiffIm.load()
@@ -555,6 +571,7 @@ if genVDiff:
     for x in range(1, im.size[0] - 1):
         for y in range(1, im.size[1] - 1):
             vPixels[x, y] = getVDiff(gAvgIm, x, y)
+    stagecache.saveImage("edges_av", avKey, vDiffIm)
 
 max_vDiff = 0
 for x in range(1, im.size[0] - 1):
@@ -565,27 +582,27 @@ for x in range(1, im.size[0] - 1):
 if (args.dv or args.da) and loud:
     vDiffIm.show()
 
-if args.sv and genVDiff:
+if args.sv:
     vDiffIm.save(saveBase + "av.jpg", format="JPEG", quality=95)
 
 print("Vertical edges version done.", max_vDiff,  str(datetime.now()))
+stagetrace.end("av")
 
-hDiffIm = None
-genHDiff = True
-
-if exists(saveBase + "ah.jpg"):
-    hDiffIm = Image.open(saveBase + "ah.jpg")
-    genHDiff = False
-    print("Opened saved file:", saveBase + "ah.jpg")
-else:
+stagetrace.begin("ah")
+ahKey = stagecache.stageKey("edges_ah", imHash, {"bs": args.bs}, edgesCode)
+hDiffIm = stagecache.loadImage("edges_ah", ahKey)
+genHDiff = hDiffIm is None
+if genHDiff:
     hDiffIm = Image.new('RGB', im.size, background)
 
 hPixels = hDiffIm.load()
 
 # Get horizontal intensity differences
-for x in range(1, im.size[0] - 1):
-    for y in range(1, im.size[1] - 1):
-        hPixels[x, y] = getHDiff(gAvgIm, x, y)
+if genHDiff:
+    for x in range(1, im.size[0] - 1):
+        for y in range(1, im.size[1] - 1):
+            hPixels[x, y] = getHDiff(gAvgIm, x, y)
+    stagecache.saveImage("edges_ah", ahKey, hDiffIm)
 
 max_hDiff = 0
 for x in range(1, im.size[0] - 1):
@@ -596,21 +613,20 @@ for x in range(1, im.size[0] - 1):
 if (args.dh or args.da) and loud:
     hDiffIm.show()
 
-if args.sv and genHDiff:
+if args.sv:
     hDiffIm.save(saveBase + "ah.jpg", format="JPEG", quality=95)
 
 print("Horizontal edges version done.", max_hDiff,  str(datetime.now()))
+stagetrace.end("ah")
 
 #
 # Generate a heat map of the maxium pixel differences.
 #
-mDiffIm = None
-genMDiff = True
-if exists(saveBase + "amd.jpg"):
-    mDiffIm = Image.open(saveBase + "amd.jpg")
-    genMDiff = False
-    print("Opened saved file:", saveBase + "amd.jpg")
-else:
+stagetrace.begin("amd")
+amdKey = stagecache.stageKey("edges_amd", imHash, {"bs": args.bs}, edgesCode)
+mDiffIm = stagecache.loadImage("edges_amd", amdKey)
+genMDiff = mDiffIm is None
+if genMDiff:
     mDiffIm = Image.new('RGB', im.size, background)
 
 mdPixels = mDiffIm.load()
@@ -620,18 +636,19 @@ if genMDiff:
     for x in range(1, im.size[0] - 1):
         for y in range(1, im.size[1] - 1):
             mdPixels[x, y] = getMaxDiff(gAvgIm, x, y)
+    stagecache.saveImage("edges_amd", amdKey, mDiffIm)
 
 if loud:
     mDiffIm.show()
 
-if genMDiff:
-    mDiffIm.save(saveBase + "amd.jpg", format="JPEG", quality=95)
+mDiffIm.save(saveBase + "amd.jpg", format="JPEG", quality=95)
 
 saveMD = mDiffIm.copy()
 
-print("MaxDiff version done.", str(datetime.now()))
+stagetrace.end("amd", "MaxDiff version done.")
 #print(sorted(pixel_dict.items(), reverse=True))
 
+stagetrace.begin("reversed")
 # list to allow histogram generation of differences
 mdHisto = []
 max_mDiff = 0
@@ -668,8 +685,9 @@ if (args.dc or args.da) and loud:
 if args.sv:
     cIm.save(savePalBase + "r.jpg", format="JPEG", quality=95)
 
-print("Reversed version done.")
+stagetrace.end("reversed", "Reversed version done.")
 
+stagetrace.begin("heatmap")
 # create palette for heat map version
 hm_colors = []
 
@@ -695,7 +713,9 @@ if loud:
 mDiffIm.save(savePalBase + "ahm.jpg", format="JPEG", quality=95)
 
 print("MaxDiff heatmap version done.", max_mDiff,  str(datetime.now()))
+stagetrace.end("heatmap")
 
+stagetrace.begin("heatmapEdged")
 # Apply calculated edges to heat map
 for x in range(im.size[0]):
     for y in range(im.size[1]):
@@ -707,8 +727,9 @@ if loud:
 
 mDiffIm.save(saveBase + "ahme.jpg", format="JPEG", quality=95)
 
-print("MaxDiff edged heatmap version done.", str(datetime.now()))
+stagetrace.end("heatmapEdged", "MaxDiff edged heatmap version done.")
 
+stagetrace.begin("edged")
 # match a palette to the maximum edge differences
 pal_len = max(max_vDiff, max_hDiff) + 1
 cmax = pal_len - 1
@@ -782,7 +803,7 @@ if loud:
     avgIm.show()
 
 avgIm.save(saveBase + "se.jpg", format="JPEG", quality=95)
-print("Averaged and edged version done.")
+stagetrace.end("edged", "Averaged and edged version done.")
 
 if args.hi:
     # Use matplotlib to plot the same data as a histogram.
@@ -794,27 +815,22 @@ if args.hi:
     print("Histogram plot generated. Close histogram window to end program.")
 
 # Sobel Filter
-gShmIm = None
-genSobel = True
-
-if exists(saveBase + "esobel.jpg"):
-    # already generated a grayscale image and saved it, use it
-    gShmIm = Image.open(saveBase + "esobel.jpg")
-    genSobel = False
-    print("Opened saved file:", saveBase + "esobel.jpg")
-else:
-    # creat a canvas for Sobel gradient calculations
-    sobelIm = Image.new('RGB', im.size, background)
+stagetrace.begin("sobel")
+# NOTE: depends on the threshold, as well as the box size
+esobelKey = stagecache.stageKey("edges_esobel", imHash, {"bs": args.bs, "th": args.th}, edgesCode)
+gShmIm = stagecache.loadImage("edges_esobel", esobelKey)
+genSobel = gShmIm is None
+if genSobel:
+    # Calculate Sobel gradients for the whole averaged grayscale image at once
+    sobelGrads = kernels.sobelGradients(kernels.imageArray(gAvgIm)[..., 0])
+    maxR = int(sobelGrads.max())
+
+    # creat a canvas holding the Sobel gradients
+    # NOTE: gradients above 255 clip to 255, same as setting the pixels did
+    sobelGrays = sobelGrads.clip(0, 255).astype(np.uint8)
+    sobelIm = kernels.arrayImage(np.stack((sobelGrays, sobelGrays, sobelGrays), axis=-1))
     sobelPixels = sobelIm.load()
 
-    maxR = 0
-    for x in range(1, gAvgIm.size[0] - 1):
-        for y in range(1, gAvgIm.size[1] - 1):
-            sobelPixels[x, y] = pixel = sobel(gAvgIm, x, y)
-            c0 = pixel[0]
-            if c0 > maxR:
-                maxR = c0
-
     print('maxR =', maxR)
 
     gShmColors = list()
@@ -839,13 +855,15 @@ if genSobel:
         for y in range(gAvgIm.size[1]):
             sPix = sobelPixels[x, y][0]
             gShmPixels[x, y] = gShmColors[sPix]
+    stagecache.saveImage("edges_esobel", esobelKey, gShmIm)
 
 if loud:
     gShmIm.show()
 
-if genSobel:
-    gShmIm.save(saveBase + "esobel.jpg", format="JPEG", quality=95)
+gShmIm.save(saveBase + "esobel.jpg", format="JPEG", quality=95)
+stagetrace.end("sobel", "Sobel edges version done.")
 
+stagetrace.begin("sobelEdged")
 # Now do averaged, posterized, and antiposterized versions using sobel edges
 sAvgIm = Image.new('RGB', im.size, background)
 sAvgPixels = sAvgIm.load()
@@ -877,9 +895,10 @@ print("Averaged and sobel edged version done.")
 sPostIm.save(savePalBase + "psobel.jpg", format="JPEG", quality=95)
 print("Posterized and sobel edged version done.")
 sAntiIm.save(savePalBase + "pisobel.jpg", format="JPEG", quality=95)
-print("Inverted posterized and sobel edged version done.")
+stagetrace.end("sobelEdged", "Inverted posterized and sobel edged version done.")
 
 if args.wm:
+    stagetrace.begin("wm")
     sAvgIm.paste(wmIm, loc, wmIm)
     sPostIm.paste(wmIm, loc, wmIm)
     sAntiIm.paste(wmIm, loc, wmIm)
@@ -894,4 +913,6 @@ if args.wm:
     sPostIm.save(savePalBase + "psobel_wm.jpg", format="JPEG", quality=95)
     print("Watermarked posterized and sobel edged version done.")
     sAntiIm.save(savePalBase + "pisobel_wm.jpg", format="JPEG", quality=95)
-    print("Watermarked inverted posterized and sobel edged version done.")
+    stagetrace.end("wm", "Watermarked inverted posterized and sobel edged version done.")
+
+stagetrace.finish()
@@ -0,0 +1,302 @@
+#! /Library/Frameworks/Python.framework/Versions/3.9/bin/python3
+#
+# cli_golden.py
+#
+# A program to check the whole array image operations against the original
+# per pixel versions kept in reference.py, on the same inputs.
+#
+# Runs each case both ways on deterministic synthetic images (and any images
+# given with --fn), and reports how many elements differ, and by how much.
+# Every case is expected to match exactly, --tol allows a largest absolute
+# difference instead. Exits with status 1 if any case doesn't match.
+#
+# NOTE: the reference versions are slow, keep the images small
+#
+
+import argparse
+import sys
+
+import numpy as np
+
+from datetime import datetime
+from PIL import Image
+
+import cli_bench
+import cli_thinning
+import ImageMaker
+import kernels
+import nearcolor
+import reference
+
+# Default image sizes, each synthetic image is size x (3/4 size) pixels, so
+# a mix up of the x and y axes can't go unnoticed
+SIZES = (64, 128)
+# Cases checked by default
+CASES = ("lums", "lumsFloat", "smooth", "sobel", "nc", "ncL2", "xs",
+         "threshold", "thinPass0", "thinPass1", "thinning", "mask")
+# Cases that are only checked when asked for, as they are approximate by design
+EXTRA_CASES = ("ncq",)
+# Border around the working canvas, as in ImageMaker.py
+BORDER = 1
+# Thinning threshold, the cli_thinning.py default
+THIN_TH = 8
+# Palette used by the cases
+PALETTE = "jet"
+
+
+def syntheticImage(kind, size, seed=0):
+    # A cli_bench.py synthetic image, cut down to size x (3/4 size)
+    oIm = cli_bench.syntheticImage(kind, size, seed)
+
+    return(oIm.crop((0, 0, size, (size * 3) // 4)))
+
+
+def caseInputs(oIm):
+    # Inputs shared by the cases, calculated once per image the same way
+    # ImageMaker.py and cli_thinning.py do
+    inputs = dict()
+    colors, pn = ImageMaker.loadPalette(PALETTE)
+    inputs["colors"] = colors
+    inputs["oIm"] = oIm.convert("RGB")
+
+    im = Image.new("RGB", (oIm.size[0] + (2 * BORDER), oIm.size[1] + (2 * BORDER)), ImageMaker.BACKGROUND)
+    im.paste(inputs["oIm"], (BORDER, BORDER))
+    inputs["im"] = im
+
+    sIm = ImageMaker.smoothImage(im, None, False, BORDER)
+    inputs["sIm"] = sIm
+
+    edges = np.zeros(sIm.size, dtype=kernels.SOBEL_DTYPE)
+    ImageMaker.createSobelEdges(sIm, edges, BORDER)
+    inputs["norm"] = ImageMaker.normalizeEdges(edges)
+    inputs["bools"] = reference.thresholdGradients(inputs["norm"], THIN_TH)
+    inputs["thinned"], limit = withBackend("reference", lambda: cli_thinning.guoHallThin(inputs["bools"]))
+
+    return(inputs)
+
+
+def withBackend(backend, call):
+    # Make a call with the given backend selected
+    previous = reference.settings["backend"]
+    reference.configure(backend)
+    try:
+        return(call())
+    finally:
+        reference.configure(previous)
+
+
+def lumsArray(im, mode=None):
+    # Luminosities of the working canvas, fast (with mode) or reference (mode None)
+    lums = np.zeros(im.size, dtype=kernels.LUM_DTYPE)
+    if mode is None:
+        reference.luminosities(im, lums, BORDER)
+    else:
+        ImageMaker.get_luminosities(im, lums, BORDER, mode)
+
+    return(lums)
+
+
+def sobelArray(sIm, fast):
+    # Sobel gradients of the smoothed image, fast or reference
+    edges = np.zeros(sIm.size, dtype=kernels.SOBEL_DTYPE)
+    if fast:
+        ImageMaker.createSobelEdges(sIm, edges, BORDER)
+    else:
+        reference.sobelEdges(sIm, edges, BORDER)
+
+    return(edges)
+
+
+def cropBorder(im):
+    # Crop the border from around a working canvas sized image
+    return(im.crop((BORDER, BORDER, im.size[0] - BORDER, im.size[1] - BORDER)))
+
+
+def nearestCube(oIm, colors, levels):
+    # Nearest colors image from the color cube, as ImageMaker.py --nc does
+    ncCube = nearcolor.getColorCube(colors, levels, ImageMaker.MAX_CDIST)
+    ncIndices = nearcolor.cubeIndices(kernels.imageArray(oIm), ncCube)
+
+    return(kernels.arrayImage(kernels.renderPalette(ncIndices, colors + [ImageMaker.WHITE], "ncIndices")))
+
+
+def nearestL2(oIm, colors):
+    # Euclidean nearest colors image, as cli_sobel.py --nc does
+    ncIndices = nearcolor.nearestColors(kernels.imageArray(oIm), colors, "l2", reference.MAX_L2_CDIST)
+
+    return(kernels.arrayImage(kernels.renderPalette(ncIndices, colors + [ImageMaker.WHITE], "ncIndices")))
+
+
+def caseCalls(case, inputs):
+    # The fast and reference calls for a case
+    im = inputs["im"]
+    oIm = inputs["oIm"]
+    colors = inputs["colors"]
+    if case == "lums":
+        return((lambda: lumsArray(im, "int"), lambda: lumsArray(im)))
+    elif case == "lumsFloat":
+        return((lambda: lumsArray(im, "float"), lambda: lumsArray(im)))
+    elif case == "smooth":
+        return((lambda: ImageMaker.smoothImage(im, None, False, BORDER),
+                lambda: cropBorder(reference.smoothImage(im, BORDER))))
+    elif case == "sobel":
+        return((lambda: sobelArray(inputs["sIm"], True), lambda: sobelArray(inputs["sIm"], False)))
+    elif case == "nc":
+        return((lambda: nearestCube(oIm, colors, nearcolor.EXACT_LEVELS),
+                lambda: reference.nearestImage(oIm, colors, "l1")))
+    elif case == "ncq":
+        return((lambda: nearestCube(oIm, colors, nearcolor.QUANTIZED_LEVELS),
+                lambda: reference.nearestImage(oIm, colors, "l1")))
+    elif case == "ncL2":
+        return((lambda: nearestL2(oIm, colors), lambda: reference.nearestImage(oIm, colors, "l2")))
+    elif case == "xs":
+        return((lambda: ImageMaker.crossStitch(oIm, colors), lambda: reference.crossStitch(oIm, colors)))
+    elif case == "threshold":
+        return((lambda: cli_thinning.thresholdGradients(inputs["norm"], THIN_TH),
+                lambda: reference.thresholdGradients(inputs["norm"], THIN_TH)))
+    elif case == "thinPass0":
+        return((lambda: cli_thinning.thinningGuoHallIteration(inputs["bools"], 0),
+                lambda: reference.thinningIteration(inputs["bools"], 0)))
+    elif case == "thinPass1":
+        return((lambda: cli_thinning.thinningGuoHallIteration(inputs["bools"], 1),
+                lambda: reference.thinningIteration(inputs["bools"], 1)))
+    elif case == "thinning":
+        # NOTE: the reference result is calculated once, in caseInputs()
+        return((lambda: withBackend("fast", lambda: cli_thinning.guoHallThin(inputs["bools"]))[0],
+                lambda: inputs["thinned"]))
+    elif case == "mask":
+        return((lambda: cli_thinning.maskGradients(inputs["norm"], inputs["thinned"]),
+                lambda: reference.maskGradients(inputs["norm"], inputs["thinned"])))
+    else:
+        raise ValueError("Unknown case '" + str(case) + "', use one of " + str(CASES + EXTRA_CASES))
+
+
+def asArray(data):
+    # Results as arrays to compare, images as [x, y, (r, g, b)]
+    if isinstance(data, Image.Image):
+        return(kernels.imageArray(data))
+
+    return(np.asarray(data))
+
+
+def compare(fast, ref, tol):
+    # Compare a fast result to its reference
+    # Returns the number of elements, how many differ by more than tol,
+    # the largest difference (None if the shapes differ), and the status
+    fast = asArray(fast)
+    ref = asArray(ref)
+    if fast.shape != ref.shape:
+        return((ref.size, ref.size, None, "SHAPE " + str(fast.shape) + " != " + str(ref.shape)))
+
+    diff = np.abs(fast.astype(np.int64) - ref.astype(np.int64))
+    maxDiff = int(diff.max()) if diff.size else 0
+    differing = int(np.count_nonzero(diff > tol))
+    if maxDiff == 0:
+        status = "exact"
+    elif differing == 0:
+        status = "within tol"
+    else:
+        status = "DIFF"
+
+    return((ref.size, differing, maxDiff, status))
+
+
+def report(rows):
+    # Table of the case results
+    lines = list()
+    lines.append("{:<12} {:<24} {:>10} {:>10} {:>8}  {}".format(
+        "case", "input", "elements", "differing", "max diff", "status"))
+    for row in rows:
+        lines.append("{:<12} {:<24} {:>10} {:>10} {:>8}  {}".format(
+            row[0], row[1][:24], row[2], row[3], "" if row[4] is None else row[4], row[5]))
+
+    return("\n".join(lines))
+
+
+if __name__ == '__main__':
+    print("Start now:",  str(datetime.now()))
+
+    # Instantiate the command line parser
+    parser = argparse.ArgumentParser(description="cli_golden: fast versus reference image operations")
+
+    # Optional argument for the synthetic image sizes
+    parser.add_argument('--sizes',
+                        type=int,
+                        nargs="+",
+                        help="synthetic image sizes (size x 3/4 size pixels)",
+                        default=list(SIZES)
+                        )
+
+    # Optional argument for the synthetic image kinds
+    parser.add_argument('--kinds',
+                        nargs="+",
+                        help="synthetic image kinds",
+                        choices=cli_bench.KINDS,
+                        default=list(cli_bench.KINDS)
+                        )
+
+    # Optional argument for the synthetic image seed
+    parser.add_argument('--seed',
+                        type=int,
+                        help="synthetic image random seed",
+                        default=0
+                        )
+
+    # Optional argument for more input images (as well as the synthetic ones)
+    parser.add_argument('--fn',
+                        nargs="+",
+                        help="input image filenames",
+                        default=list()
+                        )
+
+    # Optional argument for the cases to check
+    parser.add_argument('--cases',
+                        nargs="+",
+                        help="cases to check",
+                        choices=CASES + EXTRA_CASES,
+                        default=list(CASES)
+                        )
+
+    # Optional argument for the largest allowed difference (defaults to exact)
+    parser.add_argument('--tol',
+                        type=float,
+                        help="largest allowed absolute difference per element",
+                        default=0
+                        )
+
+    # Get the actual values of the command line arguments.
+    args = parser.parse_args()
+    print("sizes\t", args.sizes)
+    print("kinds\t", args.kinds)
+    print("seed\t", args.seed)
+    print("fn\t", args.fn)
+    print("cases\t", args.cases)
+    print("tol\t", args.tol)
+
+    images = list()
+    for size in args.sizes:
+        for kind in args.kinds:
+            images.append((kind + " " + str(size), syntheticImage(kind, size, args.seed)))
+    for fn in args.fn:
+        images.append((fn, Image.open(fn)))
+
+    rows = list()
+    for name, oIm in images:
+        print(str(datetime.now()), "Checking", name, str(oIm.size[0]) + "x" + str(oIm.size[1]))
+        inputs = caseInputs(oIm)
+        for case in args.cases:
+            fastCall, refCall = caseCalls(case, inputs)
+            row = (case, name) + compare(fastCall(), refCall(), args.tol)
+            rows.append(row)
+            print(str(datetime.now()), case, row[5])
+
+    print(report(rows))
+
+    failures = [row for row in rows if row[5] not in ("exact", "within tol")]
+    if failures:
+        print(str(datetime.now()), "FAILED:", len(failures), "of", len(rows), "cases differ from the reference:")
+        for row in failures:
+            print("\t" + row[0] + " " + row[1])
+        sys.exit(1)
+
+    print(str(datetime.now()), "PASSED:", len(rows), "cases match the reference.")
@@ -27,6 +27,12 @@ from os.path import exists
 
 from matplotlib.colors import LinearSegmentedColormap
 
+import kernels
+import nearcolor
+import reference
+import stagecache
+import stagetrace
+
 # Constants
 # maximum color brightness
 MAX_COLOR = 255
@@ -120,35 +126,40 @@ def invert(pixel):
 def get_lum(pixel):
     # Calculate luminosity of an (r, g, b) pixel
     # gray level = 0.3r + 0.59g + 0.11b
+    # NOTE: integer math, same result as the float version of the formula
 
-    lum = int((0.3 * pixel[0]) + (0.59 * pixel[1]) + (0.11 * pixel[2]))
-
-    return(lum)
+    return(kernels.pixelLum(pixel))
 
 
-def get_luminosities(im, lums, border=0):
+def get_luminosities(im, lums, border=0, mode="int"):
     # Calculate the luminosity of every pixel in im inside the border area
-
-    for x in range(border, im.size[0] - border):
-        for y in range(border, im.size[1] - border):
-            lums[x, y] = get_lum(im.getpixel((x, y)))
-
-
-# Read or generate luminosity data
-def lumData(im, name, bord=0):
-    lumPath = Path(name)
-    lums = None
-    if lumPath.exists():
-        lpFP = open(name, "rb")
-        lums = np.load(lpFP)
-        print(str(datetime.now()), "Using saved file:", name)
-    else:
+    # NOTE: whole array at once, same results as get_lum() on each pixel
+    #       mode is "int" (lookup tables) or "float" (float weights)
+    if reference.active():
+        # original per pixel loop (mode makes no difference to it)
+        reference.luminosities(im, lums, border)
+        return
+
+    rgb = kernels.imageArray(im)
+    inner = (slice(border, im.size[0] - border), slice(border, im.size[1] - border))
+
+    lums[inner] = kernels.luminosities(rgb[inner], mode)
+
+
+# Read cached luminosity data, or generate it
+def lumData(im, name, bord=0, mode="int"):
+    # NOTE: cached by the image contents and settings, name is written
+    #       as well, for use by other programs, unless it's already up to date
+    key = stagecache.stageKey("lums", stagecache.dataHash(im), {"border": bord, "mode": mode},
+                              (get_luminosities,))
+    lums = stagecache.loadArray("lums", key, kernels.LUM_DTYPE)
+    if lums is None:
         # Calculate input image pixel luminosities
-        lums = np.zeros(im.size).astype(int)
-        get_luminosities(im, lums, bord)
-        lpFP = open(name, "wb")
-        np.save(lpFP, lums)
-    lpFP.close()
+        lums = np.zeros(im.size, dtype=kernels.LUM_DTYPE)
+        get_luminosities(im, lums, bord, mode)
+        stagecache.saveArray("lums", key, lums)
+
+    stagecache.exportArray(key, lums, name)
 
     return(lums)
 
@@ -176,16 +187,12 @@ def processImage(npa, name, palette, save=False, border=0):
     # Create, and possibly display, and possibly save, an image
     # using provided lookup values and palette
 
-    # Create canvas for new image
-    newIm = Image.new('RGB', npa.shape, BACKGROUND)
-    pixels = newIm.load()
+    # Look up the palette colors, then blank the border back to the background
+    rgb = kernels.renderPalette(npa, palette, "npa")
+    rgb[:border] = rgb[npa.shape[0] - border:] = BLACK
+    rgb[:, :border] = rgb[:, npa.shape[1] - border:] = BLACK
 
-    for x in range(border, npa.shape[0] - border):
-        for y in range(border, npa.shape[1] - border):
-            try:
-                pixels[x, y] = palette[npa[x, y]]
-            except:
-                print("ERROR: npa[", str(x) + ",", str(y) + "] = ", str(npa[x, y]))
+    newIm = kernels.arrayImage(rgb)
 
     if save:
         newIm.save(name, format="JPEG", quality=95)
@@ -193,22 +200,15 @@ def processImage(npa, name, palette, save=False, border=0):
     return(newIm.crop((border, border, npa.shape[0] - border, npa.shape[1] - border)))
 
 
-# Read saved image, or create if it doesn't exist
+# Create, and possibly display, and possibly save, an image
+# NOTE: always rendered, a single palette lookup is cheaper than reading a saved file
 def getImage(npa, name, palette, display=False, save=False, bord=0):
-    imPath = Path(name)
-    im = None
-    if imPath.exists():
-        # read image
-        im = Image.open(name)
-        print(str(datetime.now()), "Using saved file:", name)
-    else:
-        # create image
-        im = processImage(npa,
-                          name,
-                          palette,
-                          save,
-                          bord
-                          )
+    im = processImage(npa,
+                      name,
+                      palette,
+                      save,
+                      bord
+                      )
 
     if display:
         im.show()
@@ -220,13 +220,17 @@ def smoothImage(im, name, save=False, border=0):
     # Create, and possibly display, and possibly save, a smoothed image
     # created by averaging the 3x3 box centerd on each input imagee
 
-    # Create canvas for new image
-    newIm = Image.new('RGB', im.size, BACKGROUND)
-    pixels = newIm.load()
+    if reference.active():
+        # original per pixel loop
+        newIm = reference.smoothImage(im, border)
+    else:
+        # Average every 3x3 box at once, then blank the border back to the background
+        # NOTE: same integer-truncated averages as get_av()
+        rgb = kernels.boxAverage(kernels.imageArray(im), 3)
+        rgb[:border] = rgb[im.size[0] - border:] = BLACK
+        rgb[:, :border] = rgb[:, im.size[1] - border:] = BLACK
 
-    for x in range(border, im.size[0] - border):
-        for y in range(border, im.size[1] - border):
-            pixels[x, y] = get_av(im, x, y)
+        newIm = kernels.arrayImage(rgb)
 
     if save:
         newIm.save(name, format="JPEG", quality=95)
@@ -234,21 +238,24 @@ def smoothImage(im, name, save=False, border=0):
     return(newIm.crop((border, border, im.size[0] - border, im.size[1] - border)))
 
 
-# Either open or generate the smoothed imagee
+# Either read the cached smoothed image, or generate it
 def getSmoothImage(im, name, display=False, save=False, border=0):
-    sImPath = Path(name)
-    sIm = None
-    if sImPath.exists():
-        # read image
-        sIm = Image.open(name)
-        print(str(datetime.now()), "Using saved file:", name)
-    else:
+    # NOTE: cached by the image contents and border
+    key = stagecache.stageKey("smooth", stagecache.dataHash(im), {"border": border}, (smoothImage,))
+    sIm = stagecache.loadImage("smooth", key)
+    if sIm is None:
         # create image
         sIm = smoothImage(im,
                          name,
                          save,
                          border
                          )
+        stagecache.saveImage("smooth", key, sIm)
+    elif save:
+        # saved file is the full size image, with a blank border
+        saveIm = Image.new("RGB", im.size, BACKGROUND)
+        saveIm.paste(sIm, (border, border))
+        saveIm.save(name, format="JPEG", quality=95)
 
     if display:
         sIm.show()
@@ -302,42 +309,41 @@ def sobel(im, x, y):
 
 # Fill an edges array with the calculated sobel edge gradient
 def createSobelEdges(im, edges, border=0):
+    if reference.active():
+        # original per pixel loop
+        reference.sobelEdges(im, edges, border)
+        return
 
-    for x in range(border, im.size[0] - (2 * border)):
-        for y in range(border, im.size[1] - (2 * border)):
-            edges[x, y] = sobel(im, x, y)
+    # NOTE: whole array at once from the red plane, same values as sobel()
+    grads = kernels.sobelGradients(kernels.imageArray(im)[..., 0])
+    inner = (slice(border, im.size[0] - (2 * border)), slice(border, im.size[1] - (2 * border)))
 
+    edges[inner] = grads[inner]
 
-# Read gradients file if exists, else calculate gradients.
+
+# Read the cached gradients for the image, else calculate the gradients
+# (once) and cache them. name is written as well (if not up to date), for cli_thinning.py
+# Returns the gradients, and True if they came from the cache
 def getEdges(im, name, bord=0):
-    ePath = Path(name)
-    edges = None
-    if ePath.exists():
-        epFP = open(name, "rb")
-        edges = np.load(epFP)
-        print(str(datetime.now()), "Using saved file:", name)
-    else:
-        # Calculate input image pixel luminosities
-        edges = np.zeros(im.size).astype(int)
+    key = stagecache.stageKey("sobel", stagecache.dataHash(im), {"border": bord}, (createSobelEdges,))
+    edges = stagecache.loadArray("sobel", key, kernels.SOBEL_DTYPE)
+    cached = edges is not None
+    if not cached:
+        # Calculate smoothed image sobel gradients
+        edges = np.zeros(im.size, dtype=kernels.SOBEL_DTYPE)
         createSobelEdges(im, edges, bord)
-        epFP = open(name, "wb")
-        np.save(epFP, edges)
-    epFP.close()
-
-    return(edges)
+        stagecache.saveArray("sobel", key, edges)
 
+    stagecache.exportArray(key, edges, name)
 
-# Normalize the edges array to 0<->MAX_COLOR
-def normalizeEdges(edges):
-    maxR = np.max(edges)
+    return((edges, cached))
 
-    norm = np.zeros(im.size).astype(int)
 
-    for x in range(edges.shape[0]):
-        for y in range(edges.shape[1]):
-            norm[x, y] = int((edges[x, y] / maxR) * MAX_COLOR)
-
-    return(norm)
+# Normalize the edges array to 0<->MAX_COLOR
+def normalizeEdges(edges, mode="max", percentile=kernels.NORM_PERCENTILE, scale=kernels.MAX_SOBEL):
+    # Scale the edge gradients into the range 0 - MAX_COLOR, for palette lookups
+    # mode is one of kernels.NORM_MODES, see kernels.normalizeGradients()
+    return(kernels.normalizeGradients(edges, mode, percentile, scale, MAX_COLOR))
 
 
 # Create a palettized version of the edge gradients
@@ -345,15 +351,8 @@ def edgesImage(edges, name, palette, display=False, save=False, border=0):
     # Create, and possibly display, and possibly save, an image
     # by applying the provided sobel edges values to the provide image
 
-    # Create canvas for new image
-    newIm = Image.new('RGB', edges.shape, BACKGROUND)
-    newPixels = newIm.load()
-
-    max = np.max(edges)
-
-    for x in range(edges.shape[0]):
-        for y in range(edges.shape[1]):
-            newPixels[x, y] = palette[edges[x, y]]
+    # Look up the palette color for every edge value
+    newIm = kernels.arrayImage(kernels.renderPalette(edges, palette, "edges"))
 
     if display:
         newIm.show()
@@ -364,31 +363,42 @@ def edgesImage(edges, name, palette, display=False, save=False, border=0):
     return(newIm)
 
 
-def applyEdges(im, edges, name, th, display=False, save=False, border=0):
-    # Create, and possibly display, and possibly save, an image
-    # by applying the provided sobel edges values to the provide image
+def edgeMask(edges, th):
+    # Mark the pixels whose edge value is at or above the threshold,
+    # these are blacked out in every image the edges are applied to
+    return(np.asarray(edges) >= th)
 
-    # Create canvas for new image
-    newIm = Image.new('RGB', im.size, BACKGROUND)
-    newPixels = newIm.load()
 
-    # get the input image
-    pixels = im.load()
-    
-    for x in range(im.size[0]):
-        for y in range(im.size[1]):
-            if edges[x, y] < th:
-                newPixels[x, y] = pixels[x, y]
-            else:
-                newPixels[x, y] = BLACK
+def applyEdgeMask(ims, mask, names, display=False, saves=None):
+    # Create, and possibly display, and possibly save, one image per input
+    # image by applying the same precomputed edge mask to each of them
+    if saves is None:
+        saves = [False] * len(ims)
 
-    if display:
-        newIm.show()
+    newIms = list()
+    for i in range(len(ims)):
+        rgb = kernels.imageArray(ims[i]).copy()
+        # NOTE: pixels past the edge of the mask are kept, as if their edge value was 0
+        w = min(rgb.shape[0], mask.shape[0])
+        h = min(rgb.shape[1], mask.shape[1])
+        rgb[:w, :h][mask[:w, :h]] = BLACK
+        newIm = kernels.arrayImage(rgb)
 
-    if save:
-        newIm.save(name, format="JPEG", quality=95)
+        if display:
+            newIm.show()
 
-    return(newIm)
+        if saves[i]:
+            newIm.save(names[i], format="JPEG", quality=95)
+
+        newIms.append(newIm)
+
+    return(newIms)
+
+
+def applyEdges(im, edges, name, th, display=False, save=False, border=0):
+    # Create, and possibly display, and possibly save, an image
+    # by applying the provided sobel edges values to the provide image
+    return(applyEdgeMask([im], edgeMask(edges, th), [name], display, [save])[0])
 
 
 
@@ -422,6 +432,103 @@ if __name__ == '__main__':
                         default = 16
                         )
 
+    # Optional argument for luminosity math (defaults to int)
+    # NOTE: int and float give identical results, int is lighter on memory
+    parser.add_argument('--lm',
+                        action="store",
+                        dest="lm",
+                        help="luminosity math (int or float)",
+                        choices=kernels.LUM_MODES,
+                        default="int"
+                        )
+
+    # Optional arguments for the intermediate results cache
+    # NOTE: least recently used results are removed to keep under the size limit
+    parser.add_argument('--cache-dir',
+                        action="store",
+                        dest="cd",
+                        help="intermediate results cache directory",
+                        default=stagecache.CACHE_DIR
+                        )
+
+    parser.add_argument('--cache-mb',
+                        type=float,
+                        dest="cmb",
+                        help="intermediate results cache size limit, in megabytes",
+                        default=stagecache.CACHE_MB
+                        )
+
+    # Optional argument to read cached arrays in full, instead of memory mapping them
+    parser.add_argument('--eager', action='store_true', help="read cached arrays in full (for benchmarking)")
+
+    # Optional argument for the image operations backend (defaults to fast)
+    # NOTE: reference runs the original per pixel loops, very slowly, for
+    #       checking the fast versions against, see cli_golden.py
+    parser.add_argument('--backend',
+                        action="store",
+                        dest="backend",
+                        help="image operations backend (fast or reference)",
+                        choices=reference.BACKENDS,
+                        default="fast"
+                        )
+
+    # Optional arguments for the stage timing trace
+    # NOTE: a summary table is always printed at the end of the run,
+    #       the trace file is CSV if its name ends in .csv, JSON otherwise
+    parser.add_argument('--trace',
+                        action="store",
+                        dest="trace",
+                        help="stage timing trace filename (.json or .csv)",
+                        default=None
+                        )
+
+    parser.add_argument('--trace-mem',
+                        action="store",
+                        dest="tm",
+                        help="stage peak memory measure (rss, or tracemalloc which is slower)",
+                        choices=stagetrace.MEMORY_MODES,
+                        default="rss"
+                        )
+
+    # Optional arguments to profile each stage, one cProfile file per stage in
+    # the directory (for pstats or snakeviz), plus sampled collapsed stacks
+    # (for flame graphs) if asked
+    parser.add_argument('--profile',
+                        action="store",
+                        dest="prof",
+                        help="stage profile directory",
+                        default=None
+                        )
+
+    parser.add_argument('--profile-collapsed',
+                        action='store_true',
+                        dest="profc",
+                        help="also save sampled collapsed stacks for each stage (needs --profile)"
+                        )
+
+    # Optional arguments for edge normalization (defaults to max)
+    # NOTE: percentile or fixed keep a few very strong edges from squeezing
+    #       all the others into the bottom of the range
+    parser.add_argument('--nm',
+                        action="store",
+                        dest="nm",
+                        help="edge normalization (max, percentile, or fixed)",
+                        choices=kernels.NORM_MODES,
+                        default="max"
+                        )
+
+    parser.add_argument('--np',
+                        type=float,
+                        help="edge normalization percentile",
+                        default=kernels.NORM_PERCENTILE
+                        )
+
+    parser.add_argument('--ns',
+                        type=float,
+                        help="edge normalization fixed scale",
+                        default=kernels.MAX_SOBEL
+                        )
+
     # Optional argument to display all images
     parser.add_argument('--da', action='store_true', help="display all images")
 
@@ -489,6 +596,18 @@ if __name__ == '__main__':
     print("fn\t", args.fn)
     print("pn\t", args.pn)
     print("th\t", args.th)
+    print("lm\t", args.lm)
+    print("nm\t", args.nm)
+    print("np\t", args.np)
+    print("ns\t", args.ns)
+    print("cd\t", args.cd)
+    print("cmb\t", args.cmb)
+    print("eager\t", args.eager)
+    print("backend\t", args.backend)
+    print("trace\t", args.trace)
+    print("tm\t", args.tm)
+    print("prof\t", args.prof)
+    print("profc\t", args.profc)
     print("da\t", args.da)
     print("do\t", args.do)
     print("dgs\t", args.dgs)
@@ -507,6 +626,15 @@ if __name__ == '__main__':
     print("ms\t", args.ms)
     print("nc\t", args.nc)
 
+    # NOTE: the reference backend caches its results separately, so they
+    #       never stand in for the fast backend's, or the other way round
+    reference.configure(args.backend)
+    if reference.active():
+        args.cd = str(Path(args.cd) / "reference")
+    stagecache.configure(args.cd, args.cmb, not args.eager)
+    stagetrace.configure(args.trace, args.tm, "cli_sobel.py", vars(args))
+    stagetrace.configureProfile(args.prof, args.profc)
+
     # Create the working palette(s)
     colors = []
 
@@ -598,39 +726,29 @@ if __name__ == '__main__':
     # Create an image from the nearest palette colors to the original colors
     if args.nc:
         print(str(datetime.now()), "Nearest colors version started.")
-        oImPixels = oIm.load()
-        ncIm = Image.new('RGB', oIm.size, BACKGROUND)
-        ncImPixels = ncIm.load()
-
+        stagetrace.begin("nc")
         # max_cDist is the greatest distance between colors (distance between black and white)
         max_cDist = int(((255 * 255) + (255 * 255) + (255 * 255))**0.5) + 1
 
-        matchCounter = 0
-        mcDict = dict()
-        for x in range(ncIm.size[0]):
-            for y in range(ncIm.size[1]):
-                pixel = oImPixels[x, y]
-                if pixel in mcDict:
-                    # know closest color to this pixel, use look up to cut down on computation
-                    ncImPixels[x, y] = mcDict[pixel]
-                    matchCounter += 1
-                else:
-                    # haven't found closest color to this pixel yet, calculate it
-                    color = nearest(pixel, colors)
-                    ncImPixels[x, y] = color
-                    # and save what we just calculated in a lookup table
-                    mcDict[pixel] = color
-
-        print(str(datetime.now()), "entries in mcDict:", len(mcDict))
-        print(str(datetime.now()), "color already in mcDict:", matchCounter)
+        if reference.active():
+            # original per pixel search, see reference.py
+            ncIm = reference.nearestImage(oIm, colors, "l2")
+        else:
+            # Solve each distinct color of the image once, Euclidean distance
+            # NOTE: extra last palette entry is nearest()'s white fallback
+            ncIndices = nearcolor.nearestColors(kernels.imageArray(oIm), colors, "l2", max_cDist)
+            ncIm = kernels.arrayImage(kernels.renderPalette(ncIndices, colors + [WHITE], "ncIndices"))
+
         ncIm.show()
         ncIm.save(savePalBase + "nc.jpg", "JPEG", quality=95)
-        print(str(datetime.now()), "Nearest colors version done.")
+        stagetrace.end("nc", "Nearest colors version done.")
 
-    lums = lumData(im, saveBase + "luminosity.npy", bord=BORDER) 
-    print(str(datetime.now()), "Original luminosity array done.")
+    stagetrace.begin("lums")
+    lums = lumData(im, saveBase + "luminosity.npy", bord=BORDER, mode=args.lm)
+    stagetrace.end("lums", "Original luminosity array done.")
 
     # Grayscale image
+    stagetrace.begin("gs")
     gsIm = getImage(lums,
                     saveBase + "gs.jpg",
                     grays,
@@ -638,9 +756,10 @@ if __name__ == '__main__':
                     True,
                     BORDER
                     )
-    print(str(datetime.now()), "Grayscale image done.")
+    stagetrace.end("gs", "Grayscale image done.")
 
     # Generate posterized and poster-invereted images
+    stagetrace.begin("p")
     pIm = getImage(lums,
                    savePalBase + "p.jpg",
                    colors,
@@ -648,9 +767,10 @@ if __name__ == '__main__':
                    (args.sa or args.sp),
                    BORDER
                    )
-    print(str(datetime.now()), "Posterized image done.")
+    stagetrace.end("p", "Posterized image done.")
 
     if args.ci:
+        stagetrace.begin("pi")
         piIm = getImage(lums,
                         savePalBase + "pi.jpg",
                         anticolors,
@@ -658,9 +778,10 @@ if __name__ == '__main__':
                         (args.sa or args.sp),
                         BORDER
                         )
-        print(str(datetime.now()), "Posterized invert image done.")
+        stagetrace.end("pi", "Posterized invert image done.")
 
     # Generate reverse posterized and poster-invereted images
+    stagetrace.begin("rp")
     rpIm = getImage(lums,
                     savePalBase + "rp.jpg",
                     r_colors,
@@ -668,9 +789,10 @@ if __name__ == '__main__':
                     (args.sa or args.sr),
                     BORDER
                     )
-    print(str(datetime.now()), "Reverse posterized image done.")
+    stagetrace.end("rp", "Reverse posterized image done.")
 
     if args.ci:
+        stagetrace.begin("rpi")
         rpiIm = getImage(lums,
                          savePalBase + "rpi.jpg",
                          r_anticolors,
@@ -678,22 +800,25 @@ if __name__ == '__main__':
                          (args.sa or args.sp),
                          BORDER
                          )
-        print(str(datetime.now()), "Reverse posterized invert image done.")
+        stagetrace.end("rpi", "Reverse posterized invert image done.")
 
     # Generate a smoothed (averaged) version of the input image.
+    stagetrace.begin("smooth")
     sIm = getSmoothImage(im,
                          saveBase + "a.jpg",
                          args.da,
                          True,
                          border=BORDER
                          )
-    print(str(datetime.now()), "Smoothed image done.")
+    stagetrace.end("smooth", "Smoothed image done.")
 
     # Calculate smoothed image pixel luminosities
-    sLums = lumData(sIm, saveBase + "smoothLum.npy", BORDER)
-    print(str(datetime.now()), "Smoothed luminosity array done.")
+    stagetrace.begin("smoothLums")
+    sLums = lumData(sIm, saveBase + "smoothLum.npy", BORDER, args.lm)
+    stagetrace.end("smoothLums", "Smoothed luminosity array done.")
 
     # Generatee smoothed grayscale image
+    stagetrace.begin("sgs")
     sGsIm = getImage(sLums,
                      saveBase + "sgs.jpg",
                      grays,
@@ -701,9 +826,10 @@ if __name__ == '__main__':
                      True,
                      BORDER
                      )
-    print(str(datetime.now()), "Smoothed grayscale image done.")
+    stagetrace.end("sgs", "Smoothed grayscale image done.")
 
     # Generate posterized and poster-invereted images
+    stagetrace.begin("sp")
     sPIm = getImage(sLums,
                     savePalBase + "sp.jpg",
                     colors,
@@ -711,9 +837,10 @@ if __name__ == '__main__':
                     (args.sa or args.sp),
                     BORDER
                     )
-    print(str(datetime.now()), "Smoothed posterized image done.")
+    stagetrace.end("sp", "Smoothed posterized image done.")
 
     if args.ci:
+        stagetrace.begin("spi")
         sPiIm = getImage(sLums,
                          savePalBase + "spi.jpg",
                          anticolors,
@@ -721,14 +848,19 @@ if __name__ == '__main__':
                          (args.sa or args.sp),
                          BORDER
                          )
-        print(str(datetime.now()), "Smoothed posterized invert image done.")
+        stagetrace.end("spi", "Smoothed posterized invert image done.")
 
-    edges = getEdges(sIm, saveBase + "sobel.npy", BORDER)
-    eIm = createSobelEdges(sIm, edges, BORDER)
-    print(str(datetime.now()), "Edge gradients calculated.")
+    # NOTE: getEdges only calculates the gradients when there is no usable saved file
+    stagetrace.begin("edges")
+    edges, edgesCached = getEdges(sIm, saveBase + "sobel.npy", BORDER)
+    if edgesCached:
+        stagetrace.end("edges", "Edge gradients loaded (cache hit).")
+    else:
+        stagetrace.end("edges", "Edge gradients calculated (cache miss).")
 
-    normEdges = normalizeEdges(edges)
-    print(str(datetime.now()), "Edge gradients normalized.")
+    stagetrace.begin("normalize")
+    normEdges = normalizeEdges(edges, args.nm, args.np, args.ns)
+    stagetrace.end("normalize", "Edge gradients normalized.")
 
     edgePal = list()
     for i in range(MAX_PLEN):
@@ -738,6 +870,7 @@ if __name__ == '__main__':
             edgePal.append(WHITE)
 
     # NOTE: Add args.th for filname because edgePal created using args.th
+    stagetrace.begin("e")
     edgesIm = edgesImage(normEdges,
                          saveThBase + "e.jpg",
                          edgePal,
@@ -746,8 +879,9 @@ if __name__ == '__main__':
                          border=BORDER
                          )
 
-    print(str(datetime.now()), "Edges image done.")
+    stagetrace.end("e", "Edges image done.")
 
+    stagetrace.begin("ep")
     colEdges = edgesImage(normEdges,
                           savePalBase + "ep.jpg",
                           colors,
@@ -756,8 +890,9 @@ if __name__ == '__main__':
                           border=BORDER
                           )
 
-    print(str(datetime.now()), "Posterized edges image done.")
+    stagetrace.end("ep", "Posterized edges image done.")
 
+    stagetrace.begin("epi")
     if args.ci:
         antiEdges = edgesImage(normEdges,
                                savePalBase + "epi.jpg",
@@ -767,8 +902,9 @@ if __name__ == '__main__':
                                border=BORDER
                                )
 
-    print(str(datetime.now()), "Posterized invert edges image done.")
+    stagetrace.end("epi", "Posterized invert edges image done.")
 
+    stagetrace.begin("rep")
     rcolEdges = edgesImage(normEdges,
                            savePalBase + "rep.jpg",
                            r_colors,
@@ -777,8 +913,9 @@ if __name__ == '__main__':
                            border=BORDER
                            )
 
-    print(str(datetime.now()), "Reverse posterized edges image done.")
+    stagetrace.end("rep", "Reverse posterized edges image done.")
 
+    stagetrace.begin("repi")
     if args.ci:
         rantiEdges = edgesImage(normEdges,
                                 savePalBase + "repi.jpg",
@@ -788,57 +925,39 @@ if __name__ == '__main__':
                                 border=BORDER
                                 )
 
-    print(str(datetime.now()), "Reverse posterized invert edges image done.")
-    esPIm = applyEdges(sPIm,
-                       normEdges,
-                       savePalThBase + "esp.jpg",
-                       args.th,
-                       args.da,
-                       (args.sa or args.spe),
-                       border=BORDER
-                       )
-
-    print(str(datetime.now()), "Edged smoothed posterized image done.")
+    stagetrace.end("repi", "Reverse posterized invert edges image done.")
+    # Find the pixels to black out once, every edged image shares the mask
+    stagetrace.begin("edged")
+    thMask = edgeMask(normEdges, args.th)
 
+    # Apply edges to the smoothed and posterized images, in one batch
+    # NOTE: key maps to (image, name, save, message)
+    edgeRequests = dict()
+    edgeRequests["sp"] = (sPIm, savePalThBase + "esp.jpg", (args.sa or args.spe),
+                          "Edged smoothed posterized image done.")
     if args.ci:
-        esPiIm = applyEdges(sPiIm,
-                            normEdges,
-                            savePalThBase + "espi.jpg",
-                            args.th,
-                            args.da,
-                            (args.sa or args.spe),
-                            border=BORDER
-                            )
-
-        print(str(datetime.now()), "Edged smoothed posterized invert image done.")
-
-    esIm = applyEdges(sIm,
-                      normEdges,
-                      saveThBase + "es.jpg",
-                      args.th,
-                      args.da,
-                      True,
-                      border=BORDER
-                      )
+        edgeRequests["spi"] = (sPiIm, savePalThBase + "espi.jpg", (args.sa or args.spe),
+                               "Edged smoothed posterized invert image done.")
+    edgeRequests["s"] = (sIm, saveThBase + "es.jpg", True,
+                         "Edged smoothed image done.")
+
+    esIms = applyEdgeMask([request[0] for request in edgeRequests.values()],
+                          thMask,
+                          [request[1] for request in edgeRequests.values()],
+                          args.da,
+                          [request[2] for request in edgeRequests.values()]
+                          )
+    stagetrace.end("edged")
 
-    print(str(datetime.now()), "Edged smoothed image done.")
+    for request in edgeRequests.values():
+        print(str(datetime.now()), request[3])
 
     if args.ms:
+        stagetrace.begin("ms")
         # Create max saturation image
-        from colorsys import hsv_to_rgb, rgb_to_hsv
-        
-        msIm = Image.new("RGB", im.size, BACKGROUND)
-        msPixels = msIm.load()
-        msOrigImPixels = im.load()
-        for x in range(msIm.size[0]):
-            for y in range(msIm.size[1]):
-                # get original (r,g,b) information
-                r, g, b = msOrigImPixels[x, y]
-                # convert to (h,s,v)
-                h, s, v = rgb_to_hsv(r, g, b)
-                # keep original hue and value, bump saturation to max, get new (r,g,b)
-                nr, ng, nb = hsv_to_rgb(h, 1.0, v)
-                msPixels[x, y] = (int(nr), int(ng), int(nb))
+        # keep original hue and value, bump saturation to max, for all pixels at once
+        # NOTE: channels stay in the 0-255 range, as before
+        msIm = kernels.arrayImage(kernels.maxSaturation(kernels.imageArray(im), scale=1))
 
         if args.da:
             msIm.show()
@@ -847,13 +966,13 @@ if __name__ == '__main__':
             msIm.save(saveBase + "ms.jpg", format="JPEG", quality=95)
             print(str(datetime.now()), "Max saturation image done.")
 
-        msEsIm = applyEdges(msIm,
-                            normEdges,
-                            saveThBase + "ms_es.jpg",
-                            args.th,
-                            args.da,
-                            True,
-                            border=BORDER
-                            )
+        msEsIm = applyEdgeMask([msIm],
+                               thMask,
+                               [saveThBase + "ms_es.jpg"],
+                               args.da,
+                               [True]
+                               )[0]
+
+        stagetrace.end("ms", "Edged max saturation image done.")
 
-        print(str(datetime.now()), "Edged max saturation image done.")
+    stagetrace.finish()
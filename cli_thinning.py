@@ -25,6 +25,10 @@ from os.path import exists
 
 from matplotlib.colors import LinearSegmentedColormap
 
+import kernels
+import reference
+import stagetrace
+
 # Constants
 # maximum color brightness
 MAX_COLOR = 255
@@ -55,95 +59,35 @@ def thinningGuoHallIteration(gradients, passNumber):
     # Do a thinning pass on a gradients matrix
     # gradients is a ndarray of booleans
     # passNumber = 0 for first pass, 1 for second pass
+    # NOTE: whole array at once, each pixel's neighborhood encoded as a byte
+    #       and looked up in a table of delete decisions, same results as
+    #       the per pixel loop (reference.thinningIteration())
     print("passNumber:", passNumber)
-    marker = np.zeros(gradients.shape).astype(bool)
-
-    for x in range(1, gradients.shape[0] - 1):
-        for y in range(1, gradients.shape[1] - 1):
-            p2 = gradients[x, y - 1]
-            p3 = gradients[x + 1, y - 1]
-            p4 = gradients[x + 1, y]
-            p5 = gradients[x + 1, y + 1]
-            p6 = gradients[x, y + 1]
-            p7 = gradients[x - 1, y + 1]
-            p8 = gradients[x - 1, y]
-            p9 = gradients[x - 1, y - 1]
-
-            ca = 1 if ((not p2) and (p3 or p4)) else 0
-            cb = 1 if ((not p4) and (p5 or p6)) else 0
-            cc = 1 if ((not p6) and (p7 or p8)) else 0
-            cd = 1 if ((not p8) and (p9 or p2)) else 0
-            c = ca + cb + cc + cd
-
-            n1a = 1 if (p9 or p2) else 0
-            n1b = 1 if (p3 or p4) else 0
-            n1c = 1 if (p5 or p6) else 0
-            n1d = 1 if (p7 or p8) else 0
-            n1 = n1a + n1b + n1c + n1d
-
-            n2a = 1 if (p2 or p3) else 0
-            n2b = 1 if (p4 or p5) else 0
-            n2c = 1 if (p6 or p7) else 0
-            n2d = 1 if (p8 or p9) else 0
-            n2 = n2a + n2b + n2c + n2d
-
-            n = min(n1, n2)
-
-            if passNumber == 0:
-                m = (p6 or p7 or (not p9)) and p8
-            else:
-                m = (p2 or p3 or (not p5)) and p4
-
-            if (c == 1) and (n == 2 or n == 3) and (not m):
-                # clear the gradient at this location
-                marker[x, y] = False
-            else:
-                # keep the gradient at this location
-                marker[x, y] = True
-
-    masked = np.logical_and(gradients, marker)
-
-    return masked
 
+    return(kernels.guoHallPass(gradients, passNumber))
 
-def thinningGuoHall(gradients, th, saveBase, displayPasses):
-    # gradients is an ndarray of gradient values
-    # th is the threshhold above which to use
-    def dump(bArray, name, saveFile):
 
-        im = Image.new('RGB', bArray.shape, BACKGROUND)
-        pixels = im.load()
-        for x in range(im.size[0]):
-            for y in range(im.size[1]):
-                if bArray[x, y]:
-                    pixels[x, y] = WHITE
-        im.show()
-
-        if saveFile:
-            im.save(saveBase + ".jpg", format="JPEG", quality=95)
-
-            fmFP = open(saveBase + ".npy", "wb")
-            np.save(fmFP, bArray)
-
-    shape = gradients.shape
-    gradientBools = np.zeros(shape).astype(bool)
-
-    for x in range(shape[0]):
-        for y in range(shape[1]):
-            if gradients[x, y] > th:
-                gradientBools[x, y] = True
+def thresholdGradients(gradients, th):
+    # Mark the gradients above the threshhold
+    return(np.asarray(gradients) > th)
 
 
+def guoHallThin(gradientBools, passDump=None):
+    # Thin a boolean gradients matrix with pairs of Guo-Hall passes, until
+    # a pair changes nothing (or after 65 pairs)
+    # passDump, if given, is called with the result of each pair, and its number
+    # Returns the thinned matrix and the number of the last pair
+    iteration = reference.thinningIteration if reference.active() else thinningGuoHallIteration
     limit = 0
     while True:
         print("limit:", limit)
-        pass0 = thinningGuoHallIteration(gradientBools, 0)
-        pass1 = thinningGuoHallIteration(pass0, 1)
+        pass0 = iteration(gradientBools, 0)
+        pass1 = iteration(pass0, 1)
         diff = np.logical_xor(pass1, gradientBools)
         countTrue = diff.astype(int).sum()
 
-        if displayPasses:
-            dump(pass1, saveBase + "_pass_" + str(limit), False) 
+        if passDump is not None:
+            passDump(pass1, limit)
 
         if countTrue == 0:
             break
@@ -155,15 +99,45 @@ def thinningGuoHall(gradients, th, saveBase, displayPasses):
 
         gradientBools = pass1.copy()
 
+    return((gradientBools, limit))
+
+
+def maskGradients(gradients, gradientBools):
+    # Keep the gradients where gradientBools is set, zero elsewhere
+    return(np.where(gradientBools, gradients, 0).astype(gradients.dtype))
+
+
+def thinningGuoHall(gradients, th, saveBase, displayPasses):
+    # gradients is an ndarray of gradient values
+    # th is the threshhold above which to use
+    def dump(bArray, name, saveFile):
+
+        # white where set, background elsewhere
+        im = kernels.arrayImage(np.where(bArray[..., None], WHITE, BLACK))
+        im.show()
+
+        if saveFile:
+            im.save(saveBase + ".jpg", format="JPEG", quality=95)
+
+            fmFP = open(saveBase + ".npy", "wb")
+            np.save(fmFP, bArray)
+
+    if reference.active():
+        gradientBools = reference.thresholdGradients(gradients, th)
+    else:
+        gradientBools = thresholdGradients(gradients, th)
+
+    passDump = None
+    if displayPasses:
+        passDump = lambda bArray, limit: dump(bArray, saveBase + "_pass_" + str(limit), False)
+    gradientBools, limit = guoHallThin(gradientBools, passDump)
+
     dump(gradientBools, saveBase + "_" + str(limit), True)
 
-    finalMask = np.zeros(shape).astype(int)
-    for x in range(gradientBools.shape[0]):
-        for y in range(gradientBools.shape[1]):
-            if gradientBools[x, y]:
-                finalMask[x, y] = gradients[x, y]
+    if reference.active():
+        return(reference.maskGradients(gradients, gradientBools))
 
-    return(finalMask)
+    return(maskGradients(gradients, gradientBools))
 
 if __name__ == '__main__':
     print("Start now:",  str(datetime.now()))
@@ -196,6 +170,75 @@ if __name__ == '__main__':
                         default = 8
                         )
 
+    # Optional arguments for gradient normalization (defaults to max)
+    parser.add_argument('--nm',
+                        action="store",
+                        dest="nm",
+                        help="gradient normalization (max, percentile, or fixed)",
+                        choices=kernels.NORM_MODES,
+                        default="max"
+                        )
+
+    parser.add_argument('--np',
+                        type=float,
+                        help="gradient normalization percentile",
+                        default=kernels.NORM_PERCENTILE
+                        )
+
+    parser.add_argument('--ns',
+                        type=float,
+                        help="gradient normalization fixed scale",
+                        default=kernels.MAX_SOBEL
+                        )
+
+    # Optional argument to read the gradient file in full, instead of memory mapping it
+    parser.add_argument('--eager', action='store_true', help="read gradient file in full (for benchmarking)")
+
+    # Optional argument for the thinning backend (defaults to fast)
+    # NOTE: reference runs the original per pixel loops, for checking the
+    #       fast versions against, see cli_golden.py
+    parser.add_argument('--backend',
+                        action="store",
+                        dest="backend",
+                        help="thinning backend (fast or reference)",
+                        choices=reference.BACKENDS,
+                        default="fast"
+                        )
+
+    # Optional arguments for the stage timing trace
+    # NOTE: a summary table is always printed at the end of the run,
+    #       the trace file is CSV if its name ends in .csv, JSON otherwise
+    parser.add_argument('--trace',
+                        action="store",
+                        dest="trace",
+                        help="stage timing trace filename (.json or .csv)",
+                        default=None
+                        )
+
+    parser.add_argument('--trace-mem',
+                        action="store",
+                        dest="tm",
+                        help="stage peak memory measure (rss, or tracemalloc which is slower)",
+                        choices=stagetrace.MEMORY_MODES,
+                        default="rss"
+                        )
+
+    # Optional arguments to profile each stage, one cProfile file per stage in
+    # the directory (for pstats or snakeviz), plus sampled collapsed stacks
+    # (for flame graphs) if asked
+    parser.add_argument('--profile',
+                        action="store",
+                        dest="prof",
+                        help="stage profile directory",
+                        default=None
+                        )
+
+    parser.add_argument('--profile-collapsed',
+                        action='store_true',
+                        dest="profc",
+                        help="also save sampled collapsed stacks for each stage (needs --profile)"
+                        )
+
     # Optional argument to display each thining pass
     parser.add_argument('--dt', action='store_true', help="display each thinning pass")
 
@@ -203,7 +246,20 @@ if __name__ == '__main__':
     print("fn\t", args.fn)
     print("pn\t", args.pn)
     print("th\t", args.th)
+    print("nm\t", args.nm)
+    print("np\t", args.np)
+    print("ns\t", args.ns)
     print("dt\t", args.dt)
+    print("eager\t", args.eager)
+    print("backend\t", args.backend)
+    print("trace\t", args.trace)
+    print("tm\t", args.tm)
+    print("prof\t", args.prof)
+    print("profc\t", args.profc)
+
+    reference.configure(args.backend)
+    stagetrace.configure(args.trace, args.tm, "cli_thinning.py", vars(args))
+    stagetrace.configureProfile(args.prof, args.profc)
 
     # Build image save filename strings
     # All files saved into a directory named from today's date (YYYYMMDD)
@@ -257,25 +313,24 @@ if __name__ == '__main__':
         # Drop all zero value pixels
         colors[0] = BLACK
 
-        gpFP = open(args.fn, "rb")
-        gradients = np.load(gpFP)
-        print(str(datetime.now()), "Using gradient file:", args.fn)
+        # NOTE: memory mapped copy-on-write, unless --eager, so only the parts
+        #       actually used are read, and changes never reach the file
+        stagetrace.begin("load")
+        gradients = np.load(args.fn, mmap_mode=(None if args.eager else "c"))
+        stagetrace.end("load", "Using gradient file: " + args.fn)
 
 # experimental -- normalize the gradients
-        maxR = np.max(gradients)
-        norm = np.zeros(gradients.shape).astype(int)
-        normIm = Image.new("RGB", gradients.shape, BACKGROUND)
-        normPixels = normIm.load()
-
-        for x in range(gradients.shape[0]):
-            for y in range(gradients.shape[1]):
-                norm[x, y] = int((gradients[x, y] / maxR) * MAX_COLOR)
-                normPixels[x, y] = colors[norm[x, y]]
+        stagetrace.begin("normalize")
+        norm = kernels.normalizeGradients(gradients, args.nm, args.np, args.ns, MAX_COLOR)
+        normIm = kernels.arrayImage(kernels.renderPalette(norm, colors, "norm"))
 
         normIm.show()
         normIm.save(savePalBase + "norm.jpg", "JPEG", quality=95)
+        stagetrace.end("normalize", "Gradients normalized.")
 
+        stagetrace.begin("thinning")
         finalMask = thinningGuoHall(norm, args.th, saveBase, args.dt)
+        stagetrace.end("thinning", "Thinning done.")
 
         maxFM = np.max(finalMask)
         minFM = np.min(finalMask)
@@ -287,15 +342,14 @@ if __name__ == '__main__':
 
 
         # Now, use the palette, and the the thinned gradients to make an image
-        im = Image.new("RGB", finalMask.shape, BACKGROUND)
-        pixels = im.load()
-
-        for x in range(finalMask.shape[0]):
-            for y in range(finalMask.shape[1]):
-                pixels[x, y] = colors[finalMask[x, y]]
+        stagetrace.begin("render")
+        im = kernels.arrayImage(kernels.renderPalette(finalMask, colors, "finalMask"))
 
         im.show()
         im.save(savePalThBase + "thin.jpg", "JPEG", quality=95)                
+        stagetrace.end("render", "Thinned image done.")
 
     else:
         print("The gradient file", args.fn, "does not exist.")
+
+    stagetrace.finish()
@@ -19,6 +19,8 @@ from PIL import ImageColor
 
 from datetime import datetime
 
+import kernels
+
 
 def createCDict(colors):
     # Create an evenly spaced cdict dictionary from a list of colors
@@ -77,10 +79,9 @@ def palette(cm):
 def get_lum(pixel):
     # Calculate luminosity of an (r, g, b) pixel
     # gray level = 0.3r + 0.59g + 0.11b
+    # NOTE: integer math, same result as the float version of the formula
 
-    lum = int((0.3 * pixel[0]) + (0.59 * pixel[1]) + (0.11 * pixel[2]))
-
-    return(lum)
+    return(kernels.pixelLum(pixel))
 
 
 def colorbar(colors):
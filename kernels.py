@@ -0,0 +1,360 @@
+#
+# kernels.py
+#
+# Whole-array versions of the per-pixel image operations shared by
+# ImageMaker.py, cli_sobel.py, cli_edges.py, and cli_thinning.py.
+#
+# NOTE: All arrays are indexed [x, y], the same as Image.load() pixel access
+#       and the lums/edges arrays the scripts already use, so image buffers
+#       are transposed on the way in and out.
+#
+
+import numpy as np
+
+from PIL import Image
+
+
+# Luminosity weights, gray level = 0.3r + 0.59g + 0.11b
+LUM_WEIGHTS = (0.3, 0.59, 0.11)
+# Same weights scaled to integers, gray level = (300r + 590g + 110b) // 1000
+LUM_INT_WEIGHTS = (300, 590, 110)
+LUM_SCALE = 1000
+# Luminosity math modes: "int" uses the lookup tables below, "float" the weights above
+LUM_MODES = ("int", "float")
+
+# Per-channel lookup tables of scaled luminosity contributions
+LUM_TABLES = np.array([np.arange(256, dtype=np.uint32) * w for w in LUM_INT_WEIGHTS])
+
+# Edge normalization modes: scale by the largest gradient, by a percentile
+# of the gradients, or by a fixed value
+NORM_MODES = ("max", "percentile", "fixed")
+# Default percentile for "percentile" normalization
+NORM_PERCENTILE = 99.5
+# Largest possible Sobel gradient, int(sqrt(2) * 4 * 255), default for "fixed"
+MAX_SOBEL = 1442
+
+# Compact types for stored arrays, luminosities and normalized edges
+# (0 - 255) fit in uint8, raw Sobel gradients (0 - MAX_SOBEL) in uint16
+LUM_DTYPE = np.uint8
+NORM_DTYPE = np.uint8
+SOBEL_DTYPE = np.uint16
+
+
+def imageArray(im):
+    # Return the pixels of an image as an [x, y, (r, g, b)] uint8 array
+    # NOTE: a read-only view of Pillow's buffer, copy before modifying
+    if im.mode != "RGB":
+        im = im.convert("RGB")
+
+    return(np.asarray(im).transpose(1, 0, 2))
+
+
+def arrayImage(rgb):
+    # Create an RGB image from an [x, y, (r, g, b)] array
+    return(Image.fromarray(np.ascontiguousarray(rgb.transpose(1, 0, 2), dtype=np.uint8), "RGB"))
+
+
+def floatLuminosities(rgb):
+    # Calculate the luminosity of every pixel in an [x, y, (r, g, b)] array
+    # NOTE: same operation order as get_lum(), so the float rounding, and so
+    #       the int() truncation, is identical
+    r = rgb[..., 0].astype(np.float64)
+    g = rgb[..., 1].astype(np.float64)
+    b = rgb[..., 2].astype(np.float64)
+
+    lums = (LUM_WEIGHTS[0] * r) + (LUM_WEIGHTS[1] * g) + (LUM_WEIGHTS[2] * b)
+
+    return(lums.astype(int))
+
+
+def lumUnderBits():
+    # Find the colors whose float luminosity truncates one below the exact
+    # integer result. Only happens when 300r + 590g + 110b is a multiple of
+    # 1000 and the float sum lands just under that whole number.
+    # Returns a bitset indexed by (r << 16) | (g << 8) | b
+    r, g = np.meshgrid(np.arange(256), np.arange(256), indexing="ij")
+    r = r.ravel()
+    g = g.ravel()
+
+    # 30r + 59g + 11b == 0 (mod 100), and 91 is the inverse of 11 (mod 100)
+    b = (-(30 * r + 59 * g) * 91) % 100
+    r = np.tile(r, 3)
+    g = np.tile(g, 3)
+    b = np.concatenate((b, b + 100, b + 200))
+    keep = b < 256
+    rgb = np.stack((r[keep], g[keep], b[keep]), axis=-1)
+
+    exact = (rgb.astype(np.uint32) * LUM_INT_WEIGHTS).sum(axis=-1) // LUM_SCALE
+    under = rgb[floatLuminosities(rgb) < exact].astype(np.uint32)
+
+    keys = (under[:, 0] << 16) | (under[:, 1] << 8) | under[:, 2]
+    bits = np.zeros(1 << 21, dtype=np.uint8)
+    np.bitwise_or.at(bits, keys >> 3, (1 << (keys & 7)).astype(np.uint8))
+
+    return(bits)
+
+
+LUM_UNDER = lumUnderBits()
+
+
+def intLuminosities(rgb):
+    # Calculate the luminosity of every pixel in an [x, y, (r, g, b)] uint8
+    # array with integer table lookups, no float temporaries
+    # NOTE: gives the same results as floatLuminosities()
+    rgb = np.asarray(rgb, dtype=np.uint8)
+    r = rgb[..., 0]
+    g = rgb[..., 1]
+    b = rgb[..., 2]
+
+    n = LUM_TABLES[0][r]
+    n += LUM_TABLES[1][g]
+    n += LUM_TABLES[2][b]
+    lums = n // LUM_SCALE
+
+    # Patch up the few whole-number results the float math truncates low
+    whole = np.nonzero(n == lums * LUM_SCALE)
+    if len(whole[0]):
+        keys = ((r[whole].astype(np.uint32) << 16) |
+                (g[whole].astype(np.uint32) << 8) |
+                b[whole])
+        lums[whole] -= (LUM_UNDER[keys >> 3] >> (keys & 7)) & 1
+
+    return(lums.astype(np.uint8))
+
+
+def luminosities(rgb, mode="int"):
+    # Calculate the luminosity of every pixel in an [x, y, (r, g, b)] array
+    if mode == "int":
+        return(intLuminosities(rgb))
+    elif mode == "float":
+        return(floatLuminosities(rgb))
+    else:
+        raise ValueError("Unknown luminosity mode '" + str(mode) + "', use one of " + str(LUM_MODES))
+
+
+def pixelLum(pixel):
+    # Calculate luminosity of a single (r, g, b) pixel with integer math
+    # NOTE: same result as int((0.3 * r) + (0.59 * g) + (0.11 * b))
+    # NOTE: channels made Python ints, so numpy uint8 pixels can't overflow
+    r, g, b = int(pixel[0]), int(pixel[1]), int(pixel[2])
+    lum, rem = divmod((300 * r) + (590 * g) + (110 * b), LUM_SCALE)
+    if rem == 0:
+        key = (r << 16) | (g << 8) | b
+        lum -= (LUM_UNDER[key >> 3] >> (key & 7)) & 1
+
+    return(int(lum))
+
+
+def maxSaturation(rgb, scale=255):
+    # Force the saturation of every pixel in an [..., (r, g, b)] array to
+    # maximum while keeping its hue and value, the same as
+    #     h, s, v = rgb_to_hsv(r / scale, g / scale, b / scale)
+    #     nr, ng, nb = hsv_to_rgb(h, 1.0, v)
+    #     (int(nr * scale), int(ng * scale), int(nb * scale))
+    # NOTE: same float operations, in the same order, as colorsys, so the
+    #       int() truncation is identical
+    c = np.asarray(rgb, dtype=np.float64) / scale
+    r = c[..., 0]
+    g = c[..., 1]
+    b = c[..., 2]
+
+    # rgb_to_hsv()
+    maxc = c.max(axis=-1)
+    minc = c.min(axis=-1)
+    gray = minc == maxc
+    # NOTE: grays have no hue, avoid dividing by a zero range
+    rangec = np.where(gray, 1.0, maxc - minc)
+    rc = (maxc - r) / rangec
+    gc = (maxc - g) / rangec
+    bc = (maxc - b) / rangec
+    h = np.where(r == maxc, bc - gc,
+                 np.where(g == maxc, 2.0 + rc - bc, 4.0 + gc - rc))
+    h = np.where(gray, 0.0, (h / 6.0) % 1.0)
+    v = maxc
+
+    # hsv_to_rgb() with s = 1.0
+    i = (h * 6.0).astype(int)
+    f = (h * 6.0) - i
+    p = v * 0.0
+    q = v * (1.0 - f)
+    t = v * (1.0 - (1.0 - f))
+    i = i % 6
+
+    # [i, (r, g, b)] choice of v, t, p, q for each hue sector
+    V, T, P, Q = 0, 1, 2, 3
+    sectors = np.array([[V, T, P], [Q, V, P], [P, V, T],
+                        [P, Q, V], [T, P, V], [V, P, Q]])
+    choices = np.stack((v, t, p, q), axis=-1)
+    sat = np.take_along_axis(choices, sectors[i], axis=-1)
+
+    return((sat * scale).astype(int))
+
+
+def paletteArray(palette):
+    # Convert a list of (r, g, b) colors into a [color, (r, g, b)] uint8 array
+    return(np.array([color[:3] for color in palette], dtype=np.uint8).reshape(-1, 3))
+
+
+def renderPalettes(indices, palettes, name="npa"):
+    # Map an [x, y] array of palette indices through a list of palettes in a
+    # single gather, giving one [x, y, palette, (r, g, b)] array
+    # NOTE: indices outside the palettes are reported once and left black
+    pals = [paletteArray(palette) for palette in palettes]
+    for pal in pals:
+        if len(pal) != len(pals[0]):
+            raise ValueError("Palettes must all be the same length")
+
+    # table is [index, palette, (r, g, b)]
+    table = np.stack(pals, axis=1)
+
+    bad = (indices < 0) | (indices >= len(table))
+    if bad.any():
+        where = np.argwhere(bad)
+        x, y = where[0]
+        print("ERROR:", len(where), name, "values outside the palette, first is",
+              name + "[", str(x) + ",", str(y) + "] = ", str(indices[x, y]))
+        rgb = np.take(table, np.where(bad, 0, indices), axis=0)
+        rgb[bad] = 0
+    else:
+        rgb = np.take(table, indices, axis=0)
+
+    return(rgb)
+
+
+def renderPalette(indices, palette, name="npa"):
+    # Map an [x, y] array of palette indices to an [x, y, (r, g, b)] array
+    return(renderPalettes(indices, [palette], name)[:, :, 0])
+
+
+def boxAverage(rgb, size):
+    # Average every size x size box of an [x, y, (r, g, b)] array using a
+    # summed-area table, so the cost per pixel is the same for any box size
+    # The box for [x, y] covers x - size // 2 up to x + size - size // 2 - 1,
+    # (slightly off-center when size is even), same for y
+    # NOTE: pixels whose box would run off the array are left black
+    # NOTE: the table wraps around in uint32, which still gives exact box sums
+    #       as long as a single box sums to less than 2**32
+    w, h = rgb.shape[0], rgb.shape[1]
+    margin = size // 2
+    other_margin = size - margin
+
+    sat = np.zeros((w + 1, h + 1, rgb.shape[2]), dtype=np.uint32)
+    np.cumsum(rgb, axis=0, dtype=np.uint32, out=sat[1:, 1:])
+    np.cumsum(sat[1:, 1:], axis=1, dtype=np.uint32, out=sat[1:, 1:])
+
+    sums = sat[size:, size:] - sat[:-size, size:] - sat[size:, :-size] + sat[:-size, :-size]
+
+    avg = np.zeros(rgb.shape, dtype=np.uint8)
+    avg[margin:w - other_margin + 1, margin:h - other_margin + 1] = sums // (size * size)
+
+    return(avg)
+
+
+def sobelGradients(plane):
+    # Calculate the Sobel gradient of every interior pixel of an [x, y] plane
+    # from shifted slices of the whole plane, r = int(sqrt(r1**2 + r2**2))
+    #     horizontal (r1)     vertical (r2)
+    #     [ 1,  2,  1]        [-1,  0,  1]
+    #     [ 0,  0,  0]        [-2,  0,  2]
+    #     [-1, -2, -1]        [-1,  0,  1]
+    # NOTE: the one pixel frame around the plane is left at 0
+    p = plane.astype(np.int32)
+
+    # neighbors of every interior pixel, named for their [x, y] offsets
+    xmym = p[:-2, :-2]
+    x0ym = p[1:-1, :-2]
+    xpym = p[2:, :-2]
+    xmy0 = p[:-2, 1:-1]
+    xpy0 = p[2:, 1:-1]
+    xmyp = p[:-2, 2:]
+    x0yp = p[1:-1, 2:]
+    xpyp = p[2:, 2:]
+
+    r1 = xmym + (2 * x0ym) + xpym - xmyp - (2 * x0yp) - xpyp
+    r2 = xpym - xmym + (2 * (xpy0 - xmy0)) + xpyp - xmyp
+
+    grads = np.zeros(p.shape, dtype=np.int32)
+    grads[1:-1, 1:-1] = np.sqrt((r1 * r1) + (r2 * r2)).astype(np.int32)
+
+    return(grads)
+
+
+def normalizeGradients(grads, mode="max", percentile=NORM_PERCENTILE, scale=MAX_SOBEL, top=255):
+    # Scale an array of gradients into the range 0 - top,
+    #     norm = int((grad / scale) * top)
+    # mode picks the scale, "max" uses the largest gradient, "percentile"
+    # the given percentile of the gradients, and "fixed" the given scale.
+    # Gradients above the scale are clipped to top, so a few very strong
+    # edges don't squeeze all the others into the bottom of the range.
+    # NOTE: "max" gives the same results as the per-pixel loop it replaces
+    # NOTE: NORM_DTYPE results, unless top doesn't fit
+    grads = np.asarray(grads)
+    if mode == "max":
+        scale = np.max(grads)
+    elif mode == "percentile":
+        scale = np.percentile(grads, percentile)
+    elif mode != "fixed":
+        raise ValueError("Unknown normalization mode '" + str(mode) + "', use one of " + str(NORM_MODES))
+
+    norm = np.zeros(grads.shape, dtype=(NORM_DTYPE if top <= np.iinfo(NORM_DTYPE).max else int))
+    if scale > 0:
+        norm[...] = np.minimum((grads / scale) * top, top)
+
+    return(norm)
+
+
+# Neighbors of a Guo-Hall neighborhood code, p2 - p9 as [x, y] offsets,
+# clockwise from [x, y - 1], p2 is bit 0 of the code and p9 is bit 7
+GUO_HALL_NEIGHBORS = ((0, -1), (1, -1), (1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1))
+
+
+def guoHallTables():
+    # Work out the Guo-Hall delete decision for every possible neighborhood,
+    # one 256 entry table per sub-pass, indexed by neighborhood code
+    # NOTE: the same tests as the per pixel thinningGuoHallIteration()
+    tables = np.zeros((2, 256), dtype=bool)
+    for code in range(256):
+        p2, p3, p4, p5, p6, p7, p8, p9 = [bool((code >> bit) & 1) for bit in range(8)]
+
+        c = (int((not p2) and (p3 or p4)) + int((not p4) and (p5 or p6)) +
+             int((not p6) and (p7 or p8)) + int((not p8) and (p9 or p2)))
+        n1 = int(p9 or p2) + int(p3 or p4) + int(p5 or p6) + int(p7 or p8)
+        n2 = int(p2 or p3) + int(p4 or p5) + int(p6 or p7) + int(p8 or p9)
+        n = min(n1, n2)
+
+        deletable = (c == 1) and (n == 2 or n == 3)
+        tables[0, code] = deletable and not ((p6 or p7 or (not p9)) and p8)
+        tables[1, code] = deletable and not ((p2 or p3 or (not p5)) and p4)
+
+    return(tables)
+
+
+GUO_HALL_DELETE = guoHallTables()
+
+
+def neighborhoodCodes(bools):
+    # Guo-Hall neighborhood code of every interior pixel of an [x, y] boolean
+    # array, one bit per neighbor (see GUO_HALL_NEIGHBORS)
+    # Returns a uint8 array two smaller than bools in each direction
+    b = np.asarray(bools).astype(np.uint8)
+    w, h = b.shape
+
+    codes = np.zeros((w - 2, h - 2), dtype=np.uint8)
+    for bit, (dx, dy) in enumerate(GUO_HALL_NEIGHBORS):
+        codes |= b[1 + dx:w - 1 + dx, 1 + dy:h - 1 + dy] << np.uint8(bit)
+
+    return(codes)
+
+
+def guoHallPass(bools, passNumber):
+    # Do one Guo-Hall thinning sub-pass (passNumber 0 or 1) over a whole
+    # [x, y] boolean array, looking up each pixel's delete decision by its
+    # neighborhood code
+    # NOTE: every pixel is decided from the array as it was before the pass,
+    #       and the one pixel frame is always cleared, same as the per pixel loop
+    bools = np.asarray(bools, dtype=bool)
+    keep = np.zeros(bools.shape, dtype=bool)
+    if min(bools.shape) > 2:
+        keep[1:-1, 1:-1] = ~GUO_HALL_DELETE[passNumber][neighborhoodCodes(bools)]
+
+    return(bools & keep)
@@ -0,0 +1,192 @@
+#
+# nearcolor.py
+#
+# Nearest palette color lookups for whole images, used by the nearest
+# color (--nc) versions.
+#
+# Distinct colors are solved against the whole palette in vectorized
+# blocks, with Manhattan (l1) or Euclidean (l2) distance, and ties going
+# to the first palette entry, the same as the per-pixel loops they replace.
+#
+# A color cube holds the index of the nearest palette color for every
+# (r, g, b) color, so mapping an image is one lookup per pixel. The full
+# 256 level cube gives exact results, smaller cubes quantize each channel
+# first and only approximate them. Cubes are saved to disk, keyed by a
+# hash of the palette, so each palette is only solved once.
+#
+
+import hashlib
+
+import numpy as np
+
+from datetime import datetime
+from pathlib import Path
+
+import kernels
+
+# Distance metrics, Manhattan (|dr| + |dg| + |db|) as in ImageMaker.nearest(),
+# or Euclidean (sqrt(dr**2 + dg**2 + db**2)) as in cli_sobel.nearest()
+METRICS = ("l1", "l2")
+# Cube sizes, the full cube is exact, the quantized cube approximates
+EXACT_LEVELS = 256
+QUANTIZED_LEVELS = 32
+# Default directory for saved color cubes
+CUBE_DIR = "colorcubes"
+# Number of colors solved together by nearestIndices()
+BLOCK_SIZE = 4096
+
+
+def channelDistances(values, pal, metric):
+    # Distance along one channel between each value and each palette entry,
+    # as a [value, palette entry] table
+    # NOTE: l2 tables hold squared distances, which sum and compare exactly
+    diff = values[:, None].astype(np.int32) - pal[None, :].astype(np.int32)
+    if metric == "l1":
+        return(np.abs(diff))
+    elif metric == "l2":
+        return(diff * diff)
+    else:
+        raise ValueError("Unknown metric '" + str(metric) + "', use one of " + str(METRICS))
+
+
+def outOfRange(dist, limit, metric):
+    # True where a nearest distance is not below limit
+    if metric == "l2":
+        return(np.sqrt(dist) >= limit)
+
+    return(dist >= limit)
+
+
+def nearestIndex(color, pal, metric="l1", limit=None):
+    # Find the nearest index of a single (r, g, b) color in a palette array,
+    # with the same ties and limit as nearestIndices()
+    diff = pal.astype(np.int32) - np.asarray(color[:3], dtype=np.int32)
+    if metric == "l1":
+        dist = np.abs(diff).sum(axis=-1)
+    elif metric == "l2":
+        dist = (diff * diff).sum(axis=-1)
+    else:
+        raise ValueError("Unknown metric '" + str(metric) + "', use one of " + str(METRICS))
+
+    near = int(dist.argmin())
+    if (limit is not None) and outOfRange(dist[near], limit, metric):
+        near = len(pal)
+
+    return(near)
+
+
+def nearestIndices(colors, palette, metric="l1", limit=None):
+    # Find the nearest palette index of each (r, g, b) row of colors,
+    # solving BLOCK_SIZE colors at a time
+    # Ties go to the first palette entry. If limit is given, colors with no
+    # palette entry closer than limit get index len(palette) instead.
+    pal = kernels.paletteArray(palette)
+    colors = np.asarray(colors)
+    if len(colors) == 1:
+        # NOTE: single colors skip the unique colors and blocking
+        return(np.array([nearestIndex(colors[0], pal, metric, limit)], dtype=np.intp))
+
+    near = np.empty(len(colors), dtype=np.intp)
+    for start in range(0, len(colors), BLOCK_SIZE):
+        block = colors[start:start + BLOCK_SIZE]
+        dist = channelDistances(block[:, 0], pal[:, 0], metric)
+        dist += channelDistances(block[:, 1], pal[:, 1], metric)
+        dist += channelDistances(block[:, 2], pal[:, 2], metric)
+        blockNear = dist.argmin(axis=-1)
+        if limit is not None:
+            nearDist = np.take_along_axis(dist, blockNear[:, None], axis=-1)[:, 0]
+            blockNear[outOfRange(nearDist, limit, metric)] = len(pal)
+        near[start:start + BLOCK_SIZE] = blockNear
+
+    return(near)
+
+
+def nearestColors(rgb, palette, metric="l1", limit=None):
+    # Find the nearest palette index of every pixel of an [x, y, (r, g, b)]
+    # array, solving each distinct color only once
+    keys = ((rgb[..., 0].astype(np.uint32) << 16) |
+            (rgb[..., 1].astype(np.uint32) << 8) |
+            rgb[..., 2])
+    uniqueKeys, inverse = np.unique(keys, return_inverse=True)
+    uniqueColors = np.stack(((uniqueKeys >> 16) & 0xFF,
+                             (uniqueKeys >> 8) & 0xFF,
+                             uniqueKeys & 0xFF), axis=-1)
+
+    near = nearestIndices(uniqueColors, palette, metric, limit)
+
+    return(near[inverse].reshape(keys.shape))
+
+
+def cubeValues(levels):
+    # Channel values represented by each level of a cube
+    # NOTE: quantized levels use the middle of the range they cover
+    step = 256 // levels
+    values = np.arange(levels) * step
+    if levels < 256:
+        values += step // 2
+
+    return(values)
+
+
+def colorCube(palette, levels=EXACT_LEVELS, limit=None, metric="l1"):
+    # Build a [r, g, b] cube of nearest palette indices
+    # Ties go to the first palette entry. If limit is given, colors with no
+    # palette entry closer than limit get index len(palette) instead.
+    pal = kernels.paletteArray(palette)
+    values = cubeValues(levels)
+
+    # per channel distance tables, [channel value, palette entry]
+    rDist = channelDistances(values, pal[:, 0], metric)
+    gDist = channelDistances(values, pal[:, 1], metric)
+    bDist = channelDistances(values, pal[:, 2], metric)
+    if metric == "l1":
+        # NOTE: l1 distances fit in int16, halving the size of each slab
+        rDist, gDist, bDist = rDist.astype(np.int16), gDist.astype(np.int16), bDist.astype(np.int16)
+
+    # one red slab at a time, distances are [g, b, palette entry]
+    cube = np.empty((levels, levels, levels), dtype=np.uint16)
+    for r in range(levels):
+        dist = gDist[:, None, :] + bDist[None, :, :]
+        dist += rDist[r]
+        near = dist.argmin(axis=-1)
+        if limit is not None:
+            nearDist = np.take_along_axis(dist, near[..., None], axis=-1)[..., 0]
+            near[outOfRange(nearDist, limit, metric)] = len(pal)
+        cube[r] = near
+
+    if cube.max() < 256:
+        cube = cube.astype(np.uint8)
+
+    return(cube)
+
+
+def paletteHash(palette):
+    # Short hash identifying a palette's colors
+    return(hashlib.sha1(kernels.paletteArray(palette).tobytes()).hexdigest()[:16])
+
+
+def getColorCube(palette, levels=EXACT_LEVELS, limit=None, metric="l1", cubeDir=CUBE_DIR):
+    # Read the saved color cube for this palette, or build and save it
+    name = "cube_" + metric + "_" + str(levels) + "_" + str(limit) + "_" + paletteHash(palette) + ".npy"
+    cubePath = Path(cubeDir) / name
+    if cubePath.exists():
+        cube = np.load(cubePath)
+        print(str(datetime.now()), "Using saved color cube:", str(cubePath))
+    else:
+        cube = colorCube(palette, levels, limit, metric)
+        cubePath.parent.mkdir(parents=True, exist_ok=True)
+        np.save(cubePath, cube)
+        print(str(datetime.now()), "Saved color cube:", str(cubePath))
+
+    return(cube)
+
+
+def cubeIndices(rgb, cube):
+    # Look up the nearest palette index of every pixel of an
+    # [x, y, (r, g, b)] array in a color cube, one gather per pixel
+    shift = 8 - (cube.shape[0].bit_length() - 1)
+    r = rgb[..., 0] >> shift
+    g = rgb[..., 1] >> shift
+    b = rgb[..., 2] >> shift
+
+    return(cube[r, g, b])
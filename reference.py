@@ -0,0 +1,334 @@
+#
+# reference.py
+#
+# The original per pixel versions of the image operations that kernels.py,
+# nearcolor.py, and friends replaced with whole array versions, kept as they
+# were so the faster versions can be checked against them (see cli_golden.py).
+#
+# ImageMaker.py, cli_sobel.py, and cli_thinning.py use them in place of the
+# faster versions with --backend reference, for tracking down a difference
+# in a full run. Slow, especially on large images, which is the point.
+#
+# NOTE: arrays are indexed [x, y], the same as the images
+#
+
+from PIL import Image
+
+import numpy as np
+
+# Backends the programs can run with
+BACKENDS = ("fast", "reference")
+# maximum color brightness
+MAX_COLOR = 255
+# default background
+BACKGROUND = (0, 0, 0, 255)
+# useful colors
+WHITE = (MAX_COLOR, MAX_COLOR, MAX_COLOR)
+# greatest Manhattan (l1) distance ImageMaker.py's nearest() will match
+MAX_CDIST = 443
+# greatest Euclidean (l2) distance cli_sobel.py's nearest() will match
+# (distance between black and white, plus 1)
+MAX_L2_CDIST = int(((255 * 255) + (255 * 255) + (255 * 255))**0.5) + 1
+
+# Current backend, see configure()
+settings = {"backend": "fast"}
+
+
+def configure(backend="fast"):
+    # Set the backend, "fast" for the whole array versions, or "reference"
+    # for the per pixel versions in this file
+    if backend not in BACKENDS:
+        raise ValueError("Unknown backend '" + str(backend) + "', use one of " + str(BACKENDS))
+
+    settings["backend"] = backend
+
+
+def active():
+    # True if the reference backend is selected
+    return(settings["backend"] == "reference")
+
+
+def get_lum(pixel):
+    # Calculate luminosity of an (r, g, b) pixel
+    # gray level = 0.3r + 0.59g + 0.11b
+    return(int((0.3 * pixel[0]) + (0.59 * pixel[1]) + (0.11 * pixel[2])))
+
+
+def luminosities(im, lums, border=0):
+    # Calculate the luminosity of every pixel in im inside the border area
+    for x in range(border, im.size[0] - border):
+        for y in range(border, im.size[1] - border):
+            lums[x, y] = get_lum(im.getpixel((x, y)))
+
+
+def get_av(im, x, y):
+    # Calculate the average pixel value of a 3x3 square of pixels
+    # centered on x, y
+    # NOTE: Does no bounds checking
+    r, g, b = 0, 0, 0
+    x_range = range(x - 1, x + 2)
+    y_range = range(y - 1, y + 2)
+    for newX in x_range:
+        for newY in y_range:
+            pixel = im.getpixel((newX, newY))
+            r += pixel[0]
+            g += pixel[1]
+            b += pixel[2]
+
+    return((int(r / 9), int(g / 9), int(b / 9)))
+
+
+def smoothImage(im, border=0):
+    # Create a smoothed image by averaging the 3x3 box centered on each
+    # pixel inside the border area
+    # NOTE: returns the full size image, border included
+    newIm = Image.new('RGB', im.size, BACKGROUND)
+    pixels = newIm.load()
+
+    for x in range(border, im.size[0] - border):
+        for y in range(border, im.size[1] - border):
+            pixels[x, y] = get_av(im, x, y)
+
+    return(newIm)
+
+
+def sobel_hPlane(im, x, y):
+    # Apply horizontal Sobel mask on a single color plane.
+    #     [ 1,  2,  1]
+    #     [ 0,  0,  0]
+    #     [-1, -2, -1]
+    v = im.getpixel((x - 1, y - 1))[0]
+    v += 2 * im.getpixel((x, y - 1))[0]
+    v += im.getpixel((x + 1, y - 1))[0]
+    v -= im.getpixel((x - 1, y + 1))[0]
+    v -= 2 * im.getpixel((x, y + 1))[0]
+    v -= im.getpixel((x + 1, y + 1))[0]
+
+    return(v)
+
+
+def sobel_vPlane(im, x, y):
+    # Apply vertical Sobel mask on a single color plane.
+    #     [-1,  0,  1]
+    #     [-2,  0,  2]
+    #     [-1,  0,  1]
+    v = 0
+    v -= im.getpixel((x - 1, y - 1))[0]
+    v += im.getpixel((x + 1, y - 1))[0]
+    v -= 2 * im.getpixel((x - 1, y))[0]
+    v += 2 * im.getpixel((x + 1, y))[0]
+    v -= im.getpixel((x - 1, y + 1))[0]
+    v += im.getpixel((x + 1, y + 1))[0]
+
+    return(v)
+
+
+def sobel(im, x, y):
+    # Calculate Sobel gradient for a pixel
+    r1 = sobel_hPlane(im, x, y)
+    r2 = sobel_vPlane(im, x, y)
+
+    # Sobel gradient r = sqrt(r1**2 + r2**2)
+    return(int(((r1 * r1) + (r2 * r2))**0.5))
+
+
+def sobelEdges(im, edges, border=0):
+    # Fill an edges array with the calculated sobel edge gradient
+    for x in range(border, im.size[0] - (2 * border)):
+        for y in range(border, im.size[1] - (2 * border)):
+            edges[x, y] = sobel(im, x, y)
+
+
+def nearestL1(pixel, palette):
+    # find the color in the palette closest to the original pixel color,
+    # by Manhattan distance, as ImageMaker.py does
+    ncDist = MAX_CDIST
+    ncColor = WHITE
+    for color in palette:
+        rDist = abs(pixel[0] - color[0])
+        gDist = abs(pixel[1] - color[1])
+        bDist = abs(pixel[2] - color[2])
+        tmpDist = rDist + gDist + bDist
+        if tmpDist < ncDist:
+            ncDist = tmpDist
+            ncColor = color
+
+    return(ncColor)
+
+
+def nearestL2(pixel, palette):
+    # find the color in the palette closest to the original pixel color,
+    # by Euclidean distance, as cli_sobel.py does
+    ncDist = MAX_L2_CDIST
+    ncColor = WHITE
+    for color in palette:
+        rDist = pixel[0] - color[0]
+        gDist = pixel[1] - color[1]
+        bDist = pixel[2] - color[2]
+        tmpDist = ((rDist * rDist) + (gDist * gDist) + (bDist * bDist))**0.5
+        if tmpDist < ncDist:
+            ncDist = tmpDist
+            ncColor = color
+
+    return(ncColor)
+
+
+def nearestImage(oIm, colors, metric="l1"):
+    # Create an image from the nearest palette colors to the original colors,
+    # metric is "l1" (ImageMaker.py) or "l2" (cli_sobel.py)
+    nearest = nearestL1 if metric == "l1" else nearestL2
+    oImPixels = oIm.load()
+    ncIm = Image.new('RGB', oIm.size, BACKGROUND)
+    ncImPixels = ncIm.load()
+
+    mcDict = dict()
+    for x in range(ncIm.size[0]):
+        for y in range(ncIm.size[1]):
+            pixel = oImPixels[x, y]
+            if pixel in mcDict:
+                # know closest color to this pixel, use look up to cut down on computation
+                ncImPixels[x, y] = mcDict[pixel]
+            else:
+                # haven't found closest color to this pixel yet, calculate it
+                color = nearest(pixel, colors)
+                ncImPixels[x, y] = color
+                # and save what we just calculated in a lookup table
+                mcDict[pixel] = color
+
+    return(ncIm)
+
+
+def mainComponent(color):
+    # return masked version of largest component of color
+    # NOTE: on =, g>r, b>r, b>g, ie: yellow->green, magenta->blue, white,cyan->blue
+    r, g, b = color
+    if r > g:
+        if r > b:
+            return(((r & 0xF0), 0, 0))
+        else:
+            return((0, 0, (b * 0xF0)))
+    else:
+        if g > b:
+            return((0, (g & 0xF0), 0))
+        else:
+            return((0, 0, (b & 0xF0)))
+
+
+def crossStitch(oIm, colors):
+    # Create the pseudo-cross stitch image, one 5x5 stitch per 5x5 block
+    # of the original image, colored by the luminosity of the block's 3x3 center
+    # NOTE: the blue totals pick up two green values, as they always have
+    xs_x = int(((oIm.size[0] + 4) // 5) * 5)
+    xs_y = int(((oIm.size[1] + 4) // 5) * 5)
+    xs_size = (xs_x, xs_y)
+
+    xsIm = Image.new("RGB", xs_size, BACKGROUND)
+    xsPixels = xsIm.load()
+    im = Image.new("RGB", xs_size, BACKGROUND)
+    im.paste(oIm, (0, 0))
+    imPixels = im.load()
+
+    x = 0
+    while x < xsIm.size[0]:
+        y = 0
+        while y < xsIm.size[1]:
+            rTotal = (imPixels[x+1,y+1][0] + imPixels[x+2,y+1][0] + imPixels[x+3,y+1][0] +
+                      imPixels[x+1,y+2][0] + imPixels[x+2,y+2][0] + imPixels[x+3,y+2][0] +
+                      imPixels[x+1,y+3][0] + imPixels[x+2,y+3][0] + imPixels[x+3,y+3][0])
+            gTotal = (imPixels[x+1,y+1][1] + imPixels[x+2,y+1][1] + imPixels[x+3,y+1][1] +
+                      imPixels[x+1,y+2][1] + imPixels[x+2,y+2][1] + imPixels[x+3,y+2][1] +
+                      imPixels[x+1,y+3][1] + imPixels[x+2,y+3][1] + imPixels[x+3,y+3][1])
+            bTotal = (imPixels[x+1,y+1][2] + imPixels[x+2,y+1][2] + imPixels[x+3,y+1][2] +
+                      imPixels[x+1,y+2][2] + imPixels[x+2,y+2][1] + imPixels[x+3,y+2][2] +
+                      imPixels[x+1,y+3][2] + imPixels[x+2,y+3][1] + imPixels[x+3,y+3][2])
+            newR = rTotal // 9
+            newG = gTotal // 9
+            newB = bTotal // 9
+            lum = get_lum((newR, newG, newB))
+            color = colors[lum]
+            xs_color = mainComponent(color)
+            # corners of the X, then the stitch, then the rest of the block
+            xsPixels[x,y] = xsPixels[x+4,y] = xsPixels[x,y+4] = xsPixels[x+4,y+4] = color
+            xsPixels[x+1,y+1] = xsPixels[x+3,y+1] = xs_color
+            xsPixels[x+2,y+2] = xs_color
+            xsPixels[x+1,y+3] = xsPixels[x+3,y+3] = xs_color
+            xsPixels[x+1,y] = xsPixels[x+2,y] = xsPixels[x+3, y] = color
+            xsPixels[x,y+1] = xsPixels[x+2,y+1] = xsPixels[x+4,y+1] = color
+            xsPixels[x,y+2] = xsPixels[x+1,y+2] = xsPixels[x+3,y+2] = xsPixels[x+4,y+2] = color
+            xsPixels[x,y+3] = xsPixels[x+2,y+3] = xsPixels[x+4,y+3] = color
+            xsPixels[x+1,y+4] = xsPixels[x+2,y+4] = xsPixels[x+3,y+4] = color
+            y += 5
+        x += 5
+
+    return(xsIm)
+
+
+def thresholdGradients(gradients, th):
+    # Mark the gradients above the threshhold
+    shape = gradients.shape
+    gradientBools = np.zeros(shape).astype(bool)
+
+    for x in range(shape[0]):
+        for y in range(shape[1]):
+            if gradients[x, y] > th:
+                gradientBools[x, y] = True
+
+    return(gradientBools)
+
+
+def thinningIteration(gradients, passNumber):
+    # Do a Guo-Hall thinning pass on a boolean gradients matrix
+    # passNumber = 0 for first pass, 1 for second pass
+    marker = np.zeros(gradients.shape).astype(bool)
+
+    for x in range(1, gradients.shape[0] - 1):
+        for y in range(1, gradients.shape[1] - 1):
+            p2 = gradients[x, y - 1]
+            p3 = gradients[x + 1, y - 1]
+            p4 = gradients[x + 1, y]
+            p5 = gradients[x + 1, y + 1]
+            p6 = gradients[x, y + 1]
+            p7 = gradients[x - 1, y + 1]
+            p8 = gradients[x - 1, y]
+            p9 = gradients[x - 1, y - 1]
+
+            ca = 1 if ((not p2) and (p3 or p4)) else 0
+            cb = 1 if ((not p4) and (p5 or p6)) else 0
+            cc = 1 if ((not p6) and (p7 or p8)) else 0
+            cd = 1 if ((not p8) and (p9 or p2)) else 0
+            c = ca + cb + cc + cd
+
+            n1a = 1 if (p9 or p2) else 0
+            n1b = 1 if (p3 or p4) else 0
+            n1c = 1 if (p5 or p6) else 0
+            n1d = 1 if (p7 or p8) else 0
+            n1 = n1a + n1b + n1c + n1d
+
+            n2a = 1 if (p2 or p3) else 0
+            n2b = 1 if (p4 or p5) else 0
+            n2c = 1 if (p6 or p7) else 0
+            n2d = 1 if (p8 or p9) else 0
+            n2 = n2a + n2b + n2c + n2d
+
+            n = min(n1, n2)
+
+            if passNumber == 0:
+                m = (p6 or p7 or (not p9)) and p8
+            else:
+                m = (p2 or p3 or (not p5)) and p4
+
+            # clear the gradient where it can go, keep it everywhere else
+            marker[x, y] = not ((c == 1) and (n == 2 or n == 3) and (not m))
+
+    return(np.logical_and(gradients, marker))
+
+
+def maskGradients(gradients, gradientBools):
+    # Keep the gradients where gradientBools is set, zero elsewhere
+    finalMask = np.zeros(gradients.shape, dtype=gradients.dtype)
+    for x in range(gradientBools.shape[0]):
+        for y in range(gradientBools.shape[1]):
+            if gradientBools[x, y]:
+                finalMask[x, y] = gradients[x, y]
+
+    return(finalMask)
@@ -0,0 +1,352 @@
+#
+# stagecache.py
+#
+# Content addressed cache for the intermediate results (luminosities,
+# smoothed images, and edge gradients) of ImageMaker.py, cli_sobel.py, and
+# cli_edges.py.
+#
+# Each result is saved under a key hashed from the contents of its input,
+# the stage name, the stage parameters, and the code version, so a changed
+# input or setting never picks up stale results, and results are reused
+# from one day to the next. The cache directory is kept under a size limit
+# by removing the least recently used results first.
+#
+# Results are written to a temporary file which is then renamed into place,
+# along with a checksum and size that are verified before a result is used,
+# so a crash never leaves a partial result behind to be picked up by a later
+# run. Each result's checksum is checked the first time it is used in a
+# run, later uses of the unchanged file (eg: memory mapped again by another
+# stage) skip reading the whole file again.
+#
+
+import hashlib
+import inspect
+import json
+import os
+import zlib
+
+import numpy as np
+
+from datetime import datetime
+from pathlib import Path
+from PIL import Image
+
+import kernels
+import reference
+
+# Default cache directory
+CACHE_DIR = "stagecache"
+# Default cache size limit, in megabytes
+CACHE_MB = 1024
+# Bump when a stage's results change without its code changing
+CACHE_VERSION = 1
+# Extension of the checksum file saved alongside each result
+CHECKSUM_EXT = ".crc"
+# Extension of the file recording which result an exported file holds
+EXPORT_EXT = ".key"
+# Size of the blocks read when calculating checksums
+CHECKSUM_BLOCK = 1 << 20
+# Marks a temporary file, followed by the process id writing it, see tempPath()
+TEMP_EXT = ".tmp"
+# Age in seconds after which a temporary file is left over, even if the
+# process id that wrote it is in use again
+TEMP_AGE = 24 * 60 * 60
+
+# Code version, changes whenever kernels.py, reference.py, or CACHE_VERSION
+# does, the stages' own code is added to each key, see codeHash()
+CODE_VERSION = hashlib.sha1(Path(kernels.__file__).read_bytes() +
+                            Path(reference.__file__).read_bytes() +
+                            str(CACHE_VERSION).encode()).hexdigest()[:16]
+
+# Current cache settings, see configure()
+settings = {"root": CACHE_DIR, "maxBytes": CACHE_MB * 1024 * 1024, "mmap": True}
+# Cache lookups so far this run, see stagetrace.py
+counts = {"hits": 0, "misses": 0}
+# Hashes of stage code, see codeHash()
+codeHashes = dict()
+# Results whose checksum was checked this run, and the file's state when it
+# was, see verify()
+verified = dict()
+
+
+def configure(root=CACHE_DIR, maxMB=CACHE_MB, mmap=True):
+    # Set the cache directory and size limit, and whether cached arrays are
+    # memory mapped (True) or read in full (False)
+    # NOTE: also trims the cache, in case the limit went down
+    settings["root"] = root
+    settings["maxBytes"] = int(maxMB * 1024 * 1024)
+    settings["mmap"] = mmap
+    evict()
+
+
+def dataHash(data):
+    # Hash the contents of an image or array, including its size and type
+    h = hashlib.sha1()
+    if isinstance(data, Image.Image):
+        h.update((data.mode + str(data.size)).encode())
+        h.update(data.tobytes())
+    else:
+        data = np.ascontiguousarray(data)
+        h.update((str(data.dtype) + str(data.shape)).encode())
+        h.update(data.data)
+
+    return(h.hexdigest())
+
+
+def codeHash(*code):
+    # Hash the code a stage runs, functions by their source, and anything
+    # else as a file path (eg: a script whose stages aren't functions)
+    # NOTE: whatever they call in kernels.py and reference.py is covered
+    #       by CODE_VERSION
+    h = hashlib.sha1()
+    for part in code:
+        if part not in codeHashes:
+            if callable(part):
+                codeHashes[part] = hashlib.sha1(inspect.getsource(part).encode()).hexdigest()
+            else:
+                codeHashes[part] = hashlib.sha1(Path(part).read_bytes()).hexdigest()
+        h.update(codeHashes[part].encode())
+
+    return(h.hexdigest()[:16])
+
+
+def stageKey(stage, inputHash, params, code=()):
+    # Key for the result of a stage on an input with the given parameters,
+    # run by the given code (see codeHash()), so changing the stage's code
+    # never picks up results from before
+    text = json.dumps([stage, inputHash, params, CODE_VERSION, codeHash(*code)], sort_keys=True)
+
+    return(hashlib.sha1(text.encode()).hexdigest())
+
+
+def cachePath(stage, key, ext):
+    # Path of a cached result, grouped into a directory per stage
+    return(Path(settings["root"]) / stage / (key + ext))
+
+
+def fileChecksum(path):
+    # CRC-32 of a file's contents, as a hex string
+    crc = 0
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(CHECKSUM_BLOCK), b""):
+            crc = zlib.crc32(block, crc)
+
+    return("{:08x}".format(crc))
+
+
+def checksumPath(path):
+    # Path of the checksum file for a cached result
+    return(path.with_name(path.name + CHECKSUM_EXT))
+
+
+def fileState(path):
+    # A file's inode, size, and modification time, which change whenever the
+    # file is replaced or written to
+    stat = path.stat()
+
+    return((stat.st_ino, stat.st_size, stat.st_mtime_ns))
+
+
+def verify(path):
+    # True if a cached result exists and matches its checksum and size, a
+    # damaged result (eg: from a crash) is removed so it gets calculated again
+    # NOTE: the checksum reads the whole file, so it is only checked once a
+    #       run for each unchanged file
+    if not path.exists():
+        return(False)
+    if verified.get(path) == fileState(path):
+        return(True)
+
+    crcPath = checksumPath(path)
+    if crcPath.exists():
+        saved = crcPath.read_text().split()
+        # NOTE: older checksum files have no size, and only get the checksum
+        sizeOk = (len(saved) < 2) or (saved[1] == str(path.stat().st_size))
+        if sizeOk and saved and (saved[0] == fileChecksum(path)):
+            verified[path] = fileState(path)
+            return(True)
+
+    print(str(datetime.now()), "Cached result", str(path), "is damaged, removing it.")
+    remove(path)
+
+    return(False)
+
+
+def tempPath(path):
+    # Temporary path to write a result to, before renaming it into place
+    return(path.with_name(path.name + TEMP_EXT + str(os.getpid())))
+
+
+def processAlive(pid):
+    # True if a process id is in use
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return(False)
+    except OSError:
+        # NOTE: eg: another user's process
+        return(True)
+
+    return(True)
+
+
+def staleTemp(path):
+    # True if a temporary file is left over from a process that is gone (eg:
+    # killed mid write), rather than being written by another run right now
+    pid = path.name.rpartition(TEMP_EXT)[2]
+    if not pid.isdigit():
+        return(False)
+
+    return((not processAlive(int(pid))) or (datetime.now().timestamp() - path.stat().st_mtime > TEMP_AGE))
+
+
+def replace(tmpPath, path):
+    # Rename a finished temporary file into place, after its checksum and size
+    # NOTE: a crash between the two renames leaves a result that fails
+    #       verify(), and is calculated again
+    crcTmpPath = tempPath(checksumPath(path))
+    with open(crcTmpPath, "w") as fp:
+        fp.write(fileChecksum(tmpPath) + " " + str(tmpPath.stat().st_size) + "\n")
+        fp.flush()
+        os.fsync(fp.fileno())
+
+    os.replace(tmpPath, path)
+    os.replace(crcTmpPath, checksumPath(path))
+    verified[path] = fileState(path)
+
+
+def loadArray(stage, key, dtype=None):
+    # Read a cached array, or None if it isn't cached
+    # If dtype is given, arrays saved with another type (eg: older int64
+    # files) are converted to it
+    # NOTE: memory mapped copy-on-write unless configured otherwise, so only
+    #       the parts actually used are read, and changes never reach the file
+    path = cachePath(stage, key, ".npy")
+    if not verify(path):
+        counts["misses"] += 1
+        return(None)
+
+    counts["hits"] += 1
+    data = np.load(path, mmap_mode=("c" if settings["mmap"] else None))
+    touch(path)
+    print(str(datetime.now()), "Using cached", stage + ":", str(path))
+    if (dtype is not None) and (data.dtype != dtype):
+        print(str(datetime.now()), "Converting cached", stage, "from", str(data.dtype), "to", np.dtype(dtype).name)
+        data = data.astype(dtype)
+
+    return(data)
+
+
+def saveArray(stage, key, data):
+    # Cache an array
+    path = cachePath(stage, key, ".npy")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmpPath = tempPath(path)
+    with open(tmpPath, "wb") as fp:
+        np.save(fp, data)
+        fp.flush()
+        os.fsync(fp.fileno())
+    replace(tmpPath, path)
+    evict(path)
+
+
+def exportStamp(path, key):
+    # What an export key file holds, the result's key, and the exported
+    # file's size and modification time, so a file changed since is noticed
+    stat = path.stat()
+
+    return(key + " " + str(stat.st_size) + " " + str(stat.st_mtime_ns))
+
+
+def exportArray(key, data, name):
+    # Write a result to a named .npy file for other programs (eg: the dated
+    # luminosity file), unless the file already holds it
+    # Returns True if the file was written
+    # NOTE: rewriting an unchanged file would read all of a memory mapped result
+    # NOTE: written to a temporary file and renamed into place before its key
+    #       file, so a crash leaves either the old file or one that no longer
+    #       matches its key file, which is written again next time
+    path = Path(name)
+    keyPath = path.with_name(path.name + EXPORT_EXT)
+    if path.exists() and keyPath.exists() and (keyPath.read_text().strip() == exportStamp(path, key)):
+        return(False)
+
+    tmpPath = tempPath(path)
+    with open(tmpPath, "wb") as fp:
+        np.save(fp, data)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmpPath, path)
+
+    keyTmpPath = tempPath(keyPath)
+    with open(keyTmpPath, "w") as fp:
+        fp.write(exportStamp(path, key) + "\n")
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(keyTmpPath, keyPath)
+
+    return(True)
+
+
+def loadImage(stage, key):
+    # Read a cached image, or None if it isn't cached
+    data = loadArray(stage, key)
+    if data is None:
+        return(None)
+
+    return(kernels.arrayImage(data))
+
+
+def saveImage(stage, key, im):
+    # Cache an image
+    # NOTE: saved as a raw .npy array, lossless and quick to read and write
+    saveArray(stage, key, kernels.imageArray(im))
+
+
+def remove(path):
+    # Remove a cached result and its checksum
+    verified.pop(path, None)
+    for oldPath in (path, checksumPath(path)):
+        if oldPath.exists():
+            oldPath.unlink()
+
+
+def touch(path):
+    # Mark a cached result as the most recently used
+    # NOTE: keeps a checked result checked, see verify()
+    checked = (verified.get(path) == fileState(path))
+    os.utime(path)
+    if checked:
+        verified[path] = fileState(path)
+
+
+def evict(keep=None):
+    # Remove the least recently used results until the cache fits in its
+    # size limit, never removing keep (the result just saved)
+    # NOTE: checksum files are removed along with their results, and are
+    #       small enough to leave out of the total, temporary files being
+    #       written by other runs are left alone, and left over ones removed
+    results = list()
+    for path in Path(settings["root"]).glob("*/*"):
+        try:
+            if TEMP_EXT in path.name:
+                if staleTemp(path):
+                    path.unlink()
+                    print(str(datetime.now()), "Removed left over temporary file:", str(path))
+            elif path.suffix == ".npy":
+                stat = path.stat()
+                results.append((stat.st_mtime, stat.st_size, path))
+        except FileNotFoundError:
+            # NOTE: renamed into place or removed by another run meanwhile
+            continue
+
+    total = sum(result[1] for result in results)
+    for mtime, size, path in sorted(results):
+        if total <= settings["maxBytes"]:
+            break
+        if path == keep:
+            continue
+
+        remove(path)
+        total -= size
+        print(str(datetime.now()), "Evicted cached result:", str(path))
@@ -0,0 +1,336 @@
+#
+# stagetrace.py
+#
+# Stage level timing and memory instrumentation for ImageMaker.py,
+# cli_sobel.py, cli_edges.py, and cli_thinning.py.
+#
+# Each stage of a run is bracketed by begin() and end(), which record its
+# wall and CPU time, peak memory, bytes read and written, and intermediate
+# results cache hits and misses. end() also prints the stage's log message,
+# in place of the usual print(str(datetime.now()), "... done.") line.
+#
+# The stages are written to a JSON or CSV trace file (if one was asked for),
+# and summarized in a table, when the run exits.
+#
+# Peak memory is either the process's peak resident set size (rss), which is
+# cheap but only ever goes up over a run, or the peak memory allocated during
+# the stage itself (tracemalloc), which is exact but slows the per pixel loops.
+# Bytes read and written are the process's read and write calls (Linux only),
+# memory mapped cache files are not counted.
+#
+# Stages can also be profiled, one cProfile file per stage (for pstats or
+# snakeviz), optionally with a sampled collapsed stack file per stage (for
+# flamegraph.pl, speedscope, and the like). Nothing is profiled unless asked.
+#
+
+import atexit
+import cProfile
+import csv
+import json
+import os
+import re
+import sys
+import threading
+import time
+import tracemalloc
+
+from datetime import datetime
+from pathlib import Path
+
+import stagecache
+
+try:
+    import resource
+except ImportError:
+    # NOTE: not available on Windows, peak rss is left blank there
+    resource = None
+
+# Peak memory measurements
+MEMORY_MODES = ("rss", "tracemalloc")
+# Trace file fields, in order
+FIELDS = ("stage", "depth", "start", "wall", "cpu", "peakBytes",
+          "readBytes", "writeBytes", "cacheHits", "cacheMisses", "cache")
+# Bytes per megabyte, for the summary table
+MB = 1024 * 1024
+# Seconds between collapsed stack samples
+SAMPLE_INTERVAL = 0.001
+
+# Current trace settings, see configure()
+settings = {"path": None, "memory": "rss", "script": None, "args": None,
+            "started": datetime.now(), "finished": False,
+            "profileDir": None, "collapsed": False}
+# Finished stages, in the order they ended
+stages = list()
+# Stages begun but not yet ended, innermost last
+running = list()
+
+
+def configure(path=None, memory="rss", script=None, args=None):
+    # Set the trace file (.csv for CSV, anything else for JSON, or None for
+    # the summary table only), how peak memory is measured, and the script
+    # and arguments recorded in the trace
+    if memory not in MEMORY_MODES:
+        raise ValueError("Unknown memory mode '" + str(memory) + "', use one of " + str(MEMORY_MODES))
+
+    settings["path"] = path
+    settings["memory"] = memory
+    settings["script"] = script
+    settings["args"] = args
+    settings["started"] = datetime.now()
+    if memory == "tracemalloc" and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+    atexit.register(finish)
+
+
+def configureProfile(profileDir=None, collapsed=False):
+    # Profile each stage into profileDir (None for no profiling), and if
+    # collapsed, also sample each stage's stacks into a collapsed stack file
+    settings["profileDir"] = profileDir
+    settings["collapsed"] = collapsed and (profileDir is not None)
+    if profileDir is not None:
+        Path(profileDir).mkdir(parents=True, exist_ok=True)
+
+
+def profilePath(name, ext):
+    # Path of a stage's profile file, numbered in the order stages ended
+    safeName = re.sub(r"[^\w.-]+", "_", name)
+
+    return(Path(settings["profileDir"]) / ("{:02d}_".format(len(stages)) + safeName + ext))
+
+
+def frameName(frame):
+    # Collapsed stack name of a frame, file:function
+    return(Path(frame.f_code.co_filename).name + ":" + frame.f_code.co_name)
+
+
+def sampleStacks(threadId, samples, stop):
+    # Count the stacks of a thread every SAMPLE_INTERVAL seconds, until stop is set
+    # NOTE: runs in its own thread, and only gets the interpreter lock between
+    #       the sampled thread's bytecodes, so long C calls show as one sample
+    while not stop.wait(SAMPLE_INTERVAL):
+        frame = sys._current_frames().get(threadId)
+        stack = list()
+        while frame is not None:
+            stack.append(frameName(frame))
+            frame = frame.f_back
+        if stack:
+            key = ";".join(reversed(stack))
+            samples[key] = samples.get(key, 0) + 1
+
+
+def startProfile(stage):
+    # Start profiling a stage, pausing the stage it's nested in
+    # NOTE: only one cProfile profiler can be active at a time, so an outer
+    #       stage's profile leaves out the stages nested inside it
+    if running and running[-1]["profiler"] is not None:
+        running[-1]["profiler"].disable()
+
+    if settings["collapsed"]:
+        stage["samples"] = dict()
+        stage["stop"] = threading.Event()
+        stage["sampler"] = threading.Thread(target=sampleStacks,
+                                            args=(threading.get_ident(), stage["samples"], stage["stop"]),
+                                            daemon=True
+                                            )
+        stage["sampler"].start()
+
+    stage["profiler"] = cProfile.Profile()
+    stage["profiler"].enable()
+
+
+def stopProfile(stage):
+    # Stop profiling a stage, save its profile (and collapsed stacks), and
+    # resume the stage it's nested in
+    stage["profiler"].disable()
+    if settings["collapsed"]:
+        stage["stop"].set()
+        stage["sampler"].join()
+
+    path = profilePath(stage["name"], ".prof")
+    stage["profiler"].dump_stats(str(path))
+    print(str(datetime.now()), "Stage profile saved:", str(path))
+    if settings["collapsed"]:
+        path = profilePath(stage["name"], ".collapsed")
+        with open(path, "w") as fp:
+            for key, count in sorted(stage["samples"].items()):
+                fp.write(key + " " + str(count) + "\n")
+        print(str(datetime.now()), "Stage collapsed stacks saved:", str(path))
+
+    if running and running[-1]["profiler"] is not None:
+        running[-1]["profiler"].enable()
+
+
+def peakRss():
+    # Peak resident set size of the process so far, in bytes, or None
+    if resource is None:
+        return(None)
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # NOTE: macOS reports bytes, Linux reports kilobytes
+    if sys.platform != "darwin":
+        peak *= 1024
+
+    return(peak)
+
+
+def ioBytes():
+    # Bytes read and written by the process so far, or (None, None)
+    try:
+        with open("/proc/self/io") as fp:
+            counters = dict(line.split(":") for line in fp if ":" in line)
+        return((int(counters["rchar"]), int(counters["wchar"])))
+    except (OSError, KeyError, ValueError):
+        return((None, None))
+
+
+def tracedPeak():
+    # Peak traced memory since the last reset
+    return(tracemalloc.get_traced_memory()[1])
+
+
+def begin(name):
+    # Start timing a stage, stages may be nested
+    if settings["memory"] == "tracemalloc":
+        if running:
+            # NOTE: keep the outer stage's peak so far, before resetting it
+            running[-1]["peak"] = max(running[-1]["peak"], tracedPeak())
+        tracemalloc.reset_peak()
+
+    stage = dict()
+    stage["name"] = name
+    stage["start"] = datetime.now()
+    stage["peak"] = 0
+    stage["io"] = ioBytes()
+    stage["hits"] = stagecache.counts["hits"]
+    stage["misses"] = stagecache.counts["misses"]
+    stage["profiler"] = None
+    if settings["profileDir"] is not None:
+        startProfile(stage)
+    # NOTE: clocks read last, so the bookkeeping above isn't timed
+    stage["cpu"] = time.process_time()
+    stage["wall"] = time.perf_counter()
+    running.append(stage)
+
+
+def end(name, message=None):
+    # Finish timing a stage, and print its log message (if any)
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    stage = running.pop()
+    if stage["name"] != name:
+        raise ValueError("Stage '" + name + "' ended inside stage '" + stage["name"] + "'")
+
+    if settings["memory"] == "tracemalloc":
+        peak = max(stage["peak"], tracedPeak())
+        if running:
+            # NOTE: the outer stage's peak includes this one
+            running[-1]["peak"] = max(running[-1]["peak"], peak)
+    else:
+        peak = peakRss()
+
+    readBytes, writeBytes = ioBytes()
+    if readBytes is not None:
+        readBytes -= stage["io"][0]
+        writeBytes -= stage["io"][1]
+
+    hits = stagecache.counts["hits"] - stage["hits"]
+    misses = stagecache.counts["misses"] - stage["misses"]
+    cache = ""
+    if hits and misses:
+        cache = "mixed"
+    elif hits:
+        cache = "hit"
+    elif misses:
+        cache = "miss"
+
+    stages.append({"stage": name,
+                   "depth": len(running),
+                   "start": stage["start"].isoformat(),
+                   "wall": wall - stage["wall"],
+                   "cpu": cpu - stage["cpu"],
+                   "peakBytes": peak,
+                   "readBytes": readBytes,
+                   "writeBytes": writeBytes,
+                   "cacheHits": hits,
+                   "cacheMisses": misses,
+                   "cache": cache
+                   })
+
+    # NOTE: after the measurements, so saving the profile isn't counted
+    if stage["profiler"] is not None:
+        stopProfile(stage)
+
+    if message is not None:
+        print(str(datetime.now()), message)
+
+
+def megabytes(count):
+    # Byte count as megabytes for the summary table, blank if unknown
+    if count is None:
+        return("")
+
+    return("{:.1f}".format(count / MB))
+
+
+def summary():
+    # Table of the finished stages, nested stages indented under their parent
+    lines = list()
+    lines.append("{:<32} {:>10} {:>10} {:>10} {:>10} {:>10} {:>6}".format(
+        "stage", "wall s", "cpu s", "peak MB", "read MB", "write MB", "cache"))
+    # NOTE: stages end innermost first, so list them by when they started
+    for stage in sorted(stages, key=lambda s: (s["start"], s["depth"])):
+        lines.append("{:<32} {:>10.3f} {:>10.3f} {:>10} {:>10} {:>10} {:>6}".format(
+            ("  " * stage["depth"] + stage["stage"])[:32],
+            stage["wall"],
+            stage["cpu"],
+            megabytes(stage["peakBytes"]),
+            megabytes(stage["readBytes"]),
+            megabytes(stage["writeBytes"]),
+            stage["cache"]
+            ))
+
+    total = (datetime.now() - settings["started"]).total_seconds()
+    staged = sum(stage["wall"] for stage in stages if stage["depth"] == 0)
+    lines.append("{:<32} {:>10.3f}".format("run", total))
+    lines.append("{:<32} {:>10.3f}".format("  outside stages", total - staged))
+
+    return("\n".join(lines))
+
+
+def saveTrace(path):
+    # Write the finished stages to a CSV (.csv) or JSON trace file
+    path = Path(path)
+    if path.parent != Path(""):
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+    if path.suffix.lower() == ".csv":
+        with open(path, "w", newline="") as fp:
+            writer = csv.DictWriter(fp, fieldnames=FIELDS)
+            writer.writeheader()
+            writer.writerows(stages)
+    else:
+        trace = {"script": settings["script"],
+                 "args": settings["args"],
+                 "started": settings["started"].isoformat(),
+                 "memory": settings["memory"],
+                 "pid": os.getpid(),
+                 "stages": stages
+                 }
+        with open(path, "w") as fp:
+            # NOTE: default=str covers arguments json can't write, eg: tuples of tuples
+            json.dump(trace, fp, indent=2, default=str)
+
+
+def finish():
+    # Print the summary table and write the trace file, once per run
+    # NOTE: also called at exit, so an interrupted run still leaves a trace
+    if settings["finished"] or not stages:
+        return
+    settings["finished"] = True
+
+    print(str(datetime.now()), "Stage summary (" + settings["memory"] + " peak memory):")
+    print(summary())
+    if settings["path"] is not None:
+        saveTrace(settings["path"])
+        print(str(datetime.now()), "Stage trace saved:", str(settings["path"]))